@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of PickleCache.
+
+Usage:
+    python benchmark_cache.py compression
+    python benchmark_cache.py hashing
+    python benchmark_cache.py batch
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import shutil
+import string
+import tempfile
+import time
+
+from flexp.flow.cache import PickleCache, np
+from flexp.flow.serialization import CODECS
+
+
+class Tokenize:
+    """Produce text-heavy data similar to tokenized corpora."""
+
+    def __init__(self, documents, words):
+        self.documents = documents
+        self.words = words
+
+    def process(self, data):
+        rnd = random.Random(data["id"])
+        vocabulary = ["".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(2, 12)))
+                      for _ in range(5000)]
+        data["tokens"] = [[rnd.choice(vocabulary) for _ in range(self.words)] for _ in range(self.documents)]
+        data["vocabulary"] = dict((word, i) for i, word in enumerate(vocabulary))
+
+
+def benchmark_compression(documents=2000, words=200, repeat=5):
+    """Compare entry size and read throughput of compression codecs."""
+    print("{:>6} {:>10} {:>8} {:>12} {:>12}".format("codec", "size [MB]", "ratio", "write [s]", "read [MB/s]"))
+    raw_size = None
+    for name in ["none"] + sorted(name for name in CODECS if name != "none"):
+        if name != "none" and not CODECS[name].available:
+            print("{:>6} not available, install {}".format(name, CODECS[name].requires))
+            continue
+        directory = tempfile.mkdtemp()
+        try:
+            cache = PickleCache(directory, chain=[Tokenize(documents, words)],
+                                compression=None if name == "none" else name)
+            start = time.time()
+            cache.process({"id": 1})
+            write_time = time.time() - start
+            key = cache.get_cache_key({"id": 1})
+            size = cache.storage.size(key)
+            raw_size = raw_size or size
+
+            start = time.time()
+            for _ in range(repeat):
+                cache.process({"id": 1})
+            read_time = (time.time() - start) / repeat
+            print("{:>6} {:>10.1f} {:>8.2f} {:>12.2f} {:>12.1f}".format(
+                name, size / 1024 ** 2, raw_size / size, write_time, raw_size / 1024 ** 2 / read_time))
+        finally:
+            shutil.rmtree(directory)
+
+
+class Lookup:
+    """Module holding a large vocabulary and embedding matrix."""
+
+    def __init__(self, words, dimension):
+        self.vocabulary = dict(("word{}".format(i), i) for i in range(words))
+        self.embeddings = np.random.RandomState(0).rand(words, dimension) if np is not None else None
+
+    def process(self, data):
+        data["indices"] = [self.vocabulary.get(token) for token in data["tokens"]]
+
+
+def benchmark_hashing(words=5000, dimension=10, repeat=1):
+    """Compare time to fingerprint a chain with streaming ObjectHasher and legacy ObjectDumper.
+
+    The legacy dump grows quadratically with size of the module, keep the sizes small.
+    """
+    chain = [Lookup(words, dimension)]
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:>8} {:>10}".format("method", "time [s]"))
+        for fingerprint in ["stream", "dump"]:
+            start = time.time()
+            for _ in range(repeat):
+                PickleCache(directory, chain=chain, fingerprint=fingerprint)
+            print("{:>8} {:>10.2f}".format(fingerprint, (time.time() - start) / repeat))
+    finally:
+        shutil.rmtree(directory)
+
+
+def add_one(data):
+    data["output"] = data["id"] + 1
+
+
+def benchmark_batch(items=20000, batch_size=1000):
+    """Compare reading cached items one by one with `process_many`."""
+    directory = tempfile.mkdtemp()
+    try:
+        cache = PickleCache(directory, chain=[add_one])
+        for data in cache.process_many({"id": i} for i in range(items)):
+            pass
+        print("{:>14} {:>12}".format("method", "items/s"))
+        start = time.time()
+        for i in range(items):
+            cache.process({"id": i})
+        print("{:>14} {:>12.0f}".format("process", items / (time.time() - start)))
+        start = time.time()
+        for data in cache.process_many(({"id": i} for i in range(items)), batch_size=batch_size):
+            pass
+        print("{:>14} {:>12.0f}".format("process_many", items / (time.time() - start)))
+        cache.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    "batch": benchmark_batch,
+    "compression": benchmark_compression,
+    "hashing": benchmark_hashing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
+
+
+if __name__ == "__main__":
+    main()
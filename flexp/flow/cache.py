@@ -3,29 +3,66 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from copy import deepcopy, copy
 from pickle import HIGHEST_PROTOCOL
 
 import six
-import collections
+import collections.abc
 import time
 import hashlib
+import io
 import os
 import inspect
+import logging
 from functools import partial
+from itertools import islice
+from operator import itemgetter
 from six.moves import cPickle as pickle
 import gc
-import stat
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from flexp.flow import Chain
-from flexp.utils import get_logger
+from flexp.flow.cache_stats import CacheStats, write_stats
+from flexp.flow.cache_index import CacheIndex, LRU, EVICTION_POLICIES, collect_garbage
+from flexp.flow.lazy import LazyData
+from flexp.flow.serialization import (CorruptedEntryError, CountingReader, RECORDS, RECORDS_MAGIC, entry_writer,
+                                      get_codec, open_entry, read_records, write_records)
+from flexp.flow.memory_cache import MemoryCache
+from flexp.flow.shared_cache import SharedMemoryCache
+from flexp.flow.storage import (DirectoryStorage, RWRWRW, atomic_path, makedirs, remove_sidecars,
+                                sidecar_directory)
+from flexp.utils import get_logger, id_generator
 
 
 log = get_logger(__name__)
 
 
-RWRWRW = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH
 GB = 1024 ** 3
+MB = 1024 ** 2
+
+# which keys of data PickleCache stores
+SAVE_ALL = "all"
+SAVE_CHANGED = "changed"
+SAVE_PROVIDES = "provides"
+SAVE_KEYS = (SAVE_ALL, SAVE_CHANGED, SAVE_PROVIDES)
+
+# how chains are fingerprinted - streaming ObjectHasher or the original ObjectDumper string
+FINGERPRINT_STREAM = "stream"
+FINGERPRINT_DUMP = "dump"
+FINGERPRINTS = (FINGERPRINT_STREAM, FINGERPRINT_DUMP)
+
+# how changes of module code are detected - warning on changed source mtimes or code hashed into the chain hash
+INVALIDATE_MTIME = "mtime"
+INVALIDATE_CODE = "code"
+INVALIDATIONS = (INVALIDATE_MTIME, INVALIDATE_CODE)
+
+PRIMITIVE_TYPES = frozenset([type(None), bool, int, float, complex, six.text_type, six.binary_type])
 
 
 class PickleMixinP2(object):
@@ -70,9 +107,178 @@ else:
     PickleMixin = PickleMixinP2
 
 
+# sha256 of source files by their path, mtime and size
+_source_hashes = {}
+
+
+def source_file_hash(path):
+    """Return sha256 of the file content, cached per process.
+
+    The file is read again only when its mtime or size change, e.g. when the module is reloaded.
+
+    :param str path:
+    :return: str hex digest
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _source_hashes:
+        with open(path, "rb") as f:
+            _source_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+    return _source_hashes[key]
+
+
+def code_hash(module):
+    """Return fingerprint of the code of the module.
+
+    Classes are represented by source files of all their (non-builtin) base classes, so that changes of helper
+    functions in the same file are detected too. Functions are represented by their own source only, they are
+    often defined in the main script. Bytecode is used when the source is not available.
+
+    :param object|function module:
+    :return: str hex digest
+    """
+    if isinstance(module, partial):
+        module = module.func
+    if inspect.isfunction(module) or inspect.ismethod(module):
+        try:
+            source = inspect.getsource(module).encode("utf8")
+        except (TypeError, OSError, IOError):
+            source = six.get_function_code(module).co_code
+        return hashlib.sha256(source).hexdigest()
+    parts = []
+    for cls in inspect.getmro(module.__class__):
+        try:
+            parts.append(source_file_hash(inspect.getsourcefile(cls)))
+        except (TypeError, OSError, IOError):  # builtin class or missing source
+            for name, function in sorted(vars(cls).items()):
+                if inspect.isfunction(function):
+                    parts.append(name + hashlib.sha256(six.get_function_code(function).co_code).hexdigest())
+    return hashlib.sha256("".join(parts).encode("ascii")).hexdigest()
+
+
+class ObjectHasher(object):
+    """Streaming fingerprint of an object including values of its attributes.
+
+    Follows the rules of ObjectDumper - attributes listed in PickleCacheBlackList are skipped and the recursion
+    is limited - but the data are fed into a hashlib object instead of being concatenated into one string.
+    Objects are visited only once per run, numpy arrays are hashed via their buffer and large containers of
+    primitive values are hashed at once. Objects may provide their own fingerprint by `__flexp_hash__` method
+    returning bytes or string.
+    """
+
+    def __init__(self, max_recursion_level=10, debug_level=0):
+        """
+        :param int max_recursion_level:
+        :param int debug_level: debug_level 0 (silence), 1 or 2 (full)
+        """
+        self.max_recursion_level = max_recursion_level
+        self.debug_level = debug_level
+        self._hash = hashlib.sha256()
+        # position of visited objects by their id, the objects are kept alive so that ids are not reused
+        self._memo = {}
+        self._visited = []
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def _feed(self, tag, payload, level):
+        if not isinstance(payload, six.binary_type):
+            payload = six.text_type(payload).encode("utf8")
+        if self.debug_level == 2:
+            print("\t" * level + "level: {}, {} {!r}".format(level, tag, payload[:80]))
+        self._hash.update("{}:{}:".format(tag, len(payload)).encode("ascii"))
+        self._hash.update(payload)
+
+    def update(self, obj, level=0):
+        """Feed the object into the hash.
+
+        :param obj: any object
+        :param int level: recursion level
+        """
+        if level > self.max_recursion_level:
+            return
+        if type(obj) in PRIMITIVE_TYPES:
+            self._feed(type(obj).__name__, obj if isinstance(obj, six.binary_type) else repr(obj), level)
+            return
+        if id(obj) in self._memo:
+            self._feed("ref", self._memo[id(obj)], level)
+            return
+        self._memo[id(obj)] = len(self._visited)
+        self._visited.append(obj)
+
+        self._feed("class", obj.__class__.__name__, level)
+        name = getattr(obj, "__name__", None)
+        if isinstance(name, six.string_types):  # to distinguish functions from each other
+            self._feed("name", name, level)
+
+        flexp_hash = getattr(obj, "__flexp_hash__", None)
+        if flexp_hash is not None and not isinstance(obj, type):
+            self._feed("flexp_hash", flexp_hash(), level)
+            return
+        if np is not None and isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            self._feed("ndarray", "{}{}".format(obj.dtype.str, obj.shape), level)
+            self._hash.update(np.ascontiguousarray(obj).reshape(-1).view(np.uint8).data)
+            return
+
+        items = self._items(obj)
+        if items is None:
+            try:
+                self._feed("pickle", pickle.dumps(obj, HIGHEST_PROTOCOL), level)
+            except Exception:  # object could not be dumped
+                log.debug("Can't hash object type {}".format(obj.__class__.__name__))
+        elif PRIMITIVE_TYPES.issuperset(map(type, map(itemgetter(0), items))) and \
+                PRIMITIVE_TYPES.issuperset(map(type, map(itemgetter(1), items))):
+            # repr of primitive values is deterministic and much faster than visiting them one by one
+            self._feed("items", repr(items), level)
+        else:
+            for key, value in items:
+                self.update(key, level + 1)
+                self.update(value, level + 1)
+
+    @staticmethod
+    def _sorted(items):
+        try:
+            # names are unique so values are never compared
+            return sorted(items)
+        except TypeError:
+            return sorted(items, key=lambda item: (item[0].__class__.__name__, repr(item[0])))
+
+    def _items(self, obj):
+        """Return sorted (name, value) pairs describing the object, None if the object is a leaf."""
+        if isinstance(obj, (list, tuple)):
+            return list(enumerate(obj))
+        if isinstance(obj, (set, frozenset)):
+            return self._sorted((value, None) for value in obj)
+        if isinstance(obj, dict):
+            return self._sorted(obj.items())
+        if hasattr(obj, "__dict__"):
+            items = dict(vars(obj))
+            for attribute in getattr(obj, "PickleCacheBlackList", ()):
+                items.pop(attribute, None)
+            return self._sorted(items.items())
+        return None
+
+
 class ObjectDumper(PickleMixin):
     """Functionality of this class is used in PickleCache and CachingChain"""
 
+    def _object_hash(self, obj, max_recursion_level, debug_level=0):
+        """Return sha256 fingerprint of the object and its attributes.
+
+        :param obj: Object instance
+        :param int max_recursion_level:
+        :param int debug_level: debug_level 0 (silence), 1 or 2 (full)
+        :return: str hex digest
+        """
+        if getattr(self, "fingerprint", FINGERPRINT_STREAM) == FINGERPRINT_DUMP:
+            return hashlib.sha256(self._object_dump_to_string(obj, max_recursion_level,
+                                                              debug_level=debug_level)).hexdigest()
+        hasher = ObjectHasher(max_recursion_level, debug_level)
+        hasher.update(obj)
+        if debug_level > 0:
+            print("object hash is {}".format(hasher.hexdigest()))
+        return hasher.hexdigest()
+
     def _object_dump_to_string(self, obj, max_recursion_level, level=0, debug_level=0):
         """Consolidate object with its attributes and their values into ony byte-string.
         If object has PickleCacheBlackList class attribute then attributes listed there are not taken into account.
@@ -152,17 +358,111 @@ class ObjectDumper(PickleMixin):
         return dump_string
 
 
+def _stored_items(data):
+    """Return (key, value) pairs of data as stored, values of `LazyData` are not loaded.
+
+    :param data: dict or dict-like data
+    :rtype: list[tuple]
+    """
+    return list(dict.items(data) if isinstance(data, dict) else data.items())
+
+
+class ArrayPickler(pickle.Pickler):
+    """Pickler that stores large numpy arrays as sidecar `.npy` files next to the pickle file.
+
+    Pandas blocks are covered too as they are pickled as plain numpy arrays.
+    """
+
+    def __init__(self, file, path, min_bytes=MB, protocol=HIGHEST_PROTOCOL):
+        """
+        :param file: opened binary file the pickle is written to
+        :param str path: path of the pickle file, sidecars are stored as `<token>.<n>.npy` in its sidecar directory
+        (see `flexp.flow.storage.sidecar_directory`)
+        :param int min_bytes: smaller arrays are kept inside the pickle
+        :param int protocol: pickle protocol
+        """
+        super(ArrayPickler, self).__init__(file, protocol)
+        self.path = path
+        # unique per write so that readers of a replaced entry never see sidecars of the new one
+        self.token = id_generator(8)
+        self.min_bytes = min_bytes
+        self.sidecars = []
+        self._saved = {}
+
+    def persistent_id(self, obj):
+        if np is None or type(obj) not in (np.ndarray, np.memmap):
+            return None
+        if obj.dtype.hasobject or obj.nbytes < self.min_bytes:
+            return None
+        if id(obj) not in self._saved:
+            directory = sidecar_directory(self.path)
+            makedirs(directory)
+            name = "{}.{}.npy".format(self.token, len(self.sidecars))
+            sidecar = os.path.join(directory, name)
+            with atomic_path(sidecar) as tmp_path, open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(obj), allow_pickle=False)
+            self.sidecars.append(sidecar)
+            # keep the reference so that id(obj) is not reused during pickling, the name is relative to the pickle
+            self._saved[id(obj)] = (obj, ("ndarray", os.path.basename(directory) + "/" + name))
+        return self._saved[id(obj)][1]
+
+
+class ArrayUnpickler(pickle.Unpickler):
+    """Unpickler counterpart of ArrayPickler, sidecar arrays are memory-mapped read-only."""
+
+    def __init__(self, file, path):
+        """
+        :param file: opened binary file the pickle is read from
+        :param str|None path: path of the pickle file, None if the pickle is not stored as a file
+        """
+        super(ArrayUnpickler, self).__init__(file)
+        self.directory = os.path.dirname(path) if path is not None else None
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind != "ndarray" or self.directory is None:
+            raise pickle.UnpicklingError("Unsupported persistent id {}".format(kind))
+        try:
+            return np.load(os.path.join(self.directory, name), mmap_mode="r")
+        except (IOError, OSError):
+            raise CorruptedEntryError("Missing sidecar array {}".format(name))
+
+
 class PickleCache(Chain, ObjectDumper):
     """
     Caches the data processed by the given chain. Cached data are stored in the given directory as pickle files.
     File names are the hash od data.id and chain hash.
+    Other storage backends (e.g. `flexp.flow.storage.SqliteStorage`) can be passed as `storage`.
     """
 
+    # runtime state and options of storing the entries do not describe the cached chain, so a cache nested in
+    # another chain can be tuned without invalidating the outer entries
+    PickleCacheBlackList = ["_writer", "_write_slots", "_pending", "memory", "shared", "stats", "_hot_log",
+                            "batch_size", "_accesses", "_accesses_lock", "_accesses_flushed", "storage", "index",
+                            "max_bytes", "max_entries", "max_age", "eviction", "compression", "compression_level",
+                            "single_flight", "lock_timeout", "async_write", "write_workers", "max_pending_writes",
+                            "save_keys", "fingerprint", "invalidation", "memory_copy_on_read", "mmap_arrays",
+                            "mmap_min_bytes", "chunked", "lazy", "_index_synced"]
+
+    # hits are written to the access index in batches of this size or after this number of seconds
+    ACCESS_BATCH = 1000
+    ACCESS_INTERVAL = 10.
+    # process_many and lookup_many prefetch hits of a batch only up to this number of bytes, the rest is read on demand
+    PREFETCH_MAX_BYTES = 64 * MB
+
+    _hot_logger = log
+
     def __init__(self, directory, data_key="id", chain=None, force=False,
-                 max_recursion_level=10, dir_rights=0o777, debug_level=0, save_cache=True):
+                 max_recursion_level=10, dir_rights=0o777, debug_level=0, save_cache=True, mmap_arrays=False,
+                 mmap_min_bytes=MB, storage=None, max_bytes=None, max_entries=None, max_age=None, eviction=LRU,
+                 compression=None, compression_level=None, single_flight=False, lock_timeout=None,
+                 async_write=False, write_workers=1, max_pending_writes=4, save_keys=SAVE_ALL,
+                 fingerprint=FINGERPRINT_STREAM, invalidation=INVALIDATE_MTIME, memory_max_bytes=None,
+                 memory_copy_on_read=True, shared_memory=False, name=None, log_every=None, log_interval=None,
+                 chunked=False, lazy=False):
         """
 
-        :param directory:
+        :param directory: directory of the default DirectoryStorage, ignored if `storage` is given
         :param data_key:
         :param chain:
         :param boolean force: if True then will not read the cache
@@ -170,13 +470,113 @@ class PickleCache(Chain, ObjectDumper):
         :param dir_rights:
         :param int debug_level:
         :param boolean force: if True then will dump the cache
+        :param bool mmap_arrays: if True then numpy arrays (and pandas blocks) in data are stored as sidecar `.npy`
+        files and memory-mapped read-only on cache hit
+        :param int mmap_min_bytes: arrays smaller than this are pickled as usual
+        :param flexp.flow.storage.CacheStorage storage: storage backend, DirectoryStorage(directory) by default
+        :param int max_bytes: maximal total size of the cache, evicted entries are chosen by `eviction` policy
+        :param int max_entries: maximal number of entries in the cache
+        :param float max_age: entries not accessed for longer than `max_age` seconds are evicted
+        :param str eviction: "lru" (least recently used) or "lfu" (least frequently used)
+        :param str compression: codec of written entries - "gzip", "bz2", "lzma", "lz4" or "zstd", None for no
+        compression; codec of read entries is detected automatically
+        :param int compression_level: codec specific compression level, codec default if None
+        :param bool single_flight: if True then only one process computes a missing entry while other processes
+        wait for its result; uses file locks
+        :param float lock_timeout: how long to wait for an entry computed by another process, the entry is
+        computed anyway after the timeout; None waits forever
+        :param bool async_write: if True then entries are serialized and written by background threads, so a cache
+        miss costs only the computation; modules following the cache must not modify values of data in place
+        until `flush` or `close` is called. Ignored with single_flight.
+        :param int write_workers: number of background writer threads
+        :param int max_pending_writes: processing blocks while this many entries wait to be written
+        :param str save_keys: which keys of data are stored - "all" keys, "changed" keys (added or reassigned by
+        the chain and keys in `provides` of its modules) or only keys in "provides" of the modules
+        :param str fingerprint: how the chain is hashed - "stream" (ObjectHasher) or "dump" (ObjectDumper string,
+        used by flexp before, keeps entries written by older versions valid)
+        :param str invalidation: "mtime" only warns when source files of modules were modified after the entry was
+        written, "code" adds hash of the source code of modules to the chain hash so entries of changed code are
+        never used
+        :param int memory_max_bytes: budget of in-process memory tier in front of the storage (measured as length of
+        pickled entries), recently used entries are kept in memory, None disables the tier
+        :param bool memory_copy_on_read: keep pickled entries in memory and unpickle them on every hit, otherwise
+        the same objects are returned on every hit and must not be modified in place
+        :param bool shared_memory: entries loaded from the storage are published in shared memory, other processes
+        (e.g. workers of ParallelDataChain) attach them instead of reading the storage, numpy arrays are shared
+        zero-copy and read-only; requires Python 3.8+
+        :param str name: name of the cache in logs and statistics
+        :param int log_every: per-item messages (cache hits and misses) are not logged one by one but summarized after
+        this number of messages
+        :param float log_interval: per-item messages are summarized after this number of seconds
+        :param bool chunked: every value of cached data is pickled and stored as a separate record, so memory needed
+        for writing is given by the largest value and selected keys can be loaded alone (see `lookup_keys`); cached
+        data are retrieved as dict. Entries of both layouts are read regardless of this option.
+        :param bool lazy: implies `chunked`; on cache hit, values of chunked entries are not loaded into data of type
+        `flexp.flow.lazy.LazyData` until they are accessed, other data are filled as usual
         """
-        super(PickleCache, self).__init__(chain)
+        if mmap_arrays and np is None:
+            raise ImportError("mmap_arrays=True requires numpy")
+        if storage is None:
+            storage = DirectoryStorage(directory, dir_rights)
+        if mmap_arrays and not storage.entry_files:
+            raise ValueError("mmap_arrays=True requires storage with entries stored as files")
+        get_codec(compression)  # fail early on unknown or unavailable codec
+        if invalidation not in INVALIDATIONS:
+            raise ValueError("Unknown invalidation {}, use one of {}".format(invalidation, INVALIDATIONS))
+        if fingerprint not in FINGERPRINTS:
+            raise ValueError("Unknown fingerprint {}, use one of {}".format(fingerprint, FINGERPRINTS))
+        if save_keys not in SAVE_KEYS:
+            raise ValueError("Unknown save_keys {}, use one of {}".format(save_keys, SAVE_KEYS))
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}, use one of {}".format(eviction, EVICTION_POLICIES))
+        if single_flight and storage.lock_path("") is None:
+            raise ValueError("Storage {!r} does not support locking needed for single_flight".format(storage))
+        bounded = max_bytes is not None or max_entries is not None or max_age is not None
+        if bounded and storage.index_path() is None:
+            raise ValueError("Storage {!r} does not support access index needed for eviction".format(storage))
+        super(PickleCache, self).__init__(chain, name=name, log_every=log_every, log_interval=log_interval)
+        if save_keys == SAVE_PROVIDES and not self.provides:
+            raise ValueError("save_keys={!r} requires modules of the chain with non-empty provides, nothing would be "
+                             "stored".format(save_keys))
         self.directory = directory
+        self.storage = storage
+        self.index = CacheIndex(storage.index_path()) if bounded else None
+        # entries written without the index (e.g. by an unbounded cache) are indexed before the first eviction
+        self._index_synced = False
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.eviction = eviction
+        self.compression = compression
+        self.compression_level = compression_level
+        self.single_flight = single_flight
+        self.lock_timeout = lock_timeout
+        self.async_write = async_write
+        self.write_workers = write_workers
+        self.max_pending_writes = max_pending_writes
+        self.save_keys = save_keys
+        self.fingerprint = fingerprint
+        self.invalidation = invalidation
+        self.memory = MemoryCache(memory_max_bytes) if memory_max_bytes is not None else None
+        self.memory_copy_on_read = memory_copy_on_read
+        self.shared = SharedMemoryCache() if shared_memory else None
+        self.stats = CacheStats()
+        # background writer is started lazily, it cannot be pickled
+        self._writer = None
+        self._write_slots = None
+        self._pending = set()
+        # hits not written to the access index yet, {key -> (time of the last hit, number of hits)}
+        self._accesses = {}
+        self._accesses_lock = threading.Lock()
+        self._accesses_flushed = time.time()
         self.force = force
         self.data_key = data_key
         self.max_recursion_level = max_recursion_level
         self.debug_level = debug_level
+        self.mmap_arrays = mmap_arrays
+        self.mmap_min_bytes = mmap_min_bytes
+        self.chunked = chunked or lazy
+        self.lazy = lazy
 
         self.chain_info = {'chain_len': 0, 'chain_hash': None,
                            'chain_mtime': None,
@@ -186,38 +586,49 @@ class PickleCache(Chain, ObjectDumper):
         if chain is not None:
             self.hash_chain()
 
-        if not os.path.exists(directory):
-            # Override umask settings to enforce flexible rights. 777 enables collaboration between people and prevents
-            # omnipresent AccessDeniedErrors.
-            original_umask = None
-            try:
-                original_umask = os.umask(0)
-                os.makedirs(directory, dir_rights)
-            finally:
-                if original_umask is not None:
-                    os.umask(original_umask)
-
     def step(self, data):
         # TODO write step method or get rid of step altogether, as Inspector is not much used
         pass
 
-    def get_cache_file_from_id(self, data_id):
+    def get_cache_key_from_id(self, data_id):
+        """Return storage key of the cache entry.
+
+        :param data_id: value of data[data_key]
+        :rtype: str
+        """
         key = hashlib.sha256(self.pickle(data_id)).hexdigest()
-        return self.directory + "/" + key + self.chain_info['chain_hash']
+        return key + self.chain_info['chain_hash']
+
+    def get_cache_key(self, data):
+        """
+        :type data: dict
+        :rtype: str
+        """
+        return self.get_cache_key_from_id(data[self.data_key])
+
+    def get_cache_file_from_id(self, data_id):
+        """Return path to the cache file, None if the storage does not use files."""
+        return self.storage.path(self.get_cache_key_from_id(data_id))
 
     def get_cache_file(self, data):
-        key = hashlib.sha256(self.pickle(data[self.data_key])).hexdigest()
-        chain_hash = self.chain_info['chain_hash']
-        return self.directory + "/" + key + chain_hash
+        """Return path to the cache file, None if the storage does not use files."""
+        return self.get_cache_file_from_id(data[self.data_key])
+
+    def check_cache_exists_from_id(self, data_id):
+        """
+        :param data_id: value of data[data_key]
+        :rtype: bool
+        """
+        key = self.get_cache_key_from_id(data_id)
+        self._hot_log.log(logging.DEBUG, "Cache: {} in {!r}", key, self.storage)
+        return self.storage.exists(key)
 
     def check_cache_exists(self, data):
         """
         :type data: dict
         :rtype: bool
         """
-        file = self.get_cache_file(data)
-        log.debug("Cache: {}".format(file))
-        return os.path.exists(file)
+        return self.check_cache_exists_from_id(data[self.data_key])
 
     @staticmethod
     def hash_dump_string(dump_string):
@@ -236,8 +647,7 @@ class PickleCache(Chain, ObjectDumper):
         :return: string
         """
         # todo if like this then PickleCache(m1, m2) + PickleCache(m3) != PickleCache(m1, m2, m3)
-        chain_string = self._object_dump_to_string(chain, self.max_recursion_level, debug_level=self.debug_level)
-        return self.hash_dump_string(chain_string)
+        return self._object_hash(chain, self.max_recursion_level, debug_level=self.debug_level)
 
     def _get_object_mtime(self, obj):
         """Extract mtime from object's source file.
@@ -259,7 +669,7 @@ class PickleCache(Chain, ObjectDumper):
         """
         chain_mtimes = [0.]  # default time in case no other time is obtained
         for module in chain:
-            if isinstance(module, collections.Iterable):  # module is a chain
+            if isinstance(module, collections.abc.Iterable):  # module is a chain
                 chain_mtimes.append(self._get_chain_mtime(module))
             elif hasattr(module, 'process'):  # module is an object
                 chain_mtimes.append(self._get_object_mtime(module))
@@ -268,6 +678,20 @@ class PickleCache(Chain, ObjectDumper):
                 pass
         return max(chain_mtimes)
 
+    def _get_chain_code_hash(self, chain):
+        """Hash the code of all modules in the chain.
+
+        :param chain: list of modules
+        :return: string
+        """
+        code_hashes = []
+        for module in chain:
+            if isinstance(module, collections.abc.Iterable):  # module is a chain
+                code_hashes.append(self._get_chain_code_hash(module))
+            else:
+                code_hashes.append(code_hash(module))
+        return hashlib.sha256(" ".join(code_hashes).encode("ascii")).hexdigest()
+
     def _get_chain_repr(self, chain):
         """Concatenate string representations of all modules in the chain.
 
@@ -276,7 +700,7 @@ class PickleCache(Chain, ObjectDumper):
         """
         chain_repr = []
         for module in chain:
-            if isinstance(module, collections.Iterable):  # module is a chain
+            if isinstance(module, collections.abc.Iterable):  # module is a chain
                 chain_repr.append(self._get_chain_repr(module))
             elif hasattr(module, 'process'):  # module is an object
                 chain_repr.extend(
@@ -297,12 +721,22 @@ class PickleCache(Chain, ObjectDumper):
         :return: (dict, bool)
         """
         stop = False
+        # values are referenced, so that ids of rebound values cannot be reused; placeholders of LazyData are not
+        # loaded
+        before = dict(_stored_items(data)) if self.save_keys == SAVE_CHANGED else None
         try:
             super(PickleCache, self).process(data)
         except StopIteration:
             stop = True
 
-        data_to_save = data
+        if self.save_keys == SAVE_ALL:
+            data_to_save = data
+        else:
+            saved_keys = set(key for key in self.provides if key in data)
+            if self.save_keys == SAVE_CHANGED:
+                saved_keys.update(key for key, value in _stored_items(data)
+                                  if key not in before or before[key] is not value)
+            data_to_save = dict((key, data[key]) for key in saved_keys)
 
         cache = dict() if cache is None else cache
         cache[self.chain_info['chain_hash']] = {"data": data_to_save,
@@ -328,10 +762,14 @@ class PickleCache(Chain, ObjectDumper):
     def hash_chain(self):
         """Hash the chain in order to use the hash as a dictionary key."""
         if len(self.modules) != self.chain_info['chain_len']:
+            chain_hash = self._get_chain_hash(self.modules)
+            if self.invalidation == INVALIDATE_CODE:
+                chain_hash = self.hash_dump_string(
+                    (chain_hash + self._get_chain_code_hash(self.modules)).encode("ascii"))
             self.chain_info = {
                 'chain_len': len(self.modules),
                 'chain_mtime': self._get_chain_mtime(self.modules),
-                'chain_hash': self._get_chain_hash(self.modules),
+                'chain_hash': chain_hash,
                 'chain_repr': self._get_chain_repr(self.modules),
             }
 
@@ -340,59 +778,553 @@ class PickleCache(Chain, ObjectDumper):
         """Return chain_hash of the current chain."""
         return self.chain_info['chain_hash']
 
-    def process(self, data):
+    def process(self, data, exists=None):
         """
         Checks if there is cached data. If so, returns it, otherwise runs the chain and stores the processed data.
         :type data: dict
+        :param bool exists: whether the entry is stored if it is already known (e.g. listed by CachingChain),
+        otherwise it is looked up
         :return:
         """
-        file = self.get_cache_file(data)
-        loaded = False
-        if self.check_cache_exists(data):
-            if self.force:
-                log.info("Item found in cache but force=True")
+        cache_key = self.get_cache_key(data)
+        self._hot_log.log(logging.DEBUG, "Cache: {} in {!r}", cache_key, self.storage)
+        if exists is None:
+            exists = (self.memory is not None and cache_key in self.memory) or self.storage.exists(cache_key)
+        self._process_item(cache_key, data, exists)
+
+    def process_batch(self, data_list):
+        """Process a list of data, cache entries are looked up for the whole list at once.
+
+        Called for every micro-batch of a chain, so the entries are looked up by one query of the storage instead of
+        its listing and hits are read one by one.
+
+        :param list[dict] data_list:
+        :return list[dict]: data for which the chain did not request stop
+        """
+        return list(self.process_many(data_list, batch_size=max(len(data_list), 1), prefetch=False, listing=False))
+
+    def stream(self, data_iterable):
+        """Return generator of processed data, see `Chain.stream`.
+
+        Cache entries are looked up by `process_many`, so one batch of data is kept in memory. The cached chain
+        processes one data at a time, it cannot contain transforms.
+
+        :param iterable[dict] data_iterable:
+        :return: generator of processed data
+        """
+        return self.process_many(data_iterable)
+
+    def process_many(self, data_iterable, batch_size=1000, prefetch=True, listing=True):
+        """Process a stream of data, cache entries are looked up and read in batches.
+
+        Existence of entries is resolved by one listing of the directory storage (or one query per batch for other
+        storages) and hits are read in a background thread while the previous batch is processed, up to
+        `PREFETCH_MAX_BYTES` per batch. Misses are checked once more before computing, so entries written after the
+        listing (e.g. of repeated ids) are used. The iterable is consumed one batch ahead of the returned generator.
+
+        :param iterable[dict] data_iterable:
+        :param int batch_size: number of items looked up at once
+        :param bool prefetch: read entries of the next batch in background, otherwise entries are read one by one
+        :param bool listing: list the directory storage once, otherwise entries are looked up by one query per batch;
+        listing pays off only for runs touching a good part of the cache
+        :return: generator of processed data, items for which the chain requested stop are left out
+        """
+        for data, cache_key, exists, payload in self._lookup(data_iterable, lambda data: data[self.data_key],
+                                                             batch_size, prefetch, listing):
+            if not exists and not self.force:
+                # entries computed during this run are not in the listing, a miss costs the computation anyway
+                exists = (self.memory is not None and cache_key in self.memory) or self.storage.exists(cache_key)
+            try:
+                stopped = self._process_item(cache_key, data, exists, payload)
+            except StopIteration:
+                stopped = True
+            if not stopped:
+                yield data
+
+    def lookup_many(self, ids, batch_size=1000, prefetch=True):
+        """Return cached data of many ids without running the chain.
+
+        :param iterable ids: values of data[data_key]
+        :param int batch_size: number of items looked up at once
+        :param bool prefetch: read entries of the next batch in background
+        :return list[dict|None]: cached data in the order of ids, None if the entry is missing or the chain was stopped
+        """
+        results = []
+        for _, cache_key, exists, payload in self._lookup(ids, lambda data_id: data_id, batch_size, prefetch):
+            cache = self._read_entry(cache_key, payload) if exists else None
+            if cache is None:
+                self.stats.count("misses")
+            if cache is None or cache["stopped"]:
+                results.append(None)
             else:
+                self._record_access(cache_key)
+                results.append(cache["data"])
+        return results
+
+    def lookup_keys(self, data_id, keys):
+        """Return selected keys of cached data without running the chain.
+
+        Values of other keys of chunked entries are not unpickled.
+
+        :param data_id: value of data[data_key]
+        :param iterable keys: keys of data to be loaded
+        :return dict|None: cached values of the keys (keys missing in the entry are left out), None if the entry is
+        missing or the chain was stopped
+        """
+        keys = set(keys)
+        cache_key = self.get_cache_key_from_id(data_id)
+        exists = (self.memory is not None and cache_key in self.memory) or self.storage.exists(cache_key)
+        cache = self._read_entry(cache_key, keys=keys) if exists else None
+        if cache is None:
+            self.stats.count("misses")
+        if cache is None or cache["stopped"]:
+            return None
+        self._record_access(cache_key)
+        return dict((key, value) for key, value in cache["data"].items() if key in keys)
+
+    def _lookup(self, items, get_id, batch_size, prefetch, listing=True):
+        """Resolve cache keys and existence of entries in batches.
+
+        :param iterable items: data or ids
+        :param get_id: {item -> data id}
+        :param int batch_size:
+        :param bool prefetch: read payloads of hits of the next batch in background, see `_prefetch`
+        :param bool listing: list storages supporting bulk listing once instead of querying every batch
+        :return: generator of (item, cache key, bool exists, bytes payload or None)
+        """
+        executor = ThreadPoolExecutor(1) if prefetch else None
+        listed = set(self.storage.keys()) if listing and self.storage.bulk_listing and not self.force else None
+        iterator = iter(items)
+        previous = None
+        try:
+            while True:
+                current = None
+                batch = list(islice(iterator, batch_size))
+                if batch:
+                    keys = [self.get_cache_key_from_id(get_id(item)) for item in batch]
+                    if self.force:
+                        found = set()
+                    elif listed is not None:
+                        found = listed.intersection(keys)
+                    else:
+                        found = self.storage.exists_many(keys)
+                    if self.memory is not None and not self.force:
+                        in_memory = set(key for key in keys if key in self.memory)
+                        found.update(in_memory)
+                    else:
+                        in_memory = set()
+                    hits = [key for key in keys if key in found and key not in in_memory]
+                    payloads = executor.submit(self._prefetch, hits) if executor is not None and hits else None
+                    current = (batch, keys, found, payloads)
+                if previous is not None:
+                    batch, keys, found, payloads = previous
+                    payloads = payloads.result() if payloads is not None else {}
+                    for item, key in zip(batch, keys):
+                        yield item, key, key in found, payloads.get(key)
+                if current is None:
+                    break
+                previous = current
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _prefetch(self, keys):
+        """Read entries until `PREFETCH_MAX_BYTES` are read, the other entries are left to be read on demand.
+
+        :param list[str] keys:
+        :return dict[str, bytes]: payloads of read entries
+        """
+        payloads = {}
+        size = 0
+        for key in keys:
+            if size >= self.PREFETCH_MAX_BYTES:
+                break
+            payload = self.storage.get_many([key]).get(key)
+            if payload is not None:
+                payloads[key] = payload
+                size += len(payload)
+        return payloads
+
+    def _process_item(self, cache_key, data, exists, payload=None):
+        """Load the data from cache or run the chain and store the result.
+
+        :param str cache_key: storage key of the entry
+        :param dict data:
+        :param bool exists: whether the entry is stored
+        :param bytes payload: content of the entry if it was already read
+        :return bool: True if the chain requested stop while computing the data
+        :raise StopIteration: if the chain requested stop when the cached data were computed
+        """
+        if exists:
+            if self.force:
+                self._hot_log.log(logging.INFO, "Item found in cache but force=True")
+            elif self._retrieve(cache_key, data, payload):
+                return False
+        if self.single_flight and self.save_cache and not self.force:
+            stop = self._process_single_flight(cache_key, data)
+            if stop is not None:
+                return stop
+        self._hot_log.log(logging.DEBUG, "Not found in cache, processing chain")
+        return self._compute(cache_key, data)
+
+    def _retrieve(self, cache_key, data, payload=None):
+        """Copy cached data into `data`.
+
+        :param str cache_key: storage key of the entry
+        :param dict data:
+        :param bytes payload: content of the entry if it was already read
+        :return bool: False if the entry is corrupted (and was deleted)
+        """
+        self._hot_log.log(logging.INFO, "Found in cache, skipping chain")
+        lazy = self.lazy and isinstance(data, LazyData)
+        # values of chunked entries are not read, only keys of data
+        cache = self._read_entry(cache_key, payload, keys=() if lazy else None)
+        if cache is None:
+            return False
+        retrieved_data = cache['data']
+        stop = cache["stopped"]
+        if stop:
+            raise StopIteration()
+        if self.invalidation == INVALIDATE_MTIME:
+            self._check_time_consistency(cache['chain_mtime'],
+                                         self.chain_info['chain_mtime'])
+        for key, value in retrieved_data.items():
+            data[key] = value
+        if lazy:
+            for key in cache.get("keys", ()):
+                if key not in retrieved_data:
+                    data.set_lazy(key, partial(self._load_value, cache_key, key))
+        self._record_access(cache_key)
+        return True
+
+    def _load_value(self, cache_key, key):
+        """Load one value of cached data, used by lazy data.
+
+        :param str cache_key: storage key of the entry
+        :param key: key of data
+        :raise LookupError: if the entry was removed or is corrupted
+        """
+        self.stats.count("lazy_loads")
+        try:
+            return self._load(cache_key, keys=(key,))["data"][key]
+        except (KeyError, EOFError, CorruptedEntryError):
+            raise LookupError("Value {!r} of cache item {} cannot be loaded, the item was removed or is corrupted"
+                              .format(key, cache_key))
+
+    def _read_entry(self, cache_key, payload=None, keys=None):
+        """Load the cache entry, corrupted entries are deleted.
+
+        :param str cache_key: storage key of the entry
+        :param bytes payload: content of the entry if it was already read
+        :param keys: keys of data needed by the caller, other keys may be left out; all keys if None
+        :return dict|None: caching structure, None if the entry is corrupted or was removed meanwhile
+        """
+        if self.memory is not None:
+            value = self.memory.get(cache_key)
+            if value is not None:
+                self.stats.count("hits")
+                self.stats.count("memory_hits")
+                return self._unpickle(cache_key, value) if self.memory_copy_on_read else value
+        if self.shared is not None:
+            cache = self.shared.get(cache_key)
+            if cache is not None:
+                self.stats.count("hits")
+                self.stats.count("shared_hits")
+                return cache
+        try:
+            cache = self._load(cache_key, payload, keys)
+            if self.shared is not None and keys is None:
+                self.shared.publish(cache_key, cache)
+            self.stats.count("hits")
+            return cache
+        except KeyError:
+            self._hot_log.log(logging.DEBUG, "Cache item {} was removed", cache_key)
+            return None
+        except (EOFError, CorruptedEntryError):
+            log.warning(
+                "Failed to load cache item {} (corrupted file will be deleted)".format(cache_key))
+            self.stats.count("corrupted")
+            self._remove(cache_key)
+            return None
+
+    def _remove(self, cache_key):
+        """Remove the entry from all tiers and the access index."""
+        if self.memory is not None:
+            self.memory.discard(cache_key)
+        if self.shared is not None:
+            self.shared.discard(cache_key)
+        self.storage.remove(cache_key)
+        if self.index is not None:
+            self.index.forget([cache_key])
+
+    def _record_access(self, cache_key):
+        """Record cache hit in the access index, hits are written in batches."""
+        if self.index is None:
+            return
+        now = time.time()
+        with self._accesses_lock:
+            _, hits = self._accesses.get(cache_key, (None, 0))
+            self._accesses[cache_key] = (now, hits + 1)
+            due = len(self._accesses) >= self.ACCESS_BATCH or now - self._accesses_flushed >= self.ACCESS_INTERVAL
+        if due:
+            self._flush_accesses()
+
+    def _flush_accesses(self):
+        """Write buffered hits to the access index."""
+        with self._accesses_lock:
+            accesses, self._accesses = self._accesses, {}
+            self._accesses_flushed = time.time()
+        if accesses:
+            for cache_key in self.index.record_accesses(accesses):
+                # entry written without the index
                 try:
-                    log.info("Found in cache, skipping chain")
-                    with open(file, 'rb') as f:
-                        # https://stackoverflow.com/questions/2766685/how-can-i-speed-up-unpickling-large-objects-if-i-have-plenty-of-ram/36699998#36699998
-                        # disable garbage collector for speedup unpickling
-                        gc.disable()
-                        cache = pickle.load(f)
-
-                        # enable garbage collector again
-                        gc.enable()
-
-                    retrieved_data = cache['data']
-                    stop = cache["stopped"]
-                    if stop:
-                        raise StopIteration()
-                    self._check_time_consistency(cache['chain_mtime'],
-                                                 self.chain_info['chain_mtime'])
-                    for key, value in retrieved_data.items():
-                        data[key] = value
-                    loaded = True
-                except EOFError:
-                    log.warning(
-                        "Failed to load cache item {} (corrupted file will be deleted)".format(file))
-                    os.unlink(file)
-        if not loaded:
-            log.debug("Not found in cache, processing chain")
+                    self.index.record_write(cache_key, self.storage.size(cache_key))
+                except OSError:
+                    # removed meanwhile
+                    pass
+
+    def _compute(self, cache_key, data):
+        """Run the chain and store the processed data.
+
+        :param str cache_key: storage key of the entry
+        :param dict data:
+        :return bool: True if the chain requested stop
+        """
+        self.stats.count("forced" if self.force else "misses")
+        with self.stats.timer("compute"):
             cache, stop = self._process(data, {})
-            cache = cache[self.chain_info['chain_hash']]
-            if self.save_cache:
-                with open(file, 'wb') as f:
-                    try:
-                        pickle.dump(cache, f, protocol=HIGHEST_PROTOCOL)
-                    except:
-                        pickle.dump(cache, f)
+        cache = cache[self.chain_info['chain_hash']]
+        if not self.save_cache:
+            return stop
+        # other processes wait for the entry only until the lock is released
+        if self.async_write and not self.single_flight:
+            self._submit_write(cache_key, cache)
+        else:
+            self._save(cache_key, cache)
+        return stop
+
+    def _save(self, cache_key, cache):
+        """Store caching structure and enforce the budget.
 
-            # Try to set some more flexible access rights
+        :param str cache_key: storage key of the entry
+        :param dict cache: caching structure
+        """
+        size = self._dump(cache_key, cache)
+        if self.index is not None:
+            self.index.record_write(cache_key, size, metadata=self._entry_metadata())
+            self.collect_garbage(keep=(cache_key,))
+
+    def _submit_write(self, cache_key, cache):
+        """Store caching structure in a background thread, block if too many writes are pending.
+
+        :param str cache_key: storage key of the entry
+        :param dict cache: caching structure
+        """
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(self.write_workers)
+            self._write_slots = threading.BoundedSemaphore(self.max_pending_writes)
+        self._write_slots.acquire()
+        # following modules add keys to data while it is being written
+        cache = dict(cache, data=copy(cache["data"]))
+        future = self._writer.submit(self._save_in_background, cache_key, cache)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    def _save_in_background(self, cache_key, cache):
+        try:
+            self._save(cache_key, cache)
+        except Exception:
+            log.exception("Failed to write cache item {}".format(cache_key))
+        finally:
+            self._write_slots.release()
+
+    def flush(self):
+        """Wait until all background writes are finished and write buffered hits to the access index."""
+        if self._pending:
+            wait(list(self._pending))
+        if self.index is not None:
+            self._flush_accesses()
+        self.storage.flush()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_writer=None, _write_slots=None, _pending=set(), _accesses={}, _accesses_lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._accesses_lock = threading.Lock()
+
+    def _process_single_flight(self, cache_key, data):
+        """Compute the entry unless another process is computing it, wait for its result otherwise.
+
+        :param str cache_key: storage key of the entry
+        :param dict data:
+        :return bool|None: None if the entry is still missing and has to be computed, otherwise True if the chain
+        requested stop while computing the data
+        """
+        with self.storage.lock(cache_key, self.lock_timeout) as acquired:
+            if not acquired:
+                log.warning("Timeout while waiting for cache item {} computed by another process".format(cache_key))
+                return None
+            if not self.storage.exists(cache_key):
+                self._hot_log.log(logging.DEBUG, "Not found in cache, processing chain")
+                return self._compute(cache_key, data)
+        # computed by another process while we were waiting
+        return False if self._retrieve(cache_key, data) else None
+
+    def collect_garbage(self, keep=()):
+        """Evict entries exceeding the budget of the cache.
+
+        :param tuple[str] keep: keys never evicted by the size and count budget
+        :return (int, int): number of evicted entries and reclaimed bytes
+        """
+        if self.index is None:
+            return 0, 0
+        if not self._index_synced:
+            self.index.sync(self.storage)
+            self._index_synced = True
+        # recency and frequency of entries must be up to date
+        self._flush_accesses()
+        return collect_garbage(self.storage, self.index, self.eviction, self.max_bytes, self.max_entries,
+                               self.max_age, keep=keep)
+
+    def _load(self, key, payload=None, keys=None):
+        """Unpickle cache entry, sidecar numpy arrays are memory-mapped.
+
+        :param str key: storage key of the entry
+        :param bytes payload: content of the entry if it was already read, otherwise it is read from the storage
+        :param keys: keys of data to be loaded, values of other keys of chunked entries are not unpickled; all keys
+        if None
+        :return: dict
+        """
+        start = time.time()
+        keep_pickled = self.memory is not None and keys is None
+        with (self.storage.open_read(key) if payload is None else io.BytesIO(payload)) as entry:
+            # records which are not needed are skipped, only read bytes are counted
+            f = CountingReader(entry)
+            # https://stackoverflow.com/questions/2766685/how-can-i-speed-up-unpickling-large-objects-if-i-have-plenty-of-ram/36699998#36699998
+            # disable garbage collector for speedup unpickling
+            gc.disable()
             try:
-                os.chmod(file, RWRWRW)
-            except OSError:
-                pass
+                with open_entry(f) as (metadata, stream):
+                    if keep_pickled:
+                        pickled = stream.read()
+                        cache = self._read_payload(key, io.BytesIO(pickled), pickled.startswith(RECORDS_MAGIC))
+                    else:
+                        cache = self._read_payload(key, stream, metadata.get("layout") == RECORDS, keys)
+            finally:
+                # enable garbage collector again
+                gc.enable()
+            size = f.length
+        self.stats.add_time("load", time.time() - start)
+        self.stats.count("bytes_read", size)
+        self.stats.observe_size("read", size)
+        if keep_pickled:
+            # checksum was verified
+            self.memory.put(key, pickled if self.memory_copy_on_read else cache, len(pickled))
+        return cache
+
+    def _read_payload(self, key, stream, records, keys=None):
+        """Unpickle payload of the entry.
+
+        :param str key: storage key of the entry
+        :param stream: payload
+        :param bool records: the payload is stored as records
+        :param keys: keys of data to be read from records, all keys if None
+        :return: dict
+        """
+        path = self.storage.path(key)
+        if records:
+            return read_records(stream, lambda f: ArrayUnpickler(f, path), keys)
+        return ArrayUnpickler(stream, path).load()
+
+    def _entry_metadata(self):
+        """Return description of entries written by this cache, stored in the entry headers and the access index.
+
+        :rtype: dict
+        """
+        metadata = dict((key, self.chain_info[key]) for key in ("chain_hash", "chain_repr", "chain_mtime"))
+        if self.chunked:
+            metadata["layout"] = RECORDS
+        return metadata
+
+    def _unpickle(self, key, pickled):
+        """Unpickle entry kept in the memory tier.
+
+        :param str key: storage key of the entry
+        :param bytes pickled:
+        :return: dict
+        """
+        gc.disable()
+        try:
+            return self._read_payload(key, io.BytesIO(pickled), pickled.startswith(RECORDS_MAGIC))
+        finally:
+            gc.enable()
+
+    def _dump(self, key, cache):
+        """Pickle cache structure into the storage, large numpy arrays go to sidecar files if mmap_arrays is set.
+
+        :param str key: storage key of the entry
+        :param dict cache: caching structure
+        :return int: size of the entry including its sidecar files in bytes
+        """
+        if self.force:
+            # replaced entry may have sidecar arrays
+            self.storage.remove(key)
+        if self.memory is not None:
+            self.memory.discard(key)
+        if self.shared is not None:
+            self.shared.discard(key)
+        # pickled entry is kept for the memory tier, cached objects may still be modified by following modules
+        keep_pickled = self.memory is not None and self.memory_copy_on_read
+        # the entry is written to a temporary file first, so readers never see a partially written entry
+        pickler = None
+        start = time.time()
+        try:
+            with self.storage.open_write(key) as f:
+                with entry_writer(f, self.compression, self.compression_level, self._entry_metadata()) as stream:
+                    target = io.BytesIO() if keep_pickled else stream
+                    if self.mmap_arrays:
+                        pickler_factory = partial(ArrayPickler, path=self.storage.path(key),
+                                                  min_bytes=self.mmap_min_bytes)
+                    else:
+                        pickler_factory = partial(pickle.Pickler, protocol=HIGHEST_PROTOCOL)
+                    if self.chunked:
+                        pickler = write_records(target, cache, pickler_factory, self.compression,
+                                                self.compression_level)
+                    else:
+                        pickler = pickler_factory(target)
+                        pickler.dump(cache)
+                    if keep_pickled:
+                        pickled = target.getvalue()
+                        stream.write(pickled)
+                size = f.tell()
+        except BaseException:
+            for sidecar in getattr(pickler, "sidecars", []):
+                os.unlink(sidecar)
+            raise
+        if self.storage.entry_files:
+            # sidecars of the replaced entry, e.g. written concurrently by another process
+            token = getattr(pickler, "token", None)
+            remove_sidecars(self.storage.path(key), token + "." if token is not None and pickler.sidecars else None)
+        self.stats.add_time("dump", time.time() - start)
+        self.stats.count("bytes_written", size)
+        self.stats.observe_size("written", size)
+        if keep_pickled:
+            self.memory.put(key, pickled, len(pickled))
+        return size + sum(os.path.getsize(sidecar) for sidecar in getattr(pickler, "sidecars", []))
 
     def close(self):
         """Close cache and chain."""
         super(PickleCache, self).close()
+        self.flush()
+        if self._writer is not None:
+            self._writer.shutdown()
+            self._writer = None
+        self.storage.close()
+        if self.index is not None:
+            self.index.close()
+        if self.shared is not None:
+            self.shared.close()
+        write_stats(self.name, self.stats)
@@ -0,0 +1,254 @@
+"""Console entry point `flexp-cache` for maintenance of PickleCache storages.
+
+Usage: flexp-cache ls cached_pkl
+       flexp-cache stats cached_pkl
+       flexp-cache gc cached_pkl --max-size 100G --max-age 30d
+       flexp-cache warm my_experiment:make_chain my_experiment:load_data --processes 8
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import re
+import time
+
+import click
+
+from flexp.flow.cache_index import CacheIndex, EVICTION_POLICIES, LRU, collect_garbage
+from flexp.flow.cache_stats import size_bucket
+from flexp.flow.storage import DirectoryStorage, SqliteStorage
+from flexp.flow.warmup import load_data, load_object, warm_cache
+from flexp.utils import get_logger
+
+
+log = get_logger(__name__)
+
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 24 * 3600, "w": 7 * 24 * 3600}
+
+
+def parse_size(size):
+    """Parse human readable size.
+
+    >>> parse_size("1.5K")
+    1536
+    """
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?$", size.strip(), re.IGNORECASE)
+    if match is None:
+        raise click.BadParameter("Invalid size {}, use e.g. 500M or 10G".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_duration(duration):
+    """Parse human readable duration into seconds.
+
+    >>> parse_duration("2h")
+    7200.0
+    """
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([smhdw]?)$", duration.strip())
+    if match is None:
+        raise click.BadParameter("Invalid duration {}, use e.g. 3600, 12h or 30d".format(duration))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_size(size):
+    """Format size in bytes into human readable form.
+
+    >>> format_size(1536)
+    '1.5K'
+    """
+    for unit in ("", "K", "M", "G"):
+        if abs(size) < 1024:
+            return "{:.1f}{}".format(size, unit) if unit else "{:d}B".format(int(size))
+        size /= 1024
+    return "{:.1f}T".format(size)
+
+
+def format_duration(seconds):
+    """Format duration in seconds into human readable form.
+
+    >>> format_duration(3725)
+    '1:02:05'
+    """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{:d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def format_age(timestamp, now=None):
+    """Format time elapsed since the timestamp.
+
+    >>> format_age(0, now=2 * 24 * 3600 + 5)
+    '2d'
+    """
+    age = (time.time() if now is None else now) - timestamp
+    for unit, seconds in (("w", 7 * 24 * 3600), ("d", 24 * 3600), ("h", 3600), ("m", 60)):
+        if age >= seconds:
+            return "{:d}{}".format(int(age // seconds), unit)
+    return "{:d}s".format(max(int(age), 0))
+
+
+def open_storage(path):
+    """Open storage of a cache directory or of a single file SQLite cache.
+
+    :param str path:
+    :rtype: flexp.flow.storage.CacheStorage
+    """
+    if os.path.isdir(path):
+        return DirectoryStorage(path)
+    if os.path.isfile(path):
+        return SqliteStorage(path)
+    raise click.BadParameter("{} is neither cache directory nor SQLite cache file".format(path))
+
+
+@click.group()
+def main():
+    """Maintenance of PickleCache storages."""
+
+
+def open_index(storage):
+    """Open access index of the storage synchronized with the stored entries and their headers.
+
+    :param flexp.flow.storage.CacheStorage storage:
+    :rtype: CacheIndex
+    """
+    index = CacheIndex(storage.index_path())
+    added, forgotten = index.sync(storage, metadata=True)
+    if added or forgotten:
+        click.echo("Index synchronized: {} entries added, {} forgotten".format(added, forgotten), err=True)
+    return index
+
+
+@main.command()
+@click.argument("path")
+@click.option("--chain", default=None, help="List entries of chains with this hash prefix.")
+@click.option("--width", default=80, type=int, help="Maximal width of chain representations, 0 for no limit.")
+def ls(path, chain, width):
+    """List entries of PATH grouped by the chain which computed them, largest groups first.
+
+    Only entry headers are read, new entries are added to the index of the cache so next listing is faster.
+    """
+    storage = open_storage(path)
+    index = open_index(storage)
+    if chain is None:
+        click.echo("{:<16} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+            "CHAIN", "ENTRIES", "SIZE", "NEWEST", "OLDEST", "ACCESSED", "REPR"))
+        for chain_hash, chain_repr, _, count, size, oldest, newest, accessed, _ in index.chains():
+            chain_repr = chain_repr if chain_repr is not None else "(no metadata)"
+            if width and len(chain_repr) > width:
+                chain_repr = chain_repr[:width - 3] + "..."
+            click.echo("{:<16} {:>8d} {:>8} {:>8} {:>8} {:>8}  {}".format(
+                (chain_hash or "-")[:16], count, format_size(size), format_age(newest), format_age(oldest),
+                format_age(accessed), chain_repr))
+    else:
+        click.echo("{:<40} {:>8} {:>8} {:>8} {:>6}".format("KEY", "SIZE", "CREATED", "ACCESSED", "HITS"))
+        for key, size, created, accessed, hits, _ in index.entries(chain):
+            click.echo("{:<40} {:>8} {:>8} {:>8} {:>6d}".format(
+                key, format_size(size), format_age(created), format_age(accessed), hits))
+    index.close()
+    storage.close()
+
+
+@main.command()
+@click.argument("path")
+def stats(path):
+    """Summarize entries of PATH - sizes, ages, chains and hits - without loading the entries."""
+    storage = open_storage(path)
+    index = open_index(storage)
+    chains = index.chains()
+    entries = index.entries()
+    count, size = index.totals()
+    click.echo("Entries: {}".format(count))
+    click.echo("Size: {}".format(format_size(size)))
+    click.echo("Chains: {} ({} entries without metadata)".format(
+        sum(1 for row in chains if row[0] is not None), sum(row[3] for row in chains if row[0] is None)))
+    if entries:
+        click.echo("Created: newest {} ago, oldest {} ago".format(
+            format_age(max(row[2] for row in entries)), format_age(min(row[2] for row in entries))))
+        click.echo("Accessed: last {} ago, least recently {} ago".format(
+            format_age(max(row[3] for row in entries)), format_age(min(row[3] for row in entries))))
+        click.echo("Hits: {}".format(sum(row[4] for row in entries)))
+        histogram = {}
+        for row in entries:
+            bucket = size_bucket(row[1])
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        click.echo("Sizes:")
+        for bucket in sorted(histogram):
+            click.echo("  <= {:>8} {:>8d}".format(format_size(bucket), histogram[bucket]))
+    index.close()
+    storage.close()
+
+
+@main.command()
+@click.argument("path")
+@click.option("--max-size", default=None, help="Maximal total size of the cache, e.g. 100G.")
+@click.option("--max-entries", default=None, type=int, help="Maximal number of entries.")
+@click.option("--max-age", default=None, help="Evict entries not accessed for longer than this, e.g. 30d.")
+@click.option("--policy", default=LRU, type=click.Choice(EVICTION_POLICIES), help="Eviction policy.")
+@click.option("--dry-run", is_flag=True, help="Only report what would be evicted.")
+@click.option("--tmp-age", default="1h", show_default=True,
+              help="Remove temporary files of interrupted writes older than this.")
+def gc(path, max_size, max_entries, max_age, policy, dry_run, tmp_age):
+    """Evict cache entries of PATH exceeding the budget and report reclaimed bytes."""
+    storage = open_storage(path)
+    if not dry_run:
+        count, reclaimed = storage.sweep_temporary(parse_duration(tmp_age))
+        if count:
+            click.echo("Removed {} temporary files ({})".format(count, format_size(reclaimed)))
+    index = CacheIndex(storage.index_path())
+    added, forgotten = index.sync(storage)
+    if added or forgotten:
+        click.echo("Index synchronized: {} entries added, {} forgotten".format(added, forgotten))
+    count, reclaimed = collect_garbage(
+        storage, index, policy,
+        max_bytes=parse_size(max_size) if max_size is not None else None,
+        max_entries=max_entries,
+        max_age=parse_duration(max_age) if max_age is not None else None,
+        dry_run=dry_run)
+    remaining, size = index.totals()
+    if dry_run:
+        remaining, size = remaining - count, size - reclaimed
+    click.echo("{} {} entries, reclaimed {}; {} entries ({}) remain".format(
+        "Would evict" if dry_run else "Evicted", count, format_size(reclaimed), remaining, format_size(size)))
+    index.close()
+    storage.close()
+
+
+def report_progress(progress):
+    """Print throughput and ETA of the warm-up.
+
+    :param flexp.flow.warmup.WarmupProgress progress:
+    """
+    eta = progress.eta
+    click.echo("{}/{} missing items processed ({} existing, {} stopped, {} failed), {:.1f} items/s, elapsed {}, ETA {}".format(
+        progress.done, progress.missing, progress.existing, progress.stopped, progress.failed, progress.rate,
+        format_duration(progress.seconds), format_duration(eta) if eta is not None else "?"))
+
+
+@main.command()
+@click.argument("chain_factory")
+@click.argument("data_source")
+@click.option("--processes", "-p", default=None, type=int,
+              help="Number of worker processes, number of CPUs by default, 0 runs in this process.")
+@click.option("--batch-size", default=1000, type=int, help="Number of items looked up in the cache at once.")
+@click.option("--chunk-size", default=16, type=int, help="Number of items sent to a worker at once.")
+@click.option("--report-interval", default="10s", help="Time between progress reports, e.g. 10s or 5m.")
+def warm(chain_factory, data_source, processes, batch_size, chunk_size, report_interval):
+    """Compute missing cache entries of a chain over a dataset.
+
+    CHAIN_FACTORY is module:function (or file.py:function) returning a chain with PickleCache stages, DATA_SOURCE is
+    a file with one JSON object per line or module:attribute with an iterable (or a function returning it).
+    """
+    progress = warm_cache(load_object(chain_factory), load_data(data_source), processes=processes,
+                          batch_size=batch_size, chunk_size=chunk_size, report=report_progress,
+                          report_interval=parse_duration(report_interval))
+    if progress.failed:
+        raise click.ClickException("{} items failed, see the log".format(progress.failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Access index of PickleCache entries.
+
+The index records size, creation time, last access time and number of hits of every entry. It is used to
+keep the cache within a size/age/entry-count budget by evicting least recently (LRU) or least frequently
+(LFU) used entries. It also records hash, representation and modification time of the chain which computed
+every entry, taken from entry headers, so that content of a cache can be listed without loading the entries.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+
+from flexp.flow.serialization import CorruptedEntryError, read_metadata
+from flexp.flow.storage import SqliteDatabase
+from flexp.utils import get_logger
+
+
+log = get_logger(__name__)
+
+
+LRU = "lru"
+LFU = "lfu"
+EVICTION_POLICIES = (LRU, LFU)
+
+
+class CacheIndex(SqliteDatabase):
+    """Access statistics of cache entries kept in an SQLite file."""
+
+    # rows replaced by INSERT OR REPLACE fire the delete trigger too
+    SCHEMA = ("PRAGMA recursive_triggers = ON",
+              "CREATE TABLE IF NOT EXISTS access ("
+              "key TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL, "
+              "hits INTEGER NOT NULL DEFAULT 0)",
+              "CREATE INDEX IF NOT EXISTS access_last_access ON access (last_access)",
+              # number and total size of entries maintained by triggers, so that checking the budget is cheap
+              "CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), count INTEGER NOT NULL, "
+              "size INTEGER NOT NULL)",
+              "INSERT OR IGNORE INTO totals (id, count, size) SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM access",
+              "CREATE TRIGGER IF NOT EXISTS access_insert AFTER INSERT ON access BEGIN "
+              "UPDATE totals SET count = count + 1, size = size + NEW.size WHERE id = 0; END",
+              "CREATE TRIGGER IF NOT EXISTS access_delete AFTER DELETE ON access BEGIN "
+              "UPDATE totals SET count = count - 1, size = size - OLD.size WHERE id = 0; END",
+              "CREATE TABLE IF NOT EXISTS chains (chain_hash TEXT PRIMARY KEY, chain_repr TEXT, chain_mtime REAL)",
+              # chain_hash is NULL for entries without metadata
+              "CREATE TABLE IF NOT EXISTS entry_chains (key TEXT PRIMARY KEY, chain_hash TEXT)",
+              "CREATE INDEX IF NOT EXISTS entry_chains_chain_hash ON entry_chains (chain_hash)")
+
+    def __repr__(self):
+        return "CacheIndex({!r})".format(self.file)
+
+    def record_write(self, key, size, now=None, metadata=None):
+        """Record newly written entry.
+
+        :param str key:
+        :param int size: size of the entry in bytes
+        :param float now: time of the write, current time by default
+        :param dict metadata: metadata of the entry with chain_hash, chain_repr and chain_mtime
+        """
+        now = time.time() if now is None else now
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO access (key, size, created, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                (key, size, now, now))
+            if metadata is not None:
+                self._record_chain(key, metadata)
+
+    def _record_chain(self, key, metadata):
+        chain_hash = metadata.get("chain_hash")
+        if chain_hash is not None:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO chains (chain_hash, chain_repr, chain_mtime) VALUES (?, ?, ?)",
+                (chain_hash, metadata.get("chain_repr"), metadata.get("chain_mtime")))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entry_chains (key, chain_hash) VALUES (?, ?)", (key, chain_hash))
+
+    def record_access(self, key):
+        """Record cache hit of the entry.
+
+        :param str key:
+        :return bool: False if the entry is not in the index
+        """
+        return not self.record_accesses({key: (time.time(), 1)})
+
+    def record_accesses(self, accesses):
+        """Record hits of several entries in one transaction.
+
+        :param dict[str, tuple[float, int]] accesses: time of the last hit and number of hits by keys
+        :return list[str]: keys of entries which are not in the index
+        """
+        missing = []
+        with self.connection:
+            for key, (last_access, hits) in accesses.items():
+                cursor = self.connection.execute(
+                    "UPDATE access SET last_access = ?, hits = hits + ? WHERE key = ?", (last_access, hits, key))
+                if cursor.rowcount == 0:
+                    missing.append(key)
+        return missing
+
+    def forget(self, keys):
+        """Remove entries from the index.
+
+        :param list[str] keys:
+        """
+        with self.connection:
+            self.connection.executemany("DELETE FROM access WHERE key = ?", [(key,) for key in keys])
+            self.connection.executemany("DELETE FROM entry_chains WHERE key = ?", [(key,) for key in keys])
+
+    def totals(self):
+        """Return number of entries and their total size in bytes.
+
+        :rtype: (int, int)
+        """
+        return tuple(self.connection.execute("SELECT count, size FROM totals WHERE id = 0").fetchone())
+
+    def sync(self, storage, metadata=False):
+        """Make the index consistent with the storage.
+
+        Entries written without the index are added with their modification time as the last access,
+        entries removed from the storage are forgotten.
+
+        :param flexp.flow.storage.CacheStorage storage:
+        :param bool metadata: read headers of entries whose chain is not recorded yet
+        :return (int, int): number of added and forgotten entries
+        """
+        indexed = set(row[0] for row in self.connection.execute("SELECT key FROM access"))
+        stored = set(storage.keys())
+        now = time.time()
+        with self.connection:
+            for key in stored - indexed:
+                mtime = storage.mtime(key)
+                mtime = now if mtime is None else mtime
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO access (key, size, created, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                    (key, storage.size(key), mtime, mtime))
+        self.forget(indexed - stored)
+        if metadata:
+            self._sync_chains(storage, stored)
+        return len(stored - indexed), len(indexed - stored)
+
+    def _sync_chains(self, storage, stored):
+        recorded = set(row[0] for row in self.connection.execute("SELECT key FROM entry_chains"))
+        with self.connection:
+            for key in stored - recorded:
+                try:
+                    with storage.open_read(key) as f:
+                        entry_metadata = read_metadata(f)
+                except (KeyError, IOError, OSError, CorruptedEntryError):
+                    log.debug("Metadata of cache entry {} cannot be read".format(key))
+                    entry_metadata = {}
+                self._record_chain(key, entry_metadata)
+
+    def chains(self):
+        """Return entries grouped by the chain which computed them, largest groups first.
+
+        :return list[tuple]: chain hash (None for entries without metadata), chain repr, chain mtime, number of
+        entries, total size, oldest and newest creation time, last access and number of hits of the group
+        """
+        return self.connection.execute(
+            "SELECT e.chain_hash, c.chain_repr, c.chain_mtime, COUNT(*), SUM(a.size), MIN(a.created), "
+            "MAX(a.created), MAX(a.last_access), SUM(a.hits) "
+            "FROM access a LEFT JOIN entry_chains e ON a.key = e.key LEFT JOIN chains c ON e.chain_hash = c.chain_hash "
+            "GROUP BY e.chain_hash ORDER BY SUM(a.size) DESC").fetchall()
+
+    def entries(self, chain_hash=None):
+        """Return entries, largest first.
+
+        :param str chain_hash: only entries of chains with this hash prefix
+        :return list[tuple]: key, size, creation time, last access, number of hits and chain hash of entries
+        """
+        query = ("SELECT a.key, a.size, a.created, a.last_access, a.hits, e.chain_hash "
+                 "FROM access a LEFT JOIN entry_chains e ON a.key = e.key")
+        parameters = ()
+        if chain_hash is not None:
+            query += " WHERE substr(e.chain_hash, 1, ?) = ?"
+            parameters = (len(chain_hash), chain_hash)
+        return self.connection.execute(query + " ORDER BY a.size DESC", parameters).fetchall()
+
+    def victims(self, policy=LRU, max_bytes=None, max_entries=None, max_age=None, now=None, keep=()):
+        """Select entries to be evicted to satisfy the budget.
+
+        :param str policy: "lru" or "lfu"
+        :param int max_bytes: maximal total size of entries
+        :param int max_entries: maximal number of entries
+        :param float max_age: entries not accessed for longer than `max_age` seconds are evicted
+        :param float now: current time
+        :param tuple[str] keep: keys never evicted by the size and count budget, e.g. the entry just written
+        :return list[(str, int)]: keys and sizes of evicted entries
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}, use one of {}".format(policy, EVICTION_POLICIES))
+        now = time.time() if now is None else now
+        count, total = self.totals()
+        victims = []
+        if max_age is not None:
+            for key, size in self.connection.execute(
+                    "SELECT key, size FROM access WHERE last_access < ?", (now - max_age,)).fetchall():
+                victims.append((key, size))
+                count -= 1
+                total -= size
+
+        def over_budget():
+            return ((max_entries is not None and count > max_entries) or
+                    (max_bytes is not None and total > max_bytes))
+
+        if over_budget():
+            aged = set(key for key, _ in victims)
+            order = "last_access" if policy == LRU else "hits, last_access"
+            for key, size in self.connection.execute("SELECT key, size FROM access ORDER BY " + order):
+                if not over_budget():
+                    break
+                if key in aged or key in keep:
+                    continue
+                victims.append((key, size))
+                count -= 1
+                total -= size
+        return victims
+
+
+def collect_garbage(storage, index, policy=LRU, max_bytes=None, max_entries=None, max_age=None, dry_run=False,
+                    keep=()):
+    """Evict entries from the storage to satisfy the budget.
+
+    :param flexp.flow.storage.CacheStorage storage:
+    :param CacheIndex index: access index of the storage
+    :param str policy: "lru" or "lfu"
+    :param int max_bytes: maximal total size of entries
+    :param int max_entries: maximal number of entries
+    :param float max_age: entries not accessed for longer than `max_age` seconds are evicted
+    :param bool dry_run: only report what would be evicted
+    :param tuple[str] keep: keys never evicted by the size and count budget
+    :return (int, int): number of evicted entries and reclaimed bytes
+    """
+    victims = index.victims(policy, max_bytes, max_entries, max_age, keep=keep)
+    if victims and not dry_run:
+        for key, _ in victims:
+            storage.remove(key)
+        index.forget([key for key, _ in victims])
+    reclaimed = sum(size for _, size in victims)
+    if victims:
+        log.debug("Evicted {} cache entries ({} bytes) from {!r}".format(len(victims), reclaimed, storage))
+    return len(victims), reclaimed
@@ -0,0 +1,180 @@
+"""Counters and timers of PickleCache and CachingChain.
+
+Statistics of every cache are written to `cache_stats.json` in the experiment directory when the cache is closed.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from collections import defaultdict
+from contextlib import contextmanager
+import io
+import json
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flexp import flexp
+from flexp.flow.storage import atomic_path, file_lock
+from flexp.utils import get_logger
+
+
+log = get_logger(__name__)
+
+
+STATS_FILE = "cache_stats.json"
+
+
+def size_bucket(size):
+    """Return upper bound of the histogram bucket of the size - the nearest power of two.
+
+    >>> size_bucket(1000), size_bucket(1024), size_bucket(1025), size_bucket(0)
+    (1024, 1024, 2048, 0)
+
+    :param int size: size in bytes
+    :rtype: int
+    """
+    return 1 << (size - 1).bit_length() if size > 0 else 0
+
+
+class CacheStats(object):
+    """Thread-safe counters, timers (in seconds) and histograms of sizes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.histograms = defaultdict(lambda: defaultdict(int))
+
+    def __getstate__(self):
+        # copies in worker processes count their own work
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def __getitem__(self, name):
+        """Return value of the counter or timer."""
+        if name in self.seconds:
+            return self.seconds[name]
+        return self.counters.get(name, 0)
+
+    def count(self, name, value=1):
+        """Increase the counter.
+
+        :param str name:
+        :param int value:
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        """Increase the timer.
+
+        :param str name:
+        :param float seconds:
+        """
+        with self._lock:
+            self.seconds[name] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Measure wall time of the `with` block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def observe_size(self, name, size):
+        """Add the size into the histogram.
+
+        :param str name: name of the histogram
+        :param int size: size in bytes
+        """
+        with self._lock:
+            self.histograms[name][size_bucket(size)] += 1
+
+    def update(self, other):
+        """Add counters, timers and histograms of other stats.
+
+        :param CacheStats other:
+        """
+        with self._lock:
+            for name, value in other.counters.items():
+                self.counters[name] += value
+            for name, value in other.seconds.items():
+                self.seconds[name] += value
+            for name, histogram in other.histograms.items():
+                for bucket, value in histogram.items():
+                    self.histograms[name][bucket] += value
+
+    def hit_rate(self):
+        """Return ratio of hits among lookups, None if there was no lookup.
+
+        :rtype: float|None
+        """
+        hits = self.counters.get("hits", 0)
+        lookups = hits + self.counters.get("misses", 0)
+        return hits / lookups if lookups else None
+
+    def to_dict(self):
+        """Return the statistics as a JSON-serializable dict.
+
+        Timers are stored with `_seconds` suffix, histograms map upper bound of bucket in bytes to the count.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(("{}_seconds".format(name), value) for name, value in self.seconds.items())
+            stats["histograms"] = dict((name, dict((str(bucket), histogram[bucket]) for bucket in sorted(histogram)))
+                                       for name, histogram in self.histograms.items())
+        stats["hit_rate"] = self.hit_rate()
+        return stats
+
+
+def write_stats(name, stats, file_name=STATS_FILE):
+    """Store the statistics under the name into the JSON file in the experiment directory.
+
+    Statistics of other caches in the file are kept, also when caches of several processes are closed at once.
+    Nothing is written if flexp experiment is not set up.
+
+    :param str name: name of the cache
+    :param CacheStats stats:
+    :param str file_name:
+    """
+    try:
+        path = flexp.get_file_path(file_name)
+    except KeyError:
+        log.debug("Experiment is not set up, statistics of {} are not written".format(name))
+        return
+    with _stats_lock(path):
+        try:
+            with io.open(path, "rt", encoding="utf8") as f:
+                all_stats = json.load(f)
+        except (IOError, OSError, ValueError):  # first cache of the experiment or disabled experiment
+            all_stats = {}
+        all_stats[name] = stats.to_dict()
+        with atomic_path(path) as tmp_path:
+            with io.open(tmp_path, "wt", encoding="utf8") as f:
+                f.write(json.dumps(all_stats, indent=2, sort_keys=True))
+
+
+@contextmanager
+def _stats_lock(path):
+    """Hold lock of the statistics file where file locks are supported.
+
+    :param str path: path to the statistics file
+    """
+    if fcntl is None:
+        yield
+        return
+    with file_lock(path + ".lock", remove=True):
+        yield
@@ -3,13 +3,16 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
+from functools import partial
+from itertools import islice
 import hashlib
-import os
-import time
+import logging
+import types
 
 from flexp.flow import Chain
-from flexp.flow.cache import PickleCache, ObjectDumper
-from flexp.utils import get_logger
+from flexp.flow.cache_stats import CacheStats, write_stats
+from flexp.flow.cache import FINGERPRINT_STREAM, FINGERPRINTS, SAVE_ALL, PickleCache, ObjectDumper
+from flexp.utils import get_logger, perf_counter
 
 
 log = get_logger(__name__)
@@ -23,10 +26,18 @@ class CachingChain(Chain, ObjectDumper):
 
     UpdateAttrName = 'UpdateDataId'
 
+    PickleCacheBlackList = ["stats", "_hot_log", "_stage_hashes", "batch_size"]
+
+    _hot_logger = log
+
     SEPARATOR = "|"
 
+    # number of distinct hash parts of original ids whose stage hashes are remembered
+    MAX_STAGE_HASHES = 1024
+
     def __init__(self, chain=None, check=False, name=None, ignore_first_module_requirements=True, update_data_id='id',
-                 max_recursion_level=10, force=False, save_cache=True, propagate_flags=False):
+                 max_recursion_level=10, force=False, save_cache=True, propagate_flags=False,
+                 fingerprint=FINGERPRINT_STREAM, log_every=None, log_interval=None):
         """Set up modules.
         :param list[object|function]|object|function chain: one module or
         list of modules
@@ -35,15 +46,24 @@ class CachingChain(Chain, ObjectDumper):
         requirements may be satisfied by input data therefore it is common to
         not check them
         :param str name:
+        :param str fingerprint: how modules with `UpdateDataId` are hashed - "stream" or "dump", see PickleCache
+        :param int log_every: per-item messages are summarized after this number of messages, see Chain
+        :param float log_interval: per-item messages are summarized after this number of seconds, see Chain
         """
+        if fingerprint not in FINGERPRINTS:
+            raise ValueError("Unknown fingerprint {}, use one of {}".format(fingerprint, FINGERPRINTS))
         self.id_hashes = []
+        # stage hashes by hash part of original ids, see _updated_ids
+        self._stage_hashes = {}
+        self.fingerprint = fingerprint
+        self.stats = CacheStats()
         self.update_data_id = update_data_id
         self.max_recursion_level = max_recursion_level
         self.force = force
         self.save_cache = save_cache
         self.propagate_flags = propagate_flags
 
-        super().__init__(chain, check, name, ignore_first_module_requirements)
+        super().__init__(chain, check, name, ignore_first_module_requirements, log_every, log_interval)
 
     def _add(self, module):
         """Add module to the chain
@@ -52,44 +72,113 @@ class CachingChain(Chain, ObjectDumper):
         :param object|function module:
         """
         super()._add(module)
+        self._stage_hashes = {}
         if isinstance(module, PickleCache):
             # no need to distinguish PickleCache(chain=[Module1, Module2]) and [Module1, Module2]
-            # PickleCache.chain_info['chain_hash'] created same way: hash_dump_string(object_dump_to_string([module]))
+            # PickleCache.chain_info['chain_hash'] created same way: _object_hash([module])
             # content of chain_hash (which modules are used) is controlled by PickleCache logic
             # assume that PickleCache contains only modules that have significant impact on data
             log.debug(module.chain_info['chain_hash'])
             self.id_hashes.append(module.chain_info['chain_hash'])
         else:
             if hasattr(module, self.UpdateAttrName):
-                self.id_hashes.append(PickleCache.hash_dump_string(self._object_dump_to_string([module],
-                                                                                               self.max_recursion_level)))
+                self.id_hashes.append(self._object_hash([module], self.max_recursion_level))
             else:
                 self.id_hashes.append("")
 
     def get_updated_data_ids(self, data):
         """
         Create list of data ids of length = len(self.modules) + 1 , i-th id is input for i-th module
-        :param data:
+        :param data: dict or object with the id as an attribute
         :return list[str]: list of data ids
         """
-        data_id = getattr(data, self.update_data_id)
-        updated_ids = [data_id]
-        for i, module in enumerate(self.modules):
-            if self.id_hashes[i]:
-
-                parts = data_id.split(self.SEPARATOR)
-                if len(parts) > 1:
-                    prefix = "".join(parts[:-1])
-                    old_hash = parts[-1]
-                else:
-                    prefix = data_id
-                    old_hash = ""
-                updated_hash = hashlib.sha256((old_hash + self.id_hashes[i]).encode()).hexdigest()
-                updated_ids.append(prefix + self.SEPARATOR + updated_hash)
+        return self._updated_ids(data[self.update_data_id] if isinstance(data, dict) else
+                                 getattr(data, self.update_data_id))
+
+    def _updated_ids(self, data_id):
+        """Return ids of data for every module, see `get_updated_data_ids`.
+
+        Hashes of stages depend only on the hash part of the original id (after the last separator), they are
+        computed once per distinct hash part.
+
+        :param str data_id: original id of data
+        :rtype: list[str]
+        """
+        parts = data_id.split(self.SEPARATOR)
+        if len(parts) > 1:
+            prefix = "".join(parts[:-1])
+            old_hash = parts[-1]
+        else:
+            prefix = data_id
+            old_hash = ""
+        stage_hashes = self._stage_hashes.get(old_hash)
+        if stage_hashes is None:
+            stage_hashes = []
+            last_hash = None
+            for id_hash in self.id_hashes:
+                if id_hash:
+                    last_hash = hashlib.sha256(((last_hash or old_hash) + id_hash).encode()).hexdigest()
+                stage_hashes.append(last_hash)
+            if len(self._stage_hashes) >= self.MAX_STAGE_HASHES:
+                self._stage_hashes.clear()
+            self._stage_hashes[old_hash] = stage_hashes
+        return [data_id] + [data_id if stage_hash is None else prefix + self.SEPARATOR + stage_hash
+                            for stage_hash in stage_hashes]
+
+    def _plan(self, updated_ids):
+        """Return the first module to run and known existence of entries of PickleCache modules.
+
+        Processing resumes from the deepest entry holding complete data (PickleCache with save_keys="all"), entries
+        of partial data deeper in the chain are loaded on the way instead of running their chains and entries before
+        the resume point are not read at all.
+
+        :param list[str] updated_ids: ids of data for every module
+        :return tuple[int, dict]: index of the first module to run and {module index -> whether its entry exists}
+        """
+        exists = {}
+        for i, module in list(enumerate(self.modules))[::-1]:
+            if isinstance(module, PickleCache):
+                exists[i] = module.check_cache_exists_from_id(updated_ids[i])
+                if exists[i] and module.save_keys == SAVE_ALL:
+                    self._hot_log.log(logging.DEBUG, "We skip first {} modules because cache of module {} exists",
+                                      i, i + 1)
+                    return i, exists
+        return 0, exists
+
+    def _plans(self, ids_batch, listings):
+        """Return plans (see `_plan`) of a batch of data, existence of entries is checked once per batch and module.
+
+        Only existing entries are known in the plans, missing ones may have been written after the listing.
+
+        :param list[list[str]] ids_batch: ids of data for every module, for every data of the batch
+        :param dict listings: keys of storages listed during the run by module index, filled on first use; None
+        looks up every batch by a query
+        :rtype: list[tuple[int, dict]]
+        """
+        plans = [(0, {}) for _ in ids_batch]
+        unresolved = set(range(len(ids_batch)))
+        for i, module in list(enumerate(self.modules))[::-1]:
+            if not unresolved:
+                break
+            if not isinstance(module, PickleCache):
+                continue
+            keys = dict((j, module.get_cache_key_from_id(ids_batch[j][i])) for j in unresolved)
+            if listings is not None and module.storage.bulk_listing:
+                if i not in listings:
+                    listings[i] = set(module.storage.keys())
+                found = listings[i].intersection(keys.values())
             else:
-                updated_ids.append(updated_ids[-1])
-            data_id = updated_ids[-1]
-        return updated_ids
+                found = module.storage.exists_many(keys.values())
+            if module.memory is not None:
+                found.update(key for key in keys.values() if key in module.memory)
+            for j, key in keys.items():
+                if key in found:
+                    exists = plans[j][1]
+                    exists[i] = True
+                    if module.save_keys == SAVE_ALL:
+                        plans[j] = (i, exists)
+                        unresolved.discard(j)
+        return plans
 
     def process(self, data):
         """Run all modules.
@@ -97,39 +186,122 @@ class CachingChain(Chain, ObjectDumper):
         :param dict data: the inplace processed data - one data per call
         :return: dict:
         """
-        start = 0
         updated_ids = self.get_updated_data_ids(data)
         if self.force:
-            log.debug("Force module processing, do not skip anything")
+            self._hot_log.log(logging.DEBUG, "Force module processing, do not skip anything")
+            start, exists = 0, {}
         else:
-            for i, module in list(enumerate(self.modules))[::-1]:
-                if isinstance(module, PickleCache):
-                    # key = hashlib.sha256(self.pickle(updated_ids[i])).hexdigest()
-                    file = module.get_cache_file_from_id(updated_ids[i])
-                    if os.path.exists(file):
-                        log.debug("We skip first {} modules because cache: {} exists (module is {} in a chain)".format(i + 1, file, i + 2))
-                        start = i
-                        break
+            start, exists = self._plan(updated_ids)
+        self._process_from(data, updated_ids, start, exists)
+
+    def process_batch(self, data_list):
+        """Process a list of data, resume points are found for the whole list at once.
+
+        Called for every micro-batch of a chain, so entries are looked up by one query per module instead of a
+        listing of the storages.
+
+        :param list data_list:
+        :return list: data for which no module requested stop
+        """
+        return list(self.process_many(data_list, batch_size=max(len(data_list), 1), listing=False))
+
+    def stream(self, data_iterable):
+        """Return generator of processed data, see `Chain.stream`.
+
+        Resume points are found by `process_many`, so one batch of data is kept in memory. Modules process one data
+        at a time, they cannot be transforms.
+
+        :param iterable data_iterable:
+        :return: generator of processed data
+        """
+        return self.process_many(data_iterable)
+
+    def process_many(self, data_iterable, batch_size=1000, listing=True):
+        """Process a stream of data, resume points are found for a whole batch at once.
+
+        Existence of entries of every PickleCache module is resolved by one listing of its directory storage per run
+        (or one query per batch for other storages) instead of a probe per data and module. Entries written after the
+        listing are not used as resume points, the data are processed from a shallower point (PickleCache modules
+        still read the entries).
+
+        :param iterable data_iterable:
+        :param int batch_size: number of data looked up at once
+        :param bool listing: list directory storages once, otherwise entries are looked up by one query per batch and
+        module; listing pays off only for runs touching a good part of the caches
+        :return: generator of processed data, data for which a module requested stop are left out
+        """
+        listings = {} if listing else None
+        iterator = iter(data_iterable)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                break
+            ids_batch = [self.get_updated_data_ids(data) for data in batch]
+            plans = [(0, {})] * len(batch) if self.force else self._plans(ids_batch, listings)
+            for data, updated_ids, (start, exists) in zip(batch, ids_batch, plans):
+                try:
+                    self._process_from(data, updated_ids, start, exists)
+                except StopIteration:
+                    continue
+                yield data
+
+    def _process_from(self, data, updated_ids, start, exists):
+        """Run modules from the resume point.
+
+        :param data:
+        :param list[str] updated_ids: ids of data for every module
+        :param int start: index of the first module to run
+        :param dict exists: {index of PickleCache module -> whether its entry exists}, entries of other modules are
+        looked up by the modules
+        """
+        self.stats.count("items")
+        if start > 0:
+            self.stats.count("resumed")
+            self.stats.count("skipped_modules", start)
         for i in range(start, len(self.modules)):
             try:
                 if hasattr(self.modules[i], "process"):
-                    log.debug("{}.process()".format(self.names[i]))
+                    self._hot_log.log(logging.DEBUG, "{}.process()", self.names[i])
                     process_func = self.modules[i].process
                 else:
-                    log.debug("{}()".format(self.names[i]))
+                    self._hot_log.log(logging.DEBUG, "{}()", self.names[i])
                     process_func = self.modules[i]
                 # propagate self.force to PickleCache modules in modules list
                 if self.propagate_flags and hasattr(self.modules[i], 'force'):
                     self.modules[i].force = self.force
                     self.modules[i].save_cache = self.save_cache
-                start = time.clock()
+                if i in exists:
+                    # the entry was already looked up by the plan
+                    process_func = partial(process_func, exists=exists[i])
+                start = perf_counter()
                 # update data ket from list before running module
-                setattr(data, self.update_data_id,  updated_ids[i])
-                process_func(data)
-                end = time.clock()
+                if isinstance(data, dict):
+                    data[self.update_data_id] = updated_ids[i]
+                else:
+                    setattr(data, self.update_data_id,  updated_ids[i])
+                result = process_func(data)
+                end = perf_counter()
                 self.times[i] += (end - start)
+                if isinstance(result, types.GeneratorType):
+                    raise TypeError("{} yields data, CachingChain cannot run transforms".format(self.names[i]))
             except StopIteration:
-                log.debug("{} requested stop. Processing stopped".format(
-                    self.names[i]))
+                self._hot_log.log(logging.DEBUG, "{} requested stop. Processing stopped", self.names[i])
                 raise
         self.iterations += 1
+
+    def total_stats(self):
+        """Return statistics of the chain summed with statistics of its PickleCache modules.
+
+        :rtype: CacheStats
+        """
+        stats = CacheStats()
+        stats.update(self.stats)
+        for module in self.modules:
+            if isinstance(module, PickleCache):
+                stats.update(module.stats)
+        return stats
+
+    def close(self):
+        """Call module finalizers and store statistics of caching."""
+        super().close()
+        write_stats(self.name, self.total_stats())
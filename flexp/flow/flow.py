@@ -3,11 +3,12 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
-import collections
-import time
+import collections.abc
+import inspect
+import logging
 import types
 
-from flexp.utils import get_logger
+from flexp.utils import LogSummary, get_logger, perf_counter
 
 
 log = get_logger(__name__)
@@ -16,8 +17,15 @@ log = get_logger(__name__)
 class Chain(object):
     """Chains of modules run by `process` function."""
 
+    # logging state and batching do not describe the chain
+    PickleCacheBlackList = ["_hot_log", "batch_size"]
+
+    # logger of per-item messages
+    _hot_logger = log
+
     def __init__(self, chain=None, check=False, name=None,
-                 ignore_first_module_requirements=True):
+                 ignore_first_module_requirements=True, log_every=None,
+                 log_interval=None, batch_size=None):
         """Set up modules.
         :param list[object|function]|object|function chain: one module or
         list of modules
@@ -26,6 +34,12 @@ class Chain(object):
         requirements may be satisfied by input data therefore it is common to
         not check them
         :param str name:
+        :param int log_every: per-item messages are not logged one by one but
+        summarized after this number of messages
+        :param float log_interval: per-item messages are summarized after this
+        number of seconds
+        :param int batch_size: size of micro-batches passed to modules with
+        `process_batch` method by `process_batch`, whole batch by default
         """
         self.names = []
         self.modules = []
@@ -37,6 +51,8 @@ class Chain(object):
         self._ignore_first_module_requirements = \
             ignore_first_module_requirements
         self._base_name = name if name else self.__class__.__name__
+        self._hot_log = LogSummary(self._hot_logger, log_every, log_interval)
+        self.batch_size = batch_size
         super(Chain, self).__init__()
         self._generate_name()
         self.add(chain)
@@ -67,7 +83,7 @@ class Chain(object):
         """
         if not module:
             return
-        if isinstance(module, collections.Iterable):
+        if isinstance(module, collections.abc.Iterable):
             for m in module:
                 self._add(m)
         else:
@@ -115,23 +131,166 @@ class Chain(object):
         for i in range(len(self.modules)):
             try:
                 if hasattr(self.modules[i], "process"):
-                    log.debug("{}.process()".format(self.names[i]))
+                    self._hot_log.log(logging.DEBUG,
+                                      "{}.process()", self.names[i])
                     process_func = self.modules[i].process
                 else:
-                    log.debug("{}()".format(self.names[i]))
+                    self._hot_log.log(logging.DEBUG,
+                                      "{}()", self.names[i])
                     process_func = self.modules[i]
-                start = time.clock()
-                process_func(data)
-                end = time.clock()
+                start = perf_counter()
+                result = process_func(data)
+                end = perf_counter()
                 self.times[i] += (end - start)
+                if isinstance(result, types.GeneratorType):
+                    raise TypeError("{} yields data, use stream()".format(
+                        self.names[i]))
             except StopIteration:
-                log.debug("{} requested stop. Processing stopped".format(
-                    self.names[i]))
+                self._hot_log.log(logging.DEBUG,
+                                  "{} requested stop. Processing stopped", self.names[i])
                 raise
         self.iterations += 1
 
+    def process_batch(self, data_list):
+        """Run all modules on a list of data.
+
+        Modules with `process_batch(data_list)` method get micro-batches of
+        `batch_size` data, it returns the data which continue to following
+        modules or None if all of them continue. Other modules process the
+        data one by one.
+
+        :param list data_list: the inplace processed data
+        :return list: data for which no module requested stop
+        """
+        data_list = list(data_list)
+        if type(self).process is not Chain.process:
+            # subclasses running modules in their own way process data one
+            # by one
+            kept = []
+            for data in data_list:
+                try:
+                    self.process(data)
+                except StopIteration:
+                    continue
+                kept.append(data)
+            return kept
+        for i in range(len(self.modules)):
+            if not data_list:
+                break
+            module = self.modules[i]
+            kept = []
+            start = perf_counter()
+            if hasattr(module, "process_batch"):
+                self._hot_log.log(logging.DEBUG, "{}.process_batch()", self.names[i])
+                size = self.batch_size or len(data_list)
+                for j in range(0, len(data_list), size):
+                    batch = data_list[j:j + size]
+                    result = module.process_batch(batch)
+                    kept.extend(batch if result is None else result)
+            else:
+                self._hot_log.log(logging.DEBUG, "{}()", self.names[i])
+                process_func = getattr(module, "process", module)
+                transform = inspect.isgeneratorfunction(process_func)
+                for data in data_list:
+                    if transform:
+                        kept.extend(process_func(data))
+                        continue
+                    try:
+                        process_func(data)
+                    except StopIteration:
+                        self._hot_log.log(
+                            logging.DEBUG,
+                            "{} requested stop. Processing stopped", self.names[i])
+                        continue
+                    kept.append(data)
+            end = perf_counter()
+            self.times[i] += (end - start)
+            data_list = kept
+        self.iterations += len(data_list)
+        return data_list
+
+    def stream(self, data_iterable):
+        """Return generator of data processed by all modules.
+
+        Data are pulled from the iterable one by one and flow through the
+        modules one at a time, so corpora larger than memory can be processed.
+        Modules whose `process` (or the function itself) is a generator
+        function are transforms - they yield 0..n data made from the data
+        (e.g. sentences of a document) instead of modifying it in place. Data
+        for which other modules request stop are left out, transforms filter
+        data by yielding nothing (they must return instead of raising
+        StopIteration). Modules with `stream` method (nested chains,
+        PickleCache) get the whole stream.
+
+        :param iterable data_iterable:
+        :return: generator of processed data
+        """
+        if type(self).process is not Chain.process:
+            # subclasses running modules in their own way process data one
+            # by one
+            return self._stream_each(data_iterable)
+        stream = iter(data_iterable)
+        for i in range(len(self.modules)):
+            stream = self._stream_module(i, stream)
+        return self._count(stream)
+
+    def _stream_each(self, data_iterable):
+        for data in data_iterable:
+            try:
+                self.process(data)
+            except StopIteration:
+                continue
+            yield data
+
+    def _count(self, stream):
+        for data in stream:
+            self.iterations += 1
+            yield data
+
+    def _stream_module(self, i, stream):
+        """Return generator of data processed by i-th module.
+
+        :param int i: index of the module
+        :param iterator stream: data processed by previous modules
+        """
+        module = self.modules[i]
+        if hasattr(module, "stream"):
+            return module.stream(stream)
+        process_func = getattr(module, "process", module)
+        if inspect.isgeneratorfunction(process_func):
+            return self._stream_transform(i, process_func, stream)
+        return self._stream_process(i, process_func, stream)
+
+    def _stream_process(self, i, process_func, stream):
+        for data in stream:
+            start = perf_counter()
+            try:
+                process_func(data)
+            except StopIteration:
+                self._hot_log.log(logging.DEBUG,
+                                  "{} requested stop. Data left out", self.names[i])
+                continue
+            finally:
+                self.times[i] += perf_counter() - start
+            yield data
+
+    def _stream_transform(self, i, process_func, stream):
+        for data in stream:
+            outputs = process_func(data)
+            while True:
+                # only time spent in the module is measured
+                start = perf_counter()
+                try:
+                    output = next(outputs)
+                except StopIteration:
+                    break
+                finally:
+                    self.times[i] += perf_counter() - start
+                yield output
+
     def close(self):
         """Call module finalizers."""
+        self._hot_log.flush()
         for i in range(len(self.modules)):
             if hasattr(self.modules[i], "close"):
                 self.modules[i].close()
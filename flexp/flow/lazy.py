@@ -0,0 +1,111 @@
+"""Data whose values are loaded on first access.
+
+PickleCache with `lazy=True` fills LazyData with placeholders on cache hit, a value is read from the cache entry only
+when a module accesses it.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+
+class LazyValue(object):
+    """Placeholder of a value which is not loaded yet."""
+
+    __slots__ = ("load",)
+
+    def __init__(self, load):
+        """
+        :param load: function without arguments returning the value
+        """
+        self.load = load
+
+    def __repr__(self):
+        return "<lazy>"
+
+
+class LazyData(dict):
+    """Dict whose values may be loaded on first access.
+
+    Every access to a value (indexing, `get`, `items`, `values`, pickling, comparison, ...) loads it, only checking
+    keys (`in`, iteration, `len`) does not.
+    """
+
+    def set_lazy(self, key, load):
+        """Set the value to be loaded on first access.
+
+        :param key:
+        :param load: function without arguments returning the value
+        """
+        dict.__setitem__(self, key, LazyValue(load))
+
+    def is_loaded(self, key):
+        """Check whether the value was already loaded.
+
+        :param key:
+        :rtype: bool
+        """
+        return not isinstance(dict.__getitem__(self, key), LazyValue)
+
+    def materialize(self):
+        """Load all values."""
+        for key in self:
+            self[key]
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyValue):
+            value = value.load()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __iter__(self):
+        # overridden so that dict(lazy_data) and {**lazy_data} read values by __getitem__ and not directly
+        return iter(dict.keys(self))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        return key, value.load() if isinstance(value, LazyValue) else value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def copy(self):
+        """Return shallow copy, values which are not loaded yet are loaded by the copy on its own."""
+        copied = LazyData()
+        dict.update(copied, dict.items(self))
+        return copied
+
+    def __eq__(self, other):
+        self.materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return LazyData, (dict(self.items()),)
+
+    def __repr__(self):
+        return "LazyData({})".format(dict.__repr__(self))
@@ -0,0 +1,109 @@
+"""In-process memory tier of PickleCache.
+
+Recently used entries are kept in memory, so a long-running process reading the same entries again and again
+(e.g. a grid search over the same folds) does not read and unpickle them from the storage every time.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from collections import OrderedDict
+import threading
+
+
+class MemoryCache(object):
+    """Byte-budgeted LRU mapping of cache keys to entries.
+
+    Sizes of entries are given by the caller, PickleCache uses length of the pickled entry. The cache is safe to use
+    from background writer threads. Entries are not passed to other processes, a pickled MemoryCache is empty.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: maximal total size of kept entries
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def __repr__(self):
+        return "MemoryCache(max_bytes={})".format(self.max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the entry and mark it as recently used.
+
+        :param str key:
+        :return: the entry, None if it is not kept
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        """Keep the entry, least recently used entries are evicted to stay within the budget.
+
+        Entries larger than the whole budget are not kept.
+
+        :param str key:
+        :param value: the entry
+        :param int size: size of the entry in bytes
+        """
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        """Forget the entry if it is kept.
+
+        :param str key:
+        """
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return counters of the cache.
+
+        :rtype: dict
+        """
+        return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -4,11 +4,15 @@ from __future__ import absolute_import
 from __future__ import division
 
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import copy
+import logging
+import os
+import sys
 
 from flexp.utils import parallelize, merge_dicts
 from flexp.flow import Chain
-from flexp.utils import get_logger
+from flexp.utils import get_logger, perf_counter
 
 
 log = get_logger(__name__)
@@ -154,3 +158,214 @@ class ParallelModuleChain(Chain):
                 merge_dicts(data[key], d[key],
                             conflict_operation=self.conflict_operation)
         log.debug("ParallelModuleChain: Ended")
+
+
+THREADS = "thread"
+PROCESSES = "process"
+EXECUTORS = (THREADS, PROCESSES)
+
+
+# modules of DagChain in a worker process, set by _init_dag_worker
+_dag_modules = None
+
+# ProcessPoolExecutor accepts initializer since Python 3.7, older versions send the module with every call
+_DAG_WORKER_INITIALIZER = sys.version_info >= (3, 7)
+
+
+def _init_dag_worker(modules):
+    global _dag_modules
+    _dag_modules = modules
+
+
+def _run_dag_module(i, inputs, module=None):
+    """Run i-th module of DagChain in a worker process.
+
+    :param int i: index of the module
+    :param dict inputs: values of required keys
+    :param module: the module if the worker was not initialized with modules of the chain
+    :return tuple[dict, float]: values of provided keys and execution time
+    """
+    if module is None:
+        module = _dag_modules[i]
+    start = perf_counter()
+    module.process(inputs) if hasattr(module, "process") else module(inputs)
+    end = perf_counter()
+    return dict((key, inputs[key]) for key in module.provides if key in inputs), end - start
+
+
+class DagChain(Chain):
+    """
+    Chain that runs modules as soon as the keys they require are provided, independent modules run concurrently.
+    Example:
+
+    from flow import DagChain
+    chain = DagChain(executor="process", max_workers=4, chain=[
+        LoadData(),            # provides trainset
+        TfIdfFeatures(),       # requires trainset, provides tfidf
+        EmbeddingFeatures(),   # requires trainset, provides embeddings
+        Fit(),                 # requires tfidf and embeddings
+    ])
+    chain.process(data)
+
+    A module runs after every earlier module providing a key it requires, reading a key it provides or providing
+    the same key, so the result is the same as of sequential Chain. Modules without `requires` and `provides`
+    attributes wait for all earlier modules and all later modules wait for them.
+
+    With "thread" executor modules process the same data, they should be I/O-bound or release GIL. With "process"
+    executor every module with declared keys gets only values of its required keys in a worker process and only its
+    provided keys are copied back, so modules and values must be picklable and changes of module attributes stay in
+    the worker. Modules without declared keys run in this process.
+    """
+
+    PickleCacheBlackList = Chain.PickleCacheBlackList + ["_executor", "_dependents", "_dependencies"]
+
+    def __init__(self, chain=None, executor=THREADS, max_workers=None, check=False, name=None,
+                 ignore_first_module_requirements=True, log_every=None, log_interval=None):
+        """
+        :param list[object|function]|object|function chain: one module or list of modules
+        :param str executor: "thread" or "process", where modules run
+        :param int max_workers: number of threads or processes, chosen by concurrent.futures by default
+        :param bool check: check if chain modules are compatible
+        :param str name:
+        :param bool ignore_first_module_requirements: First module requirements may be satisfied by input data
+        :param int log_every: per-item messages are summarized after this number of messages
+        :param float log_interval: per-item messages are summarized after this number of seconds
+        """
+        if executor not in EXECUTORS:
+            raise ValueError("Unknown executor {}, use one of {}".format(executor, EXECUTORS))
+        self.executor = executor
+        self.max_workers = max_workers
+        self._executor = None
+        # indexes of modules which must run before / after the module
+        self._dependencies = []
+        self._dependents = []
+        super(DagChain, self).__init__(chain, check=check, name=name,
+                                       ignore_first_module_requirements=ignore_first_module_requirements,
+                                       log_every=log_every, log_interval=log_interval)
+
+    @staticmethod
+    def _declared(module):
+        return getattr(module, "requires", None) is not None and getattr(module, "provides", None) is not None
+
+    def _add(self, module):
+        """Add module to the chain and to the dependency graph.
+
+        :param object|function module:
+        """
+        if self._executor is not None and self.executor == PROCESSES:
+            # worker processes hold the modules they were started with
+            self._executor.shutdown()
+            self._executor = None
+        super(DagChain, self)._add(module)
+        i = len(self.modules) - 1
+        if self._declared(module):
+            requires = set(module.requires)
+            provides = set(module.provides)
+            dependencies = set()
+            for j in range(i):
+                other = self.modules[j]
+                if not self._declared(other) or requires & set(other.provides) or \
+                        provides & (set(other.requires) | set(other.provides)):
+                    dependencies.add(j)
+        else:
+            dependencies = set(range(i))
+        self._dependencies.append(dependencies)
+        self._dependents.append(set())
+        for j in dependencies:
+            self._dependents[j].add(i)
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor == PROCESSES and _DAG_WORKER_INITIALIZER:
+                self._executor = ProcessPoolExecutor(self.max_workers, initializer=_init_dag_worker,
+                                                     initargs=(self.modules,))
+            elif self.executor == PROCESSES:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            else:
+                # Python 3.4 requires the number of threads, later versions use the same default
+                max_workers = self.max_workers if self.max_workers is not None else (os.cpu_count() or 1) * 5
+                self._executor = ThreadPoolExecutor(max_workers)
+        return self._executor
+
+    def _run(self, i, data):
+        """Run i-th module in the current thread.
+
+        :return float: execution time
+        """
+        module = self.modules[i]
+        start = perf_counter()
+        module.process(data) if hasattr(module, "process") else module(data)
+        end = perf_counter()
+        return end - start
+
+    def _submit(self, i, data):
+        """Start i-th module, return future of None (thread) or of provided values (process) and execution time."""
+        executor = self._get_executor()
+        if self.executor == PROCESSES:
+            module = self.modules[i]
+            inputs = dict((key, data[key]) for key in module.requires if key in data)
+            return executor.submit(_run_dag_module, i, inputs, None if _DAG_WORKER_INITIALIZER else module)
+        return executor.submit(lambda: (None, self._run(i, data)))
+
+    def process(self, data):
+        """Run all modules, each as soon as modules it depends on finished.
+
+        :param dict data: the inplace processed data - one data per call
+        """
+        waiting = [len(dependencies) for dependencies in self._dependencies]
+        ready = [i for i, count in enumerate(waiting) if count == 0]
+        running = {}
+        stopped = None
+        error = None
+        while ready or running:
+            while ready and stopped is None and error is None:
+                i = ready.pop(0)
+                self._hot_log.log(logging.DEBUG, "{} started", self.names[i])
+                # a module alone runs in this thread, modules without declared keys are never run with others
+                if (self.executor == PROCESSES and self._declared(self.modules[i])) or \
+                        (self.executor == THREADS and (running or ready)):
+                    running[self._submit(i, data)] = i
+                    continue
+                try:
+                    self.times[i] += self._run(i, data)
+                except StopIteration:
+                    stopped = i
+                    break
+                for j in sorted(self._dependents[i]):
+                    waiting[j] -= 1
+                    if waiting[j] == 0:
+                        ready.append(j)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    outputs, seconds = future.result()
+                except StopIteration:
+                    stopped = i if stopped is None else stopped
+                    continue
+                except Exception as e:
+                    # modules already running are finished first
+                    error = e if error is None else error
+                    continue
+                self.times[i] += seconds
+                if outputs is not None:
+                    data.update(outputs)
+                for j in sorted(self._dependents[i]):
+                    waiting[j] -= 1
+                    if waiting[j] == 0:
+                        ready.append(j)
+        if error is not None:
+            raise error
+        if stopped is not None:
+            self._hot_log.log(logging.DEBUG, "{} requested stop. Processing stopped", self.names[stopped])
+            raise StopIteration()
+        self.iterations += 1
+
+    def close(self):
+        """Stop workers and call module finalizers."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        super(DagChain, self).close()
@@ -0,0 +1,568 @@
+"""Binary format of PickleCache entries.
+
+Every entry starts with a short header recording the format version, the compression codec,
+length and CRC32 checksum of the stored payload and metadata of the entry (e.g. hash and representation
+of the chain which computed it) readable without the payload. Readers detect the codec automatically
+and reject torn or damaged entries. Entries without the header are plain pickles written by older versions
+of flexp and are read as such.
+
+The payload is either a single pickle or a sequence of records (see `write_records`) - every value of cached
+data pickled (and compressed) on its own and framed into chunks, so values can be written and read one by one.
+Every record has its own CRC32 checksum, a reader verifies only the records it reads and skips the others.
+
+Stdlib codecs gzip, bz2 and lzma are always available, lz4 and zstd require the `lz4` and `zstandard` packages.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from contextlib import contextmanager
+import bz2
+import gzip
+import json
+import lzma
+import struct
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b"FXPC"
+FORMAT_VERSION = 3
+# magic, format version, length of codec name, length of stored payload, CRC32 of stored payload
+HEADER = struct.Struct("<4sBBQI")
+# length of JSON metadata following the codec name
+METADATA_LENGTH = struct.Struct("<I")
+
+# layout of entries stored as records, recorded in the entry metadata
+RECORDS = "records"
+# start of payload stored as records
+RECORDS_MAGIC = b"FXRC"
+# length of a chunk of a record, zero length ends the record
+CHUNK = struct.Struct("<Q")
+# CRC32 of chunks of a record, follows the zero length ending the record
+RECORD_CRC = struct.Struct("<I")
+# writes are buffered into chunks of this size, larger writes (e.g. buffers of numpy arrays) are chunks on their own
+CHUNK_SIZE = 1024 ** 2
+
+
+class CorruptedEntryError(ValueError):
+    """Cache entry is torn, damaged or written in an unknown format."""
+    pass
+
+
+class ChecksumWriter(object):
+    """File-like wrapper computing length and CRC32 of written bytes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.length = 0
+        self.crc = 0
+
+    def write(self, b):
+        # pickle writes large buffers (e.g. of numpy arrays) as PickleBuffer objects without len()
+        self.length += memoryview(b).nbytes
+        self.crc = zlib.crc32(b, self.crc)
+        return self.f.write(b)
+
+    def flush(self):
+        self.f.flush()
+
+
+class ChecksumReader(object):
+    """File-like wrapper computing length and CRC32 of read bytes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.length = 0
+        self.crc = 0
+
+    def _update(self, b):
+        self.length += len(b)
+        self.crc = zlib.crc32(b, self.crc)
+        return b
+
+    def read(self, size=-1):
+        return self._update(self.f.read(size))
+
+    def readline(self, size=-1):
+        return self._update(self.f.readline(size))
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self._update(memoryview(b)[:n])
+        return n
+
+    def readable(self):
+        return True
+
+    def drain(self):
+        """Read the rest of the payload."""
+        while self.read(1024 ** 2):
+            pass
+
+
+class CountingReader(object):
+    """Seekable file-like wrapper counting read bytes, skipped bytes are not counted."""
+
+    def __init__(self, f):
+        self.f = f
+        self.length = 0
+
+    def read(self, size=-1):
+        b = self.f.read(size)
+        self.length += len(b)
+        return b
+
+    def readline(self, size=-1):
+        b = self.f.readline(size)
+        self.length += len(b)
+        return b
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.length += n
+        return n
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+
+class Codec(object):
+    """Streaming compression codec."""
+
+    def __init__(self, name, writer=None, reader=None, default_level=None, requires=None):
+        """
+        :param str name: name of the codec stored in the entry header
+        :param writer: {(file, level) -> file} wraps file object into a compressing one
+        :param reader: {(file) -> file} wraps file object into a decompressing one
+        :param int default_level: compression level used if none is given
+        :param str requires: package needed by the codec, None if the codec is always available
+        """
+        self.name = name
+        self._writer = writer
+        self._reader = reader
+        self.default_level = default_level
+        self.requires = requires
+
+    @property
+    def available(self):
+        return self._writer is not None
+
+    def writer(self, f, level=None):
+        """Wrap file object opened for writing, closing the wrapper does not close `f`."""
+        if self._writer is None:
+            return f
+        return self._writer(f, self.default_level if level is None else level)
+
+    def reader(self, f):
+        """Wrap file object opened for reading, closing the wrapper does not close `f`."""
+        if self._reader is None:
+            return f
+        return self._reader(f)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """Make the codec available by its name.
+
+    :param Codec codec:
+    """
+    CODECS[codec.name] = codec
+
+
+NONE = Codec("none")
+register_codec(NONE)
+register_codec(Codec("gzip", lambda f, level: gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level),
+                     lambda f: gzip.GzipFile(fileobj=f, mode="rb"), default_level=6))
+register_codec(Codec("bz2", lambda f, level: bz2.BZ2File(f, "wb", compresslevel=level),
+                     lambda f: bz2.BZ2File(f, "rb"), default_level=9))
+register_codec(Codec("lzma", lambda f, level: lzma.LZMAFile(f, "wb", preset=level),
+                     lambda f: lzma.LZMAFile(f, "rb"), default_level=6))
+if lz4 is not None:
+    register_codec(Codec("lz4", lambda f, level: lz4.frame.LZ4FrameFile(f, "wb", compression_level=level),
+                         lambda f: lz4.frame.LZ4FrameFile(f, "rb"), default_level=0, requires="lz4"))
+else:
+    register_codec(Codec("lz4", requires="lz4"))
+if zstandard is not None:
+    register_codec(Codec("zstd", lambda f, level: zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False),
+                         lambda f: zstandard.ZstdDecompressor().stream_reader(f, closefd=False), default_level=3,
+                         requires="zstandard"))
+else:
+    register_codec(Codec("zstd", requires="zstandard"))
+
+
+def get_codec(name):
+    """Return codec by its name, None stands for no compression.
+
+    :param str|None name:
+    :rtype: Codec
+    """
+    if name is None:
+        return NONE
+    if name not in CODECS:
+        raise ValueError("Unknown compression {}, use one of {}".format(name, sorted(CODECS)))
+    codec = CODECS[name]
+    if codec is not NONE and not codec.available:
+        raise ImportError("Compression {} requires package {}".format(name, codec.requires))
+    return codec
+
+
+@contextmanager
+def entry_writer(f, compression=None, level=None, metadata=None):
+    """Write entry header and yield stream the payload is written into.
+
+    :param f: binary file object opened for writing
+    :param str|None compression: name of the codec
+    :param int level: compression level, codec default if None
+    :param dict metadata: JSON-serializable description of the entry stored in the header, payload of layout
+    `RECORDS` is not compressed by the yielded stream, `write_records` compresses the records one by one
+    """
+    codec = get_codec(compression)
+    name = codec.name.encode("ascii")
+    encoded = json.dumps(metadata or {}, sort_keys=True).encode("utf8")
+    start = f.tell()
+    # length and checksum are filled in when the payload is written
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(name), 0, 0) + name + METADATA_LENGTH.pack(len(encoded)) + encoded)
+    checksum = ChecksumWriter(f)
+    stream = checksum if (metadata or {}).get("layout") == RECORDS else codec.writer(checksum, level)
+    yield stream
+    if stream is not checksum:
+        stream.close()
+    end = f.tell()
+    f.seek(start)
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(name), checksum.length, checksum.crc))
+    f.seek(end)
+
+
+def _read_header(f):
+    """Read entry header, the file is left at the start of the payload.
+
+    :param f: binary file object opened for reading
+    :return tuple|None: codec name, length and CRC32 of the payload and metadata, None for plain pickle
+    :raise CorruptedEntryError: if the header is truncated or has unknown format version
+    """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        return None
+    header = magic + f.read(HEADER.size - len(MAGIC))
+    if len(header) != HEADER.size:
+        raise CorruptedEntryError("Truncated header of cache entry")
+    _, version, name_length, length, crc = HEADER.unpack(header)
+    if version != FORMAT_VERSION:
+        raise CorruptedEntryError("Unknown format version {} of cache entry".format(version))
+    name = f.read(name_length).decode("ascii")
+    encoded = f.read(METADATA_LENGTH.size)
+    if len(encoded) != METADATA_LENGTH.size:
+        raise CorruptedEntryError("Truncated header of cache entry")
+    encoded = f.read(METADATA_LENGTH.unpack(encoded)[0])
+    try:
+        metadata = json.loads(encoded.decode("utf8"))
+    except ValueError:
+        raise CorruptedEntryError("Damaged metadata of cache entry")
+    return name, length, crc, metadata
+
+
+def read_metadata(f):
+    """Read metadata of the entry without reading its payload.
+
+    :param f: binary file object opened for reading
+    :return dict: metadata given to `entry_writer`, empty for entries of older formats
+    :raise CorruptedEntryError: if the header is damaged
+    """
+    header = _read_header(f)
+    return header[3] if header is not None else {}
+
+
+@contextmanager
+def entry_reader(f):
+    """Read entry header and yield decompressed payload stream.
+
+    Checksum is validated when the consumer is done with the stream.
+
+    :param f: seekable binary file object opened for reading
+    :raise CorruptedEntryError: if the entry is torn, damaged or has unknown format version
+    """
+    with open_entry(f) as (_, stream):
+        yield stream
+
+
+@contextmanager
+def open_entry(f):
+    """Read entry header and yield its metadata and decompressed payload stream, see `entry_reader`.
+
+    Payload of layout `RECORDS` is yielded as stored, its records are decompressed and checked by `read_records`.
+
+    :param f: seekable binary file object opened for reading
+    :return: context manager yielding (dict metadata, stream)
+    """
+    header = _read_header(f)
+    if header is None:
+        # plain pickle written by older flexp
+        f.seek(0)
+        yield {}, f
+        return
+    name, length, crc, metadata = header
+    # cheap check of torn entries before anything is decoded
+    start = f.tell()
+    if f.seek(0, 2) - start != length:
+        raise CorruptedEntryError("Cache entry has {} bytes instead of {}".format(f.tell() - start, length))
+    f.seek(start)
+    if metadata.get("layout") == RECORDS:
+        yield metadata, f
+        return
+    checksum = ChecksumReader(f)
+    stream = get_codec(name).reader(checksum)
+    try:
+        yield metadata, stream
+    except Exception:
+        # decoding errors caused by damaged payload are reported as corruption
+        checksum.drain()
+        if checksum.crc != crc:
+            raise CorruptedEntryError("Checksum of cache entry does not match")
+        raise
+    finally:
+        if stream is not checksum:
+            stream.close()
+    checksum.drain()
+    if checksum.crc != crc:
+        raise CorruptedEntryError("Checksum of cache entry does not match")
+
+
+class ChunkWriter(object):
+    """File-like object framing written bytes into chunks of the current record."""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._crc = 0
+
+    def write(self, b):
+        size = memoryview(b).nbytes
+        if len(self._buffer) + size > self.chunk_size:
+            self._flush_chunk()
+        if size <= self.chunk_size:
+            self._buffer += b
+        else:
+            # written as is, without copying
+            self.f.write(CHUNK.pack(size))
+            self.f.write(b)
+            self._crc = zlib.crc32(b, self._crc)
+        return size
+
+    def flush(self):
+        # called by compressing streams, chunks are written when they are full or the record ends
+        pass
+
+    def _flush_chunk(self):
+        if self._buffer:
+            self.f.write(CHUNK.pack(len(self._buffer)))
+            self.f.write(self._buffer)
+            self._crc = zlib.crc32(self._buffer, self._crc)
+            self._buffer = bytearray()
+
+    def end_record(self):
+        """Finish the current record, following writes belong to the next record."""
+        self._flush_chunk()
+        self.f.write(CHUNK.pack(0) + RECORD_CRC.pack(self._crc))
+        self._crc = 0
+
+
+class ChunkReader(object):
+    """File-like object reading bytes of the current record.
+
+    Checksum of a record is verified when the record was read and is finished by `next_record`, chunks of records
+    which were not read at all are skipped by seeking.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        # unread bytes of the current chunk, None at the end of the record
+        self._remaining = 0
+        self._crc = 0
+        self._stored_crc = None
+        self._read = False
+
+    def _next_chunk(self):
+        header = self.f.read(CHUNK.size)
+        if len(header) != CHUNK.size:
+            raise CorruptedEntryError("Truncated record of cache entry")
+        self._remaining = CHUNK.unpack(header)[0] or None
+        if self._remaining is None:
+            crc = self.f.read(RECORD_CRC.size)
+            if len(crc) != RECORD_CRC.size:
+                raise CorruptedEntryError("Truncated record of cache entry")
+            self._stored_crc = RECORD_CRC.unpack(crc)[0]
+
+    def _read_chunk(self, n):
+        part = self.f.read(n)
+        if len(part) != n:
+            raise CorruptedEntryError("Truncated record of cache entry")
+        self._crc = zlib.crc32(part, self._crc)
+        self._remaining -= n
+        return part
+
+    def read(self, size=-1):
+        self._read = True
+        parts = []
+        while size != 0:
+            if self._remaining == 0:
+                self._next_chunk()
+            if self._remaining is None:
+                break
+            n = self._remaining if size < 0 else min(size, self._remaining)
+            parts.append(self._read_chunk(n))
+            size -= n if size > 0 else 0
+        return b"".join(parts)
+
+    def readline(self, size=-1):
+        line = []
+        while size < 0 or len(line) < size:
+            c = self.read(1)
+            if not c:
+                break
+            line.append(c)
+            if c == b"\n":
+                break
+        return b"".join(line)
+
+    def readable(self):
+        return True
+
+    def next_record(self):
+        """Finish the current record and start reading the next one.
+
+        Rest of a record which was read is read to verify its checksum, a record which was not read is skipped.
+
+        :raise CorruptedEntryError: if the record is truncated or its checksum does not match
+        """
+        while self._remaining is not None:
+            if self._read:
+                while self._remaining:
+                    self._read_chunk(min(self._remaining, CHUNK_SIZE))
+            elif self._remaining:
+                self.f.seek(self._remaining, 1)
+            self._next_chunk()
+        if self._read and self._crc != self._stored_crc:
+            raise CorruptedEntryError("Checksum of cache entry record does not match")
+        self._remaining = 0
+        self._crc = 0
+        self._read = False
+
+
+class _RecordTarget(object):
+    """File-like object the pickler of all records writes into, forwards to the stream of the current record."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, b):
+        return self.stream.write(b)
+
+
+def write_records(f, cache, pickler_factory, compression=None, level=None):
+    """Write caching structure as records - the structure without data and then every value of data.
+
+    Values are pickled and compressed one by one, memory needed for writing is given by the largest value. The
+    first record (the structure) is not compressed and names the codec of the others.
+
+    :param f: binary file object
+    :param dict cache: caching structure with "data"
+    :param pickler_factory: {file -> pickle.Pickler}
+    :param str|None compression: name of the codec
+    :param int level: compression level, codec default if None
+    :return pickle.Pickler: the used pickler
+    """
+    codec = get_codec(compression)
+    items = list(cache["data"].items())
+    envelope = dict((key, value) for key, value in cache.items() if key != "data")
+    envelope["keys"] = [key for key, _ in items]
+    envelope["codec"] = codec.name
+    f.write(RECORDS_MAGIC)
+    writer = ChunkWriter(f)
+    target = _RecordTarget(writer)
+    pickler = pickler_factory(target)
+    pickler.dump(envelope)
+    # records are independent, a record must not refer to objects of the previous ones
+    pickler.clear_memo()
+    writer.end_record()
+    for _, value in items:
+        target.stream = codec.writer(writer, level)
+        pickler.dump(value)
+        pickler.clear_memo()
+        if target.stream is not writer:
+            target.stream.close()
+        writer.end_record()
+    return pickler
+
+
+def _load_record(reader, stream, unpickler_factory):
+    """Unpickle the current record and finish it.
+
+    :param ChunkReader reader:
+    :param stream: decompressed record
+    :param unpickler_factory: {file -> pickle.Unpickler}
+    """
+    try:
+        value = unpickler_factory(stream).load()
+    except CorruptedEntryError:
+        raise
+    except Exception:
+        # decoding errors caused by damaged record are reported as corruption
+        reader.next_record()
+        raise
+    reader.next_record()
+    return value
+
+
+def read_records(f, unpickler_factory, keys=None):
+    """Read caching structure written by `write_records`.
+
+    Records of values which are not read are skipped without reading, so `f` must be seekable.
+
+    :param f: binary file object
+    :param unpickler_factory: {file -> pickle.Unpickler}
+    :param keys: keys of data to be read, values of other keys are skipped without unpickling; all keys if None
+    :return dict: caching structure, its data is a dict, "keys" lists all keys of the stored data
+    :raise CorruptedEntryError: if a read record is truncated or damaged
+    """
+    if f.read(len(RECORDS_MAGIC)) != RECORDS_MAGIC:
+        raise CorruptedEntryError("Cache entry does not consist of records")
+    reader = ChunkReader(f)
+    cache = _load_record(reader, reader, unpickler_factory)
+    codec = get_codec(cache.pop("codec"))
+    data = {}
+    for key in cache["keys"]:
+        if keys is not None and key not in keys:
+            reader.next_record()
+            continue
+        stream = codec.reader(reader)
+        try:
+            data[key] = _load_record(reader, stream, unpickler_factory)
+        finally:
+            if stream is not reader:
+                stream.close()
+    cache["data"] = data
+    return cache
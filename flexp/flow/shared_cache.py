@@ -0,0 +1,215 @@
+"""Shared-memory tier of PickleCache for parallel workers.
+
+The first worker which loads an entry from the storage publishes it in a named shared memory segment, other
+workers attach to the segment instead of reading and unpickling the entry on their own. Entries are pickled with
+protocol 5 so that numpy arrays (including pandas blocks) are stored out-of-band and workers use them zero-copy
+as read-only arrays, other objects are unpickled by every worker.
+
+Segments are unlinked when the PickleCache which created the tier is closed, or by the multiprocessing resource
+tracker when the program ends.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import glob
+import hashlib
+import os
+import pickle
+import struct
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
+from flexp.utils import get_logger, id_generator
+
+
+log = get_logger(__name__)
+
+
+# POSIX shared memory is visible as files here on Linux, used to find segments of a namespace and their free space
+SHM_DIRECTORY = "/dev/shm"
+
+MAGIC = b"FXSM"
+# magic, ready flag, length of pickle, number of out-of-band buffers
+HEADER = struct.Struct("<4sB3xQQ")
+READY_OFFSET = 4
+LENGTH = struct.Struct("<Q")
+# buffers start at aligned offsets so that numpy arrays are aligned
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+if shared_memory is not None:
+    class AttachedSegment(shared_memory.SharedMemory):
+        """Segment attached for reading which may outlive its arrays or be dropped before them."""
+
+        def __init__(self, name):
+            super(AttachedSegment, self).__init__(name)
+            # the mapping stays valid without the descriptor, thousands of attached entries would exhaust them
+            if getattr(self, "_fd", -1) >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+        def __del__(self):
+            try:
+                self.close()
+            except BufferError:
+                # arrays of the segment are still used, the memory is unmapped when they are released
+                pass
+
+
+class SharedMemoryCache(object):
+    """Entries of PickleCache in shared memory segments named by a namespace and the cache key.
+
+    A pickled SharedMemoryCache keeps its namespace, so copies in worker processes share the segments.
+    """
+
+    def __init__(self, namespace=None):
+        """
+        :param str namespace: prefix of segment names, random by default
+        """
+        if shared_memory is None:
+            raise ImportError("Shared memory tier requires Python 3.8+")
+        self.namespace = "fx" + (namespace or id_generator(10)).lower()
+        self.owner = os.getpid()
+        # workers must share the tracker of the owner, a tracker started by a worker unlinks segments created by
+        # the worker when it ends
+        resource_tracker.ensure_running()
+        # segments attached by this process by their names, they must stay mapped while their arrays are used
+        self._attached = {}
+        self._discarded = []
+        self.hits = 0
+        self.misses = 0
+        self.published = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_attached={}, _discarded=[], hits=0, misses=0, published=0)
+        return state
+
+    def __repr__(self):
+        return "SharedMemoryCache({!r})".format(self.namespace)
+
+    def segment_name(self, key):
+        """Return name of the segment of the entry, short enough for all platforms.
+
+        :param str key: cache key
+        :rtype: str
+        """
+        return "{}_{}".format(self.namespace, hashlib.sha1(key.encode("ascii")).hexdigest()[:16])
+
+    def get(self, key):
+        """Return the entry published by any process.
+
+        :param str key: cache key
+        :return: unpickled entry with read-only arrays, None if the entry is not published
+        """
+        name = self.segment_name(key)
+        segment = self._attached.get(name)
+        if segment is None:
+            try:
+                segment = AttachedSegment(name)
+            except (OSError, ValueError):  # missing or just being created
+                self.misses += 1
+                return None
+            if segment.size < HEADER.size or segment.buf[READY_OFFSET] != 1:
+                segment.close()
+                self.misses += 1
+                return None
+            self._attached[name] = segment
+        buf = segment.buf
+        _, _, length, count = HEADER.unpack_from(buf)
+        offset = HEADER.size
+        lengths = [LENGTH.unpack_from(buf, offset + i * LENGTH.size)[0] for i in range(count)]
+        offset = _align(offset + count * LENGTH.size)
+        pickled = buf[offset:offset + length]
+        offset = _align(offset + length)
+        buffers = []
+        for buffer_length in lengths:
+            buffers.append(buf[offset:offset + buffer_length].toreadonly())
+            offset = _align(offset + buffer_length)
+        self.hits += 1
+        return pickle.loads(pickled, buffers=buffers)
+
+    def publish(self, key, entry):
+        """Publish the entry unless another process has already done it.
+
+        :param str key: cache key
+        :param entry: picklable object
+        :return bool: True if the entry was published by this call
+        """
+        buffers = []
+        pickled = pickle.dumps(entry, protocol=5, buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        size = _align(HEADER.size + len(buffers) * LENGTH.size) + _align(len(pickled))
+        size += sum(_align(buffer.nbytes) for buffer in buffers)
+        if os.path.isdir(SHM_DIRECTORY):
+            # writing beyond the size of the shared memory filesystem kills the process by SIGBUS
+            stat = os.statvfs(SHM_DIRECTORY)
+            if size > stat.f_bavail * stat.f_frsize:
+                log.debug("Not enough shared memory to publish cache item {}".format(key))
+                return False
+        try:
+            segment = shared_memory.SharedMemory(self.segment_name(key), create=True, size=size)
+        except FileExistsError:
+            return False
+        buf = segment.buf
+        HEADER.pack_into(buf, 0, MAGIC, 0, len(pickled), len(buffers))
+        offset = HEADER.size
+        for buffer in buffers:
+            LENGTH.pack_into(buf, offset, buffer.nbytes)
+            offset += LENGTH.size
+        offset = _align(offset)
+        buf[offset:offset + len(pickled)] = pickled
+        offset = _align(offset + len(pickled))
+        for buffer in buffers:
+            buf[offset:offset + buffer.nbytes] = buffer
+            offset = _align(offset + buffer.nbytes)
+        # readers use the segment only when it is complete
+        buf[READY_OFFSET] = 1
+        del buf
+        segment.close()
+        self.published += 1
+        return True
+
+    def discard(self, key):
+        """Unlink the segment of the entry, processes which have already attached it keep using it.
+
+        :param str key: cache key
+        """
+        attached = self._attached.pop(self.segment_name(key), None)
+        if attached is not None:
+            self._discarded.append(attached)
+        try:
+            segment = shared_memory.SharedMemory(self.segment_name(key))
+        except (OSError, ValueError):
+            return
+        segment.close()
+        segment.unlink()
+
+    def stats(self):
+        """Return counters of this process.
+
+        :rtype: dict
+        """
+        return {"hits": self.hits, "misses": self.misses, "published": self.published}
+
+    def close(self):
+        """Unlink all segments of the namespace, only in the process which created the tier."""
+        if os.getpid() != self.owner or not os.path.isdir(SHM_DIRECTORY):
+            return
+        for path in glob.glob(os.path.join(SHM_DIRECTORY, self.namespace + "_*")):
+            try:
+                segment = shared_memory.SharedMemory(os.path.basename(path))
+            except (OSError, ValueError):
+                continue
+            segment.close()
+            segment.unlink()
@@ -0,0 +1,798 @@
+"""Storage backends of PickleCache.
+
+Cache entries are binary blobs addressed by string keys. `DirectoryStorage` keeps the original layout
+with one file per entry, `SqliteStorage` keeps all entries in a single file which saves inodes and
+metadata round trips on network file systems. `TieredStorage` keeps copies of entries of a shared storage
+on a local disk.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import errno
+import io
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flexp.utils import get_logger, id_generator
+
+
+log = get_logger(__name__)
+
+
+RWRWRW = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH
+
+# suffix of directories with sidecar files of entries
+SIDECARS_SUFFIX = ".arrays"
+
+
+def makedirs(directory, dir_rights=0o777):
+    """Create directory with given rights regardless of umask.
+
+    :param str directory:
+    :param int dir_rights:
+    """
+    if os.path.exists(directory):
+        return
+    # Override umask settings to enforce flexible rights. 777 enables collaboration between people and prevents
+    # omnipresent AccessDeniedErrors.
+    original_umask = None
+    try:
+        original_umask = os.umask(0)
+        os.makedirs(directory, dir_rights)
+    except OSError:
+        # created by another process in the meantime
+        if not os.path.isdir(directory):
+            raise
+    finally:
+        if original_umask is not None:
+            os.umask(original_umask)
+
+
+def set_rights(path):
+    """Try to set some more flexible access rights.
+
+    :param str path:
+    """
+    try:
+        os.chmod(path, RWRWRW)
+    except OSError:
+        pass
+
+
+def sidecar_directory(path):
+    """Return directory of sidecar files (e.g. memory-mapped numpy arrays) of the entry file.
+
+    :param str path: path of the entry file
+    :rtype: str
+    """
+    return path + SIDECARS_SUFFIX
+
+
+def remove_sidecars(path, keep=None):
+    """Remove sidecar files of the entry file, e.g. those of an entry replaced by a newer write.
+
+    :param str path: path of the entry file
+    :param str keep: prefix of names of files which are kept, None removes all sidecars
+    :return int: reclaimed bytes
+    """
+    directory = sidecar_directory(path)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    reclaimed = 0
+    for name in names:
+        if keep is not None and name.startswith(keep):
+            continue
+        try:
+            sidecar = os.path.join(directory, name)
+            size = os.path.getsize(sidecar)
+            os.unlink(sidecar)
+            reclaimed += size
+        except OSError:
+            # removed by another writer meanwhile
+            pass
+    if keep is None:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+    return reclaimed
+
+
+def _directory_size(directory):
+    # os.scandir is not available in Python 3.4
+    size = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    for name in names:
+        try:
+            entry_stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(entry_stat.st_mode):
+            size += entry_stat.st_size
+    return size
+
+
+@contextmanager
+def atomic_path(path):
+    """Yield temporary path in the same directory which replaces `path` when the `with` block succeeds.
+
+    Readers never see partially written file, the temporary file is removed on failure.
+
+    :param str path: final path
+    """
+    tmp_path = "{}.tmp{}{}".format(path, os.getpid(), id_generator(8))
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    set_rights(path)
+
+
+def _lockf_timeout(f, offset, timeout):
+    """Block until the record lock of byte `offset` of file `f` is acquired or `timeout` seconds pass.
+
+    `lockf` has no timeout, it blocks in a helper thread. On timeout the thread takes over the file, releases the lock
+    as soon as it gets it and closes the file.
+
+    :param file f: open lock file
+    :param int offset: locked byte
+    :param float timeout:
+    :return bool: True if the lock was acquired, False on timeout
+    """
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+    state = {"abandoned": False, "error": None}
+    guard = threading.Lock()
+    done = threading.Event()
+
+    def wait():
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX, 1, offset)
+        except BaseException as e:
+            state["error"] = e
+        with guard:
+            if state["abandoned"]:
+                if state["error"] is None:
+                    fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+                f.close()
+            done.set()
+
+    thread = threading.Thread(target=wait, name="file-lock")
+    thread.daemon = True
+    thread.start()
+    done.wait(timeout)
+    with guard:
+        if not done.is_set():
+            state["abandoned"] = True
+            return False
+    if state["error"] is not None:
+        raise state["error"]
+    return True
+
+
+@contextmanager
+def file_lock(path, timeout=None, offset=0, remove=False):
+    """Hold exclusive inter-process lock of the file.
+
+    POSIX record locks are used as they work on NFS too. Threads of one process do not exclude each other.
+
+    :param str path: path to the lock file, created if needed
+    :param float timeout: how long to wait for the lock, None waits forever
+    :param int offset: locked byte of the file, many locks can share one file
+    :param bool remove: remove the lock file when the lock is released
+    :return: context manager yielding True if the lock was acquired, False on timeout
+    """
+    if fcntl is None:
+        raise OSError("File locks are not supported on this platform")
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        f = open(path, 'ab')
+        set_rights(path)
+        if deadline is None:
+            fcntl.lockf(f, fcntl.LOCK_EX, 1, offset)
+        elif not _lockf_timeout(f, offset, max(deadline - time.time(), 0.)):
+            # the file is closed by the waiting thread
+            yield False
+            return
+        # the file could be removed by the previous holder while we were waiting
+        try:
+            file_stat = os.fstat(f.fileno())
+            path_stat = os.stat(path)
+            if (file_stat.st_dev, file_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino):
+                break
+        except OSError:
+            pass
+        fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+        f.close()
+    try:
+        yield True
+    finally:
+        if remove:
+            # removed while still locked, waiting processes notice it and lock a new file
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+        f.close()
+
+
+class CacheStorage(object):
+    """Interface of PickleCache storage backends."""
+
+    # True if entries are plain files, see `path`
+    entry_files = False
+
+    # True if listing all keys once is cheaper than repeated `exists_many` queries over a long stream of keys
+    bulk_listing = False
+
+    def exists(self, key):
+        """Check if the entry is stored.
+
+        :param str key:
+        :rtype: bool
+        """
+        raise NotImplementedError()
+
+    def exists_many(self, keys):
+        """Check which entries are stored.
+
+        :param list[str] keys:
+        :return set[str]: keys that are stored
+        """
+        return set(key for key in keys if self.exists(key))
+
+    def open_read(self, key):
+        """Open the entry for reading.
+
+        :param str key:
+        :return: binary file-like object usable in a `with` statement
+        :raise KeyError: if the entry does not exist
+        """
+        raise NotImplementedError()
+
+    def open_write(self, key):
+        """Open the entry for writing, the entry is stored atomically when the `with` block ends without an exception.
+
+        The file-like object must be seekable.
+
+        :param str key:
+        :return: context manager yielding a binary file-like object
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """Read several entries at once.
+
+        :param list[str] keys:
+        :return dict[str, bytes]: payloads of stored entries, missing keys are left out
+        """
+        payloads = {}
+        for key in keys:
+            try:
+                with self.open_read(key) as f:
+                    payloads[key] = f.read()
+            except KeyError:
+                pass
+        return payloads
+
+    def put_many(self, items):
+        """Store several entries at once.
+
+        :param dict[str, bytes] items: payloads by keys
+        """
+        for key, payload in items.items():
+            with self.open_write(key) as f:
+                f.write(payload)
+
+    def remove(self, key):
+        """Remove the entry, missing entry is ignored.
+
+        :param str key:
+        """
+        raise NotImplementedError()
+
+    def keys(self):
+        """Return keys of all stored entries.
+
+        :rtype: list[str]
+        """
+        raise NotImplementedError()
+
+    def size(self, key):
+        """Return size of the stored entry in bytes.
+
+        :param str key:
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+    def mtime(self, key):
+        """Return time of the last modification of the entry, None if not known.
+
+        :param str key:
+        :rtype: float|None
+        """
+        return None
+
+    def path(self, key):
+        """Return filesystem path of the entry or None if entries are not stored as files.
+
+        :param str key:
+        :rtype: str|None
+        """
+        return None
+
+    def lock_path(self, key):
+        """Return path of the lock file of the entry, None if locking is not supported.
+
+        :param str key:
+        :rtype: str|None
+        """
+        return None
+
+    def lock(self, key, timeout=None):
+        """Hold exclusive inter-process lock of the entry, see `file_lock`.
+
+        :param str key:
+        :param float timeout: how long to wait for the lock, None waits forever
+        :return: context manager yielding True if the lock was acquired, False on timeout
+        """
+        return file_lock(self.lock_path(key), timeout, remove=True)
+
+    def index_path(self):
+        """Return path of the SQLite file holding the access index of the entries, None if not supported.
+
+        :rtype: str|None
+        """
+        return None
+
+    def flush(self):
+        """Wait until written entries are stored, for storages writing in background."""
+        pass
+
+    def sweep_temporary(self, max_age=3600.):
+        """Remove temporary files left by writers killed before they stored the entry.
+
+        :param float max_age: only files older than this number of seconds are removed, younger ones may be
+        still written
+        :return (int, int): number of removed files and reclaimed bytes
+        """
+        return 0, 0
+
+    def close(self):
+        """Release resources."""
+        pass
+
+
+class DirectoryStorage(CacheStorage):
+    """One file per entry in a directory, file name is the key."""
+
+    entry_files = True
+
+    bulk_listing = True
+
+    # number of keys from which `exists_many` lists the directory instead of checking keys one by one
+    LISTING_THRESHOLD = 64
+
+    INDEX_FILE = ".flexp_index.sqlite"
+
+    def __init__(self, directory, dir_rights=0o777):
+        """
+        :param str directory:
+        :param int dir_rights: rights of the created directory
+        """
+        self.directory = directory
+        makedirs(directory, dir_rights)
+
+    def __repr__(self):
+        return "DirectoryStorage({!r})".format(self.directory)
+
+    def path(self, key):
+        return self.directory + "/" + key
+
+    def index_path(self):
+        return self.path(self.INDEX_FILE)
+
+    def lock_path(self, key):
+        return self.path(key) + ".lock"
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def exists_many(self, keys):
+        keys = set(keys)
+        if len(keys) < self.LISTING_THRESHOLD:
+            return super(DirectoryStorage, self).exists_many(keys)
+        # one directory listing is much cheaper than a stat call per key
+        return keys & set(self.keys())
+
+    def open_read(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except (IOError, OSError):
+            if not self.exists(key):
+                raise KeyError(key)
+            raise
+
+    @contextmanager
+    def open_write(self, key):
+        with atomic_path(self.path(key)) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                yield f
+
+    def remove(self, key):
+        """Remove the entry together with its sidecar files.
+
+        :param str key:
+        """
+        file = self.path(key)
+        try:
+            os.unlink(file)
+        except OSError:
+            pass
+        shutil.rmtree(sidecar_directory(file), ignore_errors=True)
+
+    def keys(self):
+        # files with a dot are sidecars or internal files
+        return [name for name in os.listdir(self.directory) if "." not in name]
+
+    def size(self, key):
+        file = self.path(key)
+        return os.path.getsize(file) + _directory_size(sidecar_directory(file))
+
+    def sweep_temporary(self, max_age=3600.):
+        """Remove temporary files of entries (see `atomic_path`) and sidecar directories of never stored entries.
+
+        :param float max_age: only files older than this number of seconds are removed
+        :return (int, int): number of removed files and reclaimed bytes
+        """
+        deadline = time.time() - max_age
+        count = 0
+        reclaimed = 0
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            try:
+                entry_stat = os.stat(path)
+                if entry_stat.st_mtime >= deadline:
+                    continue
+                if ".tmp" in name and stat.S_ISREG(entry_stat.st_mode):
+                    os.unlink(path)
+                    count += 1
+                    reclaimed += entry_stat.st_size
+                elif name.endswith(SIDECARS_SUFFIX) and not os.path.exists(path[:-len(SIDECARS_SUFFIX)]):
+                    size = _directory_size(path)
+                    shutil.rmtree(path)
+                    count += 1
+                    reclaimed += size
+            except OSError:
+                # removed by another process meanwhile
+                pass
+        return count, reclaimed
+
+    def mtime(self, key):
+        return os.path.getmtime(self.path(key))
+
+
+class SqliteDatabase(object):
+    """Lazily opened SQLite database file.
+
+    The connection is opened lazily in every process and thread, so the object can be passed to worker processes
+    and used by background threads.
+    """
+
+    # SQLite limits number of host parameters in one statement
+    BATCH_SIZE = 500
+
+    # statements creating tables of the database
+    SCHEMA = ()
+
+    PickleCacheBlackList = ["_connections"]
+
+    def __init__(self, path, timeout=60.):
+        """
+        :param str path: path to the database file, its directory is created if needed
+        :param float timeout: how long to wait for a lock held by another process
+        """
+        self.file = path
+        self.timeout = timeout
+        # connections by (process id, thread id)
+        self._connections = {}
+        directory = os.path.dirname(path)
+        if directory:
+            makedirs(directory)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connections"] = {}
+        return state
+
+    @property
+    def connection(self):
+        """Return connection owned by the current process and thread."""
+        owner = (os.getpid(), threading.current_thread().ident)
+        connection = self._connections.get(owner)
+        if connection is None:
+            # closed from another thread in `close`
+            connection = sqlite3.connect(self.file, timeout=self.timeout, check_same_thread=False)
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            connection.commit()
+            set_rights(self.file)
+            self._connections[owner] = connection
+        return connection
+
+    def _batches(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            yield keys[i:i + self.BATCH_SIZE]
+
+    def close(self):
+        pid = os.getpid()
+        for owner, connection in list(self._connections.items()):
+            # connections inherited from the parent process must not be touched
+            if owner[0] == pid:
+                connection.close()
+        self._connections = {}
+
+
+class SqliteStorage(SqliteDatabase, CacheStorage):
+    """All entries in a single SQLite database file."""
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL)",)
+
+    def __repr__(self):
+        return "SqliteStorage({!r})".format(self.file)
+
+    def index_path(self):
+        # access index lives in its own table of the same database
+        return self.file
+
+    def lock_path(self, key):
+        # all entries share one lock file, see `lock`
+        return self.file + ".lock"
+
+    def lock(self, key, timeout=None):
+        # every entry locks its own byte of the shared file, distinct entries rarely share a byte
+        offset = zlib.crc32(key.encode("utf-8")) & 0x7fffffff
+        return file_lock(self.lock_path(key), timeout, offset=offset)
+
+    def exists(self, key):
+        return self.connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def exists_many(self, keys):
+        found = set()
+        for batch in self._batches(keys):
+            query = "SELECT key FROM entries WHERE key IN ({})".format(",".join("?" * len(batch)))
+            found.update(row[0] for row in self.connection.execute(query, batch))
+        return found
+
+    def open_read(self, key):
+        row = self.connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return io.BytesIO(row[0])
+
+    @contextmanager
+    def open_write(self, key):
+        f = io.BytesIO()
+        yield f
+        self.put_many({key: f.getvalue()})
+
+    def get_many(self, keys):
+        payloads = {}
+        for batch in self._batches(keys):
+            query = "SELECT key, value FROM entries WHERE key IN ({})".format(",".join("?" * len(batch)))
+            payloads.update((key, bytes(value)) for key, value in self.connection.execute(query, batch))
+        return payloads
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)",
+                                        [(key, sqlite3.Binary(value)) for key, value in items.items()])
+
+    def remove(self, key):
+        with self.connection:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def keys(self):
+        return [row[0] for row in self.connection.execute("SELECT key FROM entries")]
+
+    def size(self, key):
+        row = self.connection.execute("SELECT length(value) FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+
+class TieredStorage(CacheStorage):
+    """Fast local storage in front of a slow shared one, e.g. a local directory in front of a directory on NFS.
+
+    Entries are read from the local storage, entries missing there are read from the remote storage and promoted
+    to the local one, so hot entries never touch the network. Written entries are stored locally and uploaded to
+    the remote storage by background threads. Any storage can be remote, e.g. DirectoryStorage of a shared
+    directory or SqliteStorage of a shared file; a client of an object store only has to implement CacheStorage.
+    """
+
+    bulk_listing = True
+
+    def __init__(self, local, remote, upload_workers=1):
+        """
+        :param CacheStorage local: fast storage, e.g. DirectoryStorage on a local disk
+        :param CacheStorage remote: shared storage
+        :param int upload_workers: number of background upload threads, 0 uploads entries before `open_write` returns
+        """
+        self.local = local
+        self.remote = remote
+        self.upload_workers = upload_workers
+        # uploads are started lazily, threads cannot be pickled
+        self._uploader = None
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self.promotions = 0
+        self.uploads = 0
+        self.failed_uploads = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_uploader=None, _uploads={}, _lock=None, promotions=0, uploads=0, failed_uploads=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "TieredStorage({!r}, {!r})".format(self.local, self.remote)
+
+    def exists(self, key):
+        return self.local.exists(key) or self.remote.exists(key)
+
+    def exists_many(self, keys):
+        keys = set(keys)
+        found = self.local.exists_many(keys)
+        return found | self.remote.exists_many(keys - found)
+
+    def open_read(self, key):
+        try:
+            return self.local.open_read(key)
+        except KeyError:
+            pass
+        with self.remote.open_read(key) as f:
+            payload = f.read()
+        self._promote(key, payload)
+        return io.BytesIO(payload)
+
+    def get_many(self, keys):
+        payloads = self.local.get_many(keys)
+        missing = [key for key in keys if key not in payloads]
+        if missing:
+            promoted = self.remote.get_many(missing)
+            for key, payload in promoted.items():
+                self._promote(key, payload)
+            payloads.update(promoted)
+        return payloads
+
+    def _promote(self, key, payload):
+        try:
+            with self.local.open_write(key) as f:
+                f.write(payload)
+        except (IOError, OSError):
+            log.warning("Failed to copy cache item {} to {!r}".format(key, self.local), exc_info=True)
+            return
+        self.promotions += 1
+
+    @contextmanager
+    def open_write(self, key):
+        with self.local.open_write(key) as f:
+            yield f
+        if self.upload_workers:
+            self._submit_upload(key)
+        else:
+            self._upload(key)
+
+    def _submit_upload(self, key):
+        with self._lock:
+            if self._uploader is None:
+                self._uploader = ThreadPoolExecutor(self.upload_workers)
+            # rewritten entry is uploaded after its previous version
+            previous = self._uploads.get(key)
+            future = self._uploader.submit(self._upload, key, previous)
+            self._uploads[key] = future
+        future.add_done_callback(lambda done: self._forget_upload(key, done))
+
+    def _forget_upload(self, key, future):
+        with self._lock:
+            if self._uploads.get(key) is future:
+                del self._uploads[key]
+
+    def _upload(self, key, previous=None):
+        if previous is not None:
+            wait([previous])
+        try:
+            with self.local.open_read(key) as f:
+                payload = f.read()
+            self.remote.put_many({key: payload})
+        except KeyError:  # removed meanwhile
+            return
+        except Exception:
+            self.failed_uploads += 1
+            log.exception("Failed to upload cache item {} to {!r}".format(key, self.remote))
+            return
+        self.uploads += 1
+
+    def remove(self, key):
+        with self._lock:
+            pending = self._uploads.get(key)
+        if pending is not None:
+            wait([pending])
+        self.local.remove(key)
+        self.remote.remove(key)
+
+    def keys(self):
+        return list(set(self.local.keys()) | set(self.remote.keys()))
+
+    def size(self, key):
+        if self.local.exists(key):
+            return self.local.size(key)
+        return self.remote.size(key)
+
+    def mtime(self, key):
+        if self.local.exists(key):
+            return self.local.mtime(key)
+        return self.remote.mtime(key)
+
+    def flush(self):
+        """Wait until all written entries are uploaded."""
+        with self._lock:
+            pending = list(self._uploads.values())
+        wait(pending)
+
+    def sweep_temporary(self, max_age=3600.):
+        local_count, local_reclaimed = self.local.sweep_temporary(max_age)
+        remote_count, remote_reclaimed = self.remote.sweep_temporary(max_age)
+        return local_count + remote_count, local_reclaimed + remote_reclaimed
+
+    def stats(self):
+        """Return counters of this process.
+
+        :rtype: dict
+        """
+        return {"promotions": self.promotions, "uploads": self.uploads, "failed_uploads": self.failed_uploads}
+
+    def close(self):
+        self.flush()
+        if self._uploader is not None:
+            self._uploader.shutdown()
+            self._uploader = None
+        self.local.close()
+        self.remote.close()
@@ -0,0 +1,260 @@
+"""Precomputation of missing cache entries of a chain over a dataset in parallel processes.
+
+Used by `flexp-cache warm`. Existing entries are found by one listing of every directory storage (or one query per
+batch for other storages) before any work starts, only the missing items are sent to a pool of worker processes.
+Every worker builds its own chain by calling the chain factory and closes it when the pool ends.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+from itertools import islice
+from multiprocessing import Pool, util
+import importlib
+import io
+import json
+import os
+import time
+
+from flexp.flow import Chain
+from flexp.flow.cache import PickleCache
+from flexp.flow.caching_chain import CachingChain
+from flexp.utils import get_logger, import_by_filename
+
+
+log = get_logger(__name__)
+
+
+COMPUTED = "computed"
+STOPPED = "stopped"
+FAILED = "failed"
+
+
+def load_object(spec):
+    """Return object given by "package.module:attribute" or "path/to/file.py:attribute".
+
+    :param str spec:
+    """
+    module_name, _, attribute = spec.partition(":")
+    if not module_name or not attribute:
+        raise ValueError("Invalid object {}, use module:attribute".format(spec))
+    if module_name.endswith(".py"):
+        module = import_by_filename(os.path.splitext(os.path.basename(module_name))[0], module_name)
+    else:
+        module = importlib.import_module(module_name)
+    obj = module
+    for name in attribute.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def load_data(source):
+    """Return iterable of data given by a file with one JSON object per line or by "module:attribute".
+
+    The attribute is either an iterable or a function returning it.
+
+    :param str source:
+    :rtype: iterable
+    """
+    if os.path.isfile(source):
+        return _read_json_lines(source)
+    data = load_object(source)
+    return data() if callable(data) else data
+
+
+def _read_json_lines(path):
+    with io.open(path, "rt", encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def cache_lookups(chain):
+    """Return PickleCache stages of the chain which must hold an entry of processed data.
+
+    The last PickleCache of CachingChain is enough because CachingChain resumes from it, all top-level PickleCache
+    modules are needed in other chains.
+
+    :param Chain chain:
+    :return list[tuple[PickleCache, function]]: caches and functions {data -> data id in the cache}
+    """
+    if isinstance(chain, PickleCache):
+        return [(chain, lambda data: data[chain.data_key])]
+    if isinstance(chain, CachingChain):
+        indexes = [i for i, module in enumerate(chain.modules) if isinstance(module, PickleCache)]
+        if indexes:
+            i = indexes[-1]
+            return [(chain.modules[i], lambda data: chain.get_updated_data_ids(data)[i])]
+    elif isinstance(chain, Chain):
+        caches = [module for module in chain.modules if isinstance(module, PickleCache)]
+        if caches:
+            return [(cache, lambda data, cache=cache: data[cache.data_key]) for cache in caches]
+    raise ValueError("Chain {} has no PickleCache stage".format(chain))
+
+
+def find_missing(chain, data_iterable, batch_size=1000):
+    """Yield data whose entries are missing in any cache of the chain, repeated data are yielded once.
+
+    :param Chain chain:
+    :param iterable data_iterable:
+    :param int batch_size: number of data looked up at once
+    :return: generator of (data, bool missing)
+    """
+    lookups = cache_lookups(chain)
+    listings = [set(cache.storage.keys()) if cache.storage.bulk_listing and not cache.force else None
+                for cache, _ in lookups]
+    scheduled = set()
+    iterator = iter(data_iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        keys = [[] for _ in batch]
+        missing = set()
+        for (cache, get_id), listed in zip(lookups, listings):
+            cache_keys = [cache.get_cache_key_from_id(get_id(data)) for data in batch]
+            if cache.force:
+                found = set()
+            elif listed is not None:
+                found = listed.intersection(cache_keys)
+            else:
+                found = cache.storage.exists_many(cache_keys)
+            for i, key in enumerate(cache_keys):
+                keys[i].append(key)
+                if key not in found:
+                    missing.add(i)
+        for i, data in enumerate(batch):
+            item_keys = tuple(keys[i])
+            if i in missing and item_keys not in scheduled:
+                scheduled.add(item_keys)
+                yield data, True
+            else:
+                yield data, False
+
+
+class WarmupProgress(object):
+    """Counters of a warm-up run."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.total = 0
+        self.existing = 0
+        self.computed = 0
+        self.stopped = 0
+        self.failed = 0
+
+    @property
+    def missing(self):
+        return self.total - self.existing
+
+    @property
+    def done(self):
+        """Number of processed missing data."""
+        return self.computed + self.stopped + self.failed
+
+    @property
+    def seconds(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """Processed data per second."""
+        seconds = self.seconds
+        return self.done / seconds if seconds > 0 else 0.
+
+    @property
+    def eta(self):
+        """Estimated remaining seconds, None before the first data is processed."""
+        rate = self.rate
+        return (self.missing - self.done) / rate if rate > 0 else None
+
+
+# chain of the worker process created by _init_worker
+_worker_chain = None
+
+
+def _init_worker(chain_factory):
+    global _worker_chain
+    _worker_chain = chain_factory()
+    # pool workers end without returning to the caller, the chain is closed (background writes flushed) on their exit
+    util.Finalize(None, _worker_chain.close, exitpriority=10)
+
+
+def _process(data):
+    try:
+        _worker_chain.process(data)
+    except StopIteration:
+        return STOPPED
+    except Exception:
+        log.exception("Failed to process {!r}".format(data))
+        return FAILED
+    return COMPUTED
+
+
+def warm_cache(chain_factory, data_iterable, processes=None, batch_size=1000, chunk_size=16, report=None,
+               report_interval=10.):
+    """Compute missing cache entries of the chain over the data in parallel.
+
+    Data with missing entries are kept in memory until they are processed, so that progress can be reported with
+    the total number of missing data known.
+
+    :param chain_factory: picklable function (defined at module level) returning Chain with PickleCache stages
+    :param iterable data_iterable:
+    :param int processes: number of worker processes, number of CPUs by default; 0 processes the data in this process
+    :param int batch_size: number of data looked up at once
+    :param int chunk_size: number of data sent to a worker at once
+    :param report: {WarmupProgress -> None} called every `report_interval` seconds and after the run
+    :param float report_interval: seconds between reports
+    :rtype: WarmupProgress
+    """
+    progress = WarmupProgress()
+    chain = chain_factory()
+    try:
+        missing = []
+        for data, is_missing in find_missing(chain, data_iterable, batch_size):
+            progress.total += 1
+            if is_missing:
+                missing.append(data)
+            else:
+                progress.existing += 1
+        log.info("{} of {} data have missing cache entries".format(progress.missing, progress.total))
+        if report is not None:
+            report(progress)
+        if processes == 0:
+            global _worker_chain
+            _worker_chain = chain
+            try:
+                _run((_process(data) for data in missing), progress, report, report_interval)
+            finally:
+                _worker_chain = None
+        elif missing:
+            pool = Pool(processes, initializer=_init_worker, initargs=(chain_factory,))
+            try:
+                _run(pool.imap_unordered(_process, missing, chunk_size), progress, report, report_interval)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        chain.close()
+    if report is not None:
+        report(progress)
+    return progress
+
+
+def _run(results, progress, report, report_interval):
+    last_report = time.time()
+    for result in results:
+        if result == COMPUTED:
+            progress.computed += 1
+        elif result == STOPPED:
+            progress.stopped += 1
+        else:
+            progress.failed += 1
+        if report is not None and time.time() - last_report >= report_interval:
+            report(progress)
+            last_report = time.time()
@@ -6,6 +6,10 @@ from multiprocessing import Process, Queue, Pool
 import random
 import re
 import string
+import time
+
+# timer of module execution times; time.clock was removed in Python 3.8
+perf_counter = time.perf_counter if hasattr(time, "perf_counter") else time.clock
 
 
 def import_by_filename(name, module_path):
@@ -185,6 +189,72 @@ def log_method(log_fnc=logging.debug, arguments=True):
     return wrap
 
 
+class LogSummary(object):
+    """Logging of messages in hot paths, e.g. once per processed item.
+
+    By default every message is logged, but formatted only if its level is enabled. With `every` or `interval` set
+    the messages are only counted by their template and a summary of the counts (with the last message of each
+    template) is logged once per `every` messages or `interval` seconds, so logging cost does not grow with the
+    number of processed items.
+    """
+
+    def __init__(self, logger, every=None, interval=None):
+        """
+        :param logging.Logger logger:
+        :param int every: log summary after this number of messages
+        :param float interval: log summary after this number of seconds
+        """
+        self.logger = logger
+        self.every = every
+        self.interval = interval
+        self.counts = {}
+        self.pending = 0
+        # set by the first message, so that a new object does not depend on time
+        self.since = None
+
+    @property
+    def summarize(self):
+        return self.every is not None or self.interval is not None
+
+    def log(self, level, message, *args):
+        """Log or count the message, messages of disabled levels are skipped.
+
+        :param int level: logging level
+        :param str message: message with `str.format` fields if `args` are given, counted messages are grouped by it
+        :param args: values of the fields
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        if not self.summarize:
+            self.logger.log(level, message.format(*args) if args else message)
+            return
+        key = (level, message)
+        count = self.counts.get(key)
+        self.counts[key] = (count[0] + 1 if count else 1, args)
+        self.pending += 1
+        if self.since is None:
+            self.since = time.time()
+        if ((self.every is not None and self.pending >= self.every) or
+                (self.interval is not None and time.time() - self.since >= self.interval)):
+            self.flush()
+
+    def flush(self):
+        """Log summary of counted messages, one record per level."""
+        if not self.pending:
+            return
+        elapsed = time.time() - self.since
+        for level in sorted(set(level for level, _ in self.counts)):
+            counts = [(message, count, args) for (message_level, message), (count, args) in sorted(self.counts.items())
+                      if message_level == level]
+            self.logger.log(level, "{} messages in {:.1f} s: {}".format(
+                sum(count for _, count, _ in counts), elapsed,
+                "; ".join("{}x {}".format(count, message.format(*args) if args else message)
+                          for message, count, args in counts)))
+        self.counts = {}
+        self.pending = 0
+        self.since = None
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
     logger.addHandler(logging.NullHandler())
@@ -46,6 +46,7 @@ setup(
     entry_points={
         'console_scripts': [
             'flexp-browser = flexp.browser:main',
+            'flexp-cache = flexp.flow.cache_cli:main',
         ]
     },
     test_suite='nose.collector',
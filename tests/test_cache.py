@@ -1,13 +1,106 @@
 from __future__ import absolute_import
 
+import glob
+import importlib
+import json
+import logging
 import os
 import pickle
 import shutil
+import time
+import sys
 import unittest
-from flexp.flow import cache
+from multiprocessing import Process
+from testfixtures import LogCapture
+from flexp import flexp
+from flexp.flexp import core
+from flexp.flow import Chain, cache
+from flexp.flow.cache_stats import CacheStats, write_stats
+from flexp.flow.caching_chain import CachingChain
+from flexp.flow.lazy import LazyData
+from flexp.flow.cache import np
+from flexp.flow.serialization import entry_reader, read_metadata
+from flexp.flow.shared_cache import shared_memory
+from flexp.flow.storage import sidecar_directory
 from .utils import Add, Mult
 
 
+class SlowCount:
+    """Count computations in a file shared by processes."""
+
+    def __init__(self, counter_file):
+        self.counter_file = counter_file
+
+    def process(self, data):
+        time.sleep(0.5)
+        with open(self.counter_file, "a") as f:
+            f.write("x")
+        data["output"] = data["input"] + 1
+
+
+class FlowData:
+    """Data with attribute access used by CachingChain."""
+
+    def __init__(self, input):
+        self.input = input
+
+    def items(self):
+        return list(vars(self).items())
+
+    def __setitem__(self, key, item):
+        setattr(self, key, item)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+
+class MakeArray:
+    def process(self, data):
+        data["array"] = np.arange(1000) + data["input"]
+
+
+class AppendInPlace:
+    provides = ["inplace"]
+
+    def process(self, data):
+        data["inplace"].append(1)
+
+
+class Unpickled:
+    """Count unpickled instances."""
+
+    count = 0
+
+    def __init__(self):
+        self.value = 1
+
+    def __setstate__(self, state):
+        Unpickled.count += 1
+        self.__dict__.update(state)
+
+
+class MakeUnpickled:
+    def process(self, data):
+        data["counted"] = Unpickled()
+
+
+def process_single_flight(cache_dir, counter_file):
+    c = cache.PickleCache(cache_dir, "input", chain=[SlowCount(counter_file)], single_flight=True)
+    data = {"input": 10}
+    c.process(data)
+    assert data["output"] == 11
+
+
+def write_many_stats(name):
+    for i in range(20):
+        stats = CacheStats()
+        stats.count("hits", i)
+        write_stats(name, stats)
+
+
 class TestCache(unittest.TestCase):
     """Test the content of cache."""
 
@@ -24,7 +117,8 @@ class TestCache(unittest.TestCase):
     def _load_cache_file(self, pickle_cache, data):
         """Read first value from cache dir."""
         file = pickle_cache.get_cache_file(data)
-        return pickle.load(open(file, 'rb'))
+        with open(file, 'rb') as f, entry_reader(f) as stream:
+            return pickle.load(stream)
 
     def test_cache(self):
         c = cache.PickleCache(self.cache_dir, "input", chain=[
@@ -101,3 +195,470 @@ class TestCache(unittest.TestCase):
         # The cache content must change because the modules parameters are different
         self.assertEqual(self._load_cache_file(c, {"input": 10})["data"],
                          {"input": 10, "output": 1300})
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_mmap_arrays(self):
+        """Large arrays are stored next to the pickle and memory-mapped on hit."""
+        def make_array(data):
+            data["array"] = np.arange(data["input"], dtype=np.float64)
+
+        c = cache.PickleCache(self.cache_dir, "input", chain=[make_array], mmap_arrays=True, mmap_min_bytes=1024)
+        c.process({"input": 1000})
+        file = c.get_cache_file({"input": 1000})
+        self.assertEqual(len(glob.glob(os.path.join(sidecar_directory(file), "*.npy"))), 1)
+        self.assertEqual(c.storage.size(c.get_cache_key({"input": 1000})),
+                         os.path.getsize(file) + os.path.getsize(glob.glob(sidecar_directory(file) + "/*")[0]))
+
+        data = {"input": 1000}
+        c.process(data)
+        c.close()
+        self.assertIsInstance(data["array"], np.memmap)
+        self.assertFalse(data["array"].flags.writeable)
+        np.testing.assert_array_equal(data["array"], np.arange(1000, dtype=np.float64))
+
+        # the entry written again (e.g. by a concurrent writer) replaces sidecars of the previous one
+        c._compute(c.get_cache_key({"input": 1000}), {"input": 1000})
+        sidecars = glob.glob(os.path.join(sidecar_directory(file), "*"))
+        self.assertEqual(len(sidecars), 1)
+        self.assertEqual(c.storage.size(c.get_cache_key({"input": 1000})),
+                         os.path.getsize(file) + os.path.getsize(sidecars[0]))
+        # arrays kept inside the pickle
+        c.mmap_arrays = False
+        c._compute(c.get_cache_key({"input": 1000}), {"input": 1000})
+        self.assertFalse(os.path.exists(sidecar_directory(file)))
+        c.close()
+
+    def test_compression(self):
+        """Compressed entries are read back regardless of the reader's compression setting."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], compression="gzip")
+        c.process({"input": 10})
+        with open(c.get_cache_file({"input": 10}), 'rb') as f:
+            self.assertIn(b"gzip", f.read(32))
+        self.assertEqual(self._load_cache_file(c, {"input": 10})["data"], {"input": 10, "output": 23})
+
+        data = {"input": 10}
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        c.process(data)
+        c.close()
+        self.assertEqual(data, {"input": 10, "output": 23})
+        self.assertRaises(ValueError, cache.PickleCache, self.cache_dir, compression="rar")
+
+    def test_legacy_entry(self):
+        """Entries written as plain pickles are still readable."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        with open(c.get_cache_file({"input": 10}), 'wb') as f:
+            pickle.dump({"data": {"input": 10, "output": 0}, "stopped": False, "chain_repr": "",
+                         "chain_mtime": c.chain_info["chain_mtime"]}, f)
+        data = {"input": 10}
+        c.process(data)
+        self.assertEqual(data["output"], 0)
+
+    def test_corrupted_entry(self):
+        """Torn or damaged entries are detected by the header and recomputed."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        c.process({"input": 10})
+        file = c.get_cache_file({"input": 10})
+        with open(file, 'rb') as f:
+            content = f.read()
+
+        for damaged in (content[:-3], content[:-1] + bytes([content[-1] ^ 1])):
+            with open(file, 'wb') as f:
+                f.write(damaged)
+            data = {"input": 10}
+            c.process(data)
+            self.assertEqual(data, {"input": 10, "output": 23})
+            with open(file, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(file)])
+
+    def test_single_flight(self):
+        """Only one of the concurrent processes computes a missing entry."""
+        os.makedirs(self.cache_dir)
+        counter_file = os.path.join(self.cache_dir, "counter.txt")
+        processes = [Process(target=process_single_flight, args=(self.cache_dir, counter_file)) for _ in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        with open(counter_file) as f:
+            self.assertEqual(f.read(), "x")
+        self.assertFalse([name for name in os.listdir(self.cache_dir) if name.endswith(".lock")])
+
+    def test_async_write(self):
+        """Entries are written in background, keys added later to data are not cached."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], async_write=True)
+        data = {"input": 10}
+        c.process(data)
+        data["later"] = 1
+        c.flush()
+        self.assertEqual(self._load_cache_file(c, {"input": 10})["data"], {"input": 10, "output": 23})
+
+        for i in range(20):
+            c.process({"input": i})
+        c.close()
+        self.assertEqual(len(c.storage.keys()), 20)
+
+    def test_save_keys(self):
+        """Only keys produced by the chain are stored."""
+        def add_extra(data):
+            data["extra"] = 1
+
+        for save_keys, saved in ((cache.SAVE_CHANGED, {"output": 23, "inplace": [1], "extra": 1}),
+                                 (cache.SAVE_PROVIDES, {"output": 23, "inplace": [1]})):
+            c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13), AppendInPlace(), add_extra],
+                                  save_keys=save_keys)
+            c.process({"input": 10, "big": "x" * 1000, "inplace": []})
+            self.assertEqual(self._load_cache_file(c, {"input": 10})["data"], saved)
+
+            data = {"input": 10, "big": "y", "inplace": []}
+            c.process(data)
+            c.close()
+            self.assertEqual(data, dict({"input": 10, "big": "y", "inplace": []}, **saved))
+            shutil.rmtree(self.cache_dir)
+
+        # a key rebound twice is stored even if ids of the freed values are reused
+        def rebind_first(data):
+            data["x"] = [10, 20]
+
+        def rebind_second(data):
+            data["x"] = [20, 30, 40]
+
+        c = cache.PickleCache(self.cache_dir, "input", chain=[rebind_first, rebind_second],
+                              save_keys=cache.SAVE_CHANGED)
+        for _ in range(2):
+            data = {"input": 10, "x": [1, 2, 3]}
+            c.process(data)
+            self.assertEqual(data["x"], [20, 30, 40])
+        c.close()
+        shutil.rmtree(self.cache_dir)
+
+        # values of lazy data are not loaded to find changed keys
+        data = LazyData(input=10)
+        data.set_lazy("unused", lambda: self.fail("unused value was loaded"))
+        c = cache.PickleCache(self.cache_dir, "input", chain=[rebind_first], save_keys=cache.SAVE_CHANGED)
+        c.process(data)
+        self.assertEqual(self._load_cache_file(c, {"input": 10})["data"], {"x": [10, 20]})
+        self.assertFalse(data.is_loaded("unused"))
+        c.close()
+
+        # nothing would be stored
+        with self.assertRaises(ValueError):
+            cache.PickleCache(self.cache_dir, "input", chain=[add_extra], save_keys=cache.SAVE_PROVIDES)
+
+    def test_code_invalidation(self):
+        """Entries of modules whose code changed are not used."""
+        source = "class Offset:\n    def process(self, data):\n        data['output'] = data['input'] + {}\n"
+        module_dir = os.path.join(self.cache_dir, "code")
+        os.makedirs(module_dir)
+        module_file = os.path.join(module_dir, "offset_module.py")
+        sys.path.insert(0, module_dir)
+        try:
+            def run(offset, mtime):
+                with open(module_file, "w") as f:
+                    f.write(source.format(offset))
+                os.utime(module_file, (mtime, mtime))
+                if "offset_module" in sys.modules:
+                    importlib.reload(sys.modules["offset_module"])
+                module = importlib.import_module("offset_module")
+                c = cache.PickleCache(self.cache_dir, "input", chain=[module.Offset()], invalidation="code")
+                data = {"input": 10}
+                c.process(data)
+                c.close()
+                return c.chain_hash, data["output"]
+
+            hash1, output1 = run(1, 1000000000)
+            self.assertEqual(output1, 11)
+            # touched file with the same content keeps the entry
+            self.assertEqual(run(1, 1000000100), (hash1, 11))
+            hash2, output2 = run(2, 1000000200)
+            self.assertNotEqual(hash1, hash2)
+            self.assertEqual(output2, 12)
+        finally:
+            sys.path.remove(module_dir)
+            sys.modules.pop("offset_module", None)
+
+        # functions are hashed by their source
+        def add_one(data):
+            data["output"] = data["input"] + 1
+
+        def add_two(data):
+            data["output"] = data["input"] + 2
+
+        add_two.__name__ = "add_one"
+        self.assertNotEqual(cache.code_hash(add_one), cache.code_hash(add_two))
+
+    def test_process_many(self):
+        """Batched lookup returns the same data as processing items one by one."""
+        def stop_odd(data):
+            if data["input"] % 2:
+                raise StopIteration()
+
+        c = cache.PickleCache(self.cache_dir, "input", chain=[stop_odd, Add(13)])
+        for i in range(0, 10, 3):
+            try:
+                c.process({"input": i})
+            except StopIteration:
+                pass
+
+        hits = [c.get_cache_key_from_id(i) for i in (0, 3, 6)]
+        self.assertEqual(len(c._prefetch(hits)), 3)
+        for prefetch, max_bytes in ((True, c.PREFETCH_MAX_BYTES), (True, 1), (False, c.PREFETCH_MAX_BYTES)):
+            c.PREFETCH_MAX_BYTES = max_bytes
+            processed = list(c.process_many(({"input": i} for i in range(10)), batch_size=3, prefetch=prefetch))
+            self.assertEqual(processed, [{"input": i, "output": i + 13} for i in range(0, 10, 2)])
+        # reading stops after the byte budget, other hits are read on demand
+        c.PREFETCH_MAX_BYTES = 1
+        self.assertEqual(len(c._prefetch(hits)), 1)
+        del c.PREFETCH_MAX_BYTES
+
+        self.assertEqual(list(c.process_many([{"input": 12}, {"input": 12}])), [{"input": 12, "output": 25}] * 2)
+        keys = c.storage.keys
+        c.storage.keys = None  # micro-batches do not list the storage
+        self.assertEqual(c.process_batch([{"input": 12}, {"input": 1}]), [{"input": 12, "output": 25}])
+        c.storage.keys = keys
+        self.assertEqual(list(Chain(c).stream({"input": i} for i in [12, 1])), [{"input": 12, "output": 25}])
+        self.assertEqual(c.lookup_many([0, 1, 11, 12]), [{"input": 0, "output": 13}, None, None,
+                                                         {"input": 12, "output": 25}])
+        c.close()
+
+    def test_memory_tier(self):
+        """Recently used entries are served from memory."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], memory_max_bytes=10 ** 6)
+        c.process({"input": 10})
+        shutil.rmtree(self.cache_dir)  # only the memory tier has the entry
+        data = {"input": 10}
+        c.process(data)
+        self.assertEqual(data, {"input": 10, "output": 23})
+        data["output"] = 0  # copy on read
+        data = {"input": 10}
+        c.process(data)
+        self.assertEqual(data["output"], 23)
+        self.assertEqual((c.memory.hits, c.memory.misses), (2, 0))
+        c.close()
+
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], memory_max_bytes=300,
+                              memory_copy_on_read=False)
+        for i in range(5):
+            c.process({"input": i})
+        self.assertEqual(len(c.memory), 0)  # computed entries are kept only with copy on read
+        for i in range(5):
+            c.process({"input": i})
+        c.process({"input": 4})
+        stats = c.memory.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 5))
+        self.assertLessEqual(stats["bytes"], 300)
+        self.assertGreater(stats["evictions"], 0)
+        c.close()
+
+    @unittest.skipIf(np is None, "numpy is not available")
+    def test_chunked(self):
+        """Values are stored as separate records and can be loaded alone."""
+        for options in ({}, {"compression": "gzip"}, {"mmap_arrays": True, "mmap_min_bytes": 100},
+                        {"memory_max_bytes": 10 ** 6}):
+            c = cache.PickleCache(self.cache_dir, "input", chain=[MakeArray(), MakeUnpickled(), Add(13)], chunked=True,
+                                  **options)
+            c.process({"input": 10})
+            with open(c.get_cache_file({"input": 10}), "rb") as f:
+                self.assertEqual(read_metadata(f)["layout"], "records")
+            data = {"input": 10}
+            c.process(data)
+            self.assertEqual(sorted(data), ["array", "counted", "input", "output"])
+            self.assertEqual(data["array"][0], 10)
+            self.assertEqual(data["output"], 23)
+
+            Unpickled.count = 0
+            c.memory = None
+            bytes_read = c.stats["bytes_read"]
+            self.assertEqual(c.lookup_keys(10, ["output", "missing"]), {"output": 23})
+            self.assertEqual(Unpickled.count, 0)
+            # records of other values are skipped without reading
+            self.assertLess(c.stats["bytes_read"] - bytes_read, os.path.getsize(c.get_cache_file({"input": 10})))
+            self.assertIsNone(c.lookup_keys(11, ["output"]))
+            c.close()
+            shutil.rmtree(self.cache_dir)
+
+    @unittest.skipIf(np is None, "numpy is not available")
+    def test_chunked_checksums(self):
+        """Only records which are read are verified, damaged records are detected when read."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[MakeArray(), Add(13)], chunked=True)
+        c.process({"input": 10})
+        file = c.get_cache_file({"input": 10})
+        with open(file, "rb") as f:
+            content = f.read()
+        position = content.index((np.arange(1000) + 10).tobytes()) + 100
+        with open(file, "wb") as f:
+            f.write(content[:position] + bytes([content[position] ^ 1]) + content[position + 1:])
+        self.assertEqual(c.lookup_keys(10, ["output"]), {"output": 23})
+
+        data = {"input": 10}
+        c.process(data)
+        self.assertEqual(data["array"][0], 10)
+        self.assertEqual(c.stats["misses"], 2)
+        with open(file, "rb") as f:
+            self.assertEqual(f.read(), content)
+        c.close()
+
+    def test_lazy(self):
+        """Values of LazyData are loaded on first access."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[MakeUnpickled(), Add(13)], lazy=True)
+        c.process(LazyData(input=10, big="x" * 10 ** 5))
+        size = os.path.getsize(c.get_cache_file({"input": 10}))
+        Unpickled.count = 0
+        bytes_read = c.stats["bytes_read"]
+        data = LazyData(input=10)
+        c.process(data)
+        self.assertEqual(sorted(data), ["big", "counted", "input", "output"])
+        self.assertFalse(data.is_loaded("counted"))
+        self.assertEqual(data["output"], 23)
+        self.assertEqual(Unpickled.count, 0)
+        # the hit and the loaded value read only their records, not the big value
+        self.assertLess(c.stats["bytes_read"] - bytes_read, size / 10)
+        self.assertEqual(dict(data)["counted"].value, 1)
+        self.assertEqual(Unpickled.count, 1)
+        self.assertEqual(c.stats["lazy_loads"], 4)  # input is cached as well
+        copied = pickle.loads(pickle.dumps(data))
+        self.assertIsInstance(copied, LazyData)
+        self.assertEqual((copied["output"], copied["counted"].value), (23, 1))
+
+        data = {"input": 10}  # plain dict is filled as usual
+        c.process(data)
+        self.assertEqual(data["output"], 23)
+
+        data = LazyData(input=10)
+        c.process(data)
+        c.storage.remove(c.get_cache_key(data))
+        self.assertRaises(LookupError, data.get, "output")
+        c.close()
+
+    @unittest.skipIf(np is None or shared_memory is None, "numpy or shared memory is not available")
+    def test_shared_memory(self):
+        """Entry loaded by one process is attached by others."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[MakeArray()], shared_memory=True)
+        c.process({"input": 10})
+        # the worker loads the entry from the storage and publishes it
+        worker = Process(target=c.process, args=({"input": 10},))
+        worker.start()
+        worker.join()
+        data = {"input": 10}
+        c.process(data)
+        np.testing.assert_array_equal(data["array"], np.arange(1000) + 10)
+        self.assertFalse(data["array"].flags.writeable)  # attached, not loaded from the storage
+        self.assertEqual(c.shared.stats()["hits"], 1)
+        name = c.shared.segment_name(c.get_cache_key(data))
+        c.close()
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, name)
+
+    def test_stats(self):
+        """Counters are written to the experiment directory on close."""
+        previous = core._eh.pop("experiment", None)
+        flexp.setup(self.cache_dir, "exp", backup=False, log_filename=None)
+        try:
+            c = cache.PickleCache(self.cache_dir + "/entries", "input", chain=[Mult(2)], name="mult")
+            chain = CachingChain([c], update_data_id="input")
+            for i in "aba":
+                chain.process(FlowData(i))
+            self.assertEqual(c.stats["hits"], 1)
+            self.assertEqual(c.stats["misses"], 2)
+            self.assertEqual(c.stats.hit_rate(), 1 / 3)
+            self.assertGreater(c.stats["bytes_written"], 0)
+            chain.close()
+            with open(flexp.get_file_path("cache_stats.json")) as f:
+                stats = json.load(f)
+        finally:
+            flexp.close()
+            if previous is not None:
+                core._eh["experiment"] = previous
+        self.assertEqual(stats["mult[Mult]"]["hits"], 1)
+        self.assertEqual(sum(stats["mult[Mult]"]["histograms"]["written"].values()), 2)
+        self.assertIn("load_seconds", stats["mult[Mult]"])
+        self.assertEqual(stats["CachingChain[mult[Mult]]"]["items"], 3)
+        self.assertEqual(stats["CachingChain[mult[Mult]]"]["misses"], 2)
+
+    def test_concurrent_stats(self):
+        """Statistics written by parallel processes are not lost."""
+        previous = core._eh.pop("experiment", None)
+        flexp.setup(self.cache_dir, "exp", backup=False, log_filename=None)
+        try:
+            processes = [Process(target=write_many_stats, args=("cache{}".format(i),)) for i in range(4)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                self.assertEqual(p.exitcode, 0)
+            path = flexp.get_file_path("cache_stats.json")
+            with open(path) as f:
+                stats = json.load(f)
+            files = os.listdir(os.path.dirname(path))
+        finally:
+            flexp.close()
+            if previous is not None:
+                core._eh["experiment"] = previous
+        self.assertEqual({name: value["hits"] for name, value in stats.items()},
+                         {"cache{}".format(i): 19 for i in range(4)})
+        self.assertFalse([name for name in files if ".lock" in name or ".tmp" in name])
+
+    def test_caching_chain_process_many(self):
+        """Resume points found for a batch are the same as when processing items one by one."""
+        def make_chain():
+            return CachingChain([cache.PickleCache(self.cache_dir + "/mult", "input", chain=[Mult(2)]),
+                                 cache.PickleCache(self.cache_dir + "/add", "input", chain=[Mult(3)])],
+                                update_data_id="input")
+
+        chain = make_chain()
+        self.assertEqual(chain.get_updated_data_ids(FlowData("a|x")), chain._updated_ids("a|x"))
+        self.assertEqual(len(set(chain.get_updated_data_ids(FlowData("a")))), 3)
+        chain.process(FlowData("a"))
+        processed = list(chain.process_many((FlowData(i) for i in "aba"), batch_size=2))
+        self.assertEqual(chain.stats["items"], 4)
+        self.assertEqual(chain.stats["resumed"], 2)
+        self.assertEqual(chain.stats["skipped_modules"], 2)
+        for module in chain.modules:
+            module.storage.keys = None  # micro-batches do not list the storages
+        self.assertEqual(len(chain.process_batch([FlowData("a"), FlowData("c")])), 2)
+        self.assertEqual(chain.stats["resumed"], 3)
+        chain.close()
+
+        chain = make_chain()
+        expected = []
+        for i in "aba":
+            data = FlowData(i)
+            chain.process(data)
+            expected.append(data.output)
+        self.assertEqual([data.output for data in processed], expected)
+        self.assertEqual(chain.stats["resumed"], 3)
+        chain.close()
+
+    def test_caching_chain_plan(self):
+        """Entries of partial data are loaded on the way from the deepest entry of complete data."""
+        def add_extra(data):
+            data["extra"] = data["output"] + "!"
+
+        complete = cache.PickleCache(self.cache_dir + "/mult", "input", chain=[Mult(2)])
+        partial = cache.PickleCache(self.cache_dir + "/add", "input", chain=[Mult(3)], save_keys=cache.SAVE_PROVIDES)
+        chain = CachingChain([complete, add_extra, partial], update_data_id="input")
+        first = FlowData("a")
+        chain.process(first)
+        for process in (chain.process, lambda data: list(chain.process_many([data]))):
+            data = FlowData("a")
+            process(data)
+            self.assertEqual((data.output, data.extra), (first.output, first.extra))
+        self.assertEqual((complete.stats["hits"], partial.stats["hits"]), (2, 2))
+        self.assertEqual((complete.stats["misses"], partial.stats["misses"]), (1, 1))
+        self.assertEqual(chain.stats["resumed"], 0)
+        chain.close()
+
+    def test_log_summary(self):
+        """Per-item messages are summarized once per log_every messages."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Mult(2)], log_every=4)
+        with LogCapture("flexp.flow.cache", level=logging.INFO) as l:
+            for i in [1, 1, 1, 1, 2]:
+                c.process({"input": i})
+            l.check()
+            c.process({"input": 1})
+            self.assertEqual(len(l.records), 1)
+            c.process({"input": 2})
+            c.close()
+        self.assertEqual(len(l.records), 2)
+        self.assertRegex(l.records[0].getMessage(), r"^4 messages in [\d.]+ s: 4x Found in cache, skipping chain$")
+        self.assertRegex(l.records[1].getMessage(), r"^1 messages in [\d.]+ s: 1x Found in cache, skipping chain$")
@@ -4,7 +4,8 @@ import os
 import pickle
 import shutil
 import unittest
-from flexp.flow import cache
+from flexp.flow import Chain, cache
+from flexp.flow.cache import np
 
 
 class TestModule:
@@ -21,6 +22,19 @@ class TestModule:
         pass
 
 
+class CustomHash:
+
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+
+    def __flexp_hash__(self):
+        return self.name
+
+    def process(self, data):
+        pass
+
+
 class TestCache(unittest.TestCase):
     """Test the hash of cache and black list parameter"""
 
@@ -58,3 +72,65 @@ class TestCache(unittest.TestCase):
         c.close()
         c2.close()
         c3.close()
+
+    def test_fingerprint(self):
+        def chain_hash(*chain, **kwargs):
+            c = cache.PickleCache(self.cache_dir, "input", chain=list(chain), **kwargs)
+            c.close()
+            return c.chain_info['chain_hash']
+
+        shared = [1, 2, 3]
+        cyclic = {"a": [1, {"b": 2}]}
+        cyclic["self"] = cyclic
+        module = TestModule(shared, shared, 0)
+        module.cyclic = cyclic
+        self.assertEqual(chain_hash(module), chain_hash(module))
+        self.assertNotEqual(chain_hash(TestModule(1, 2, 3)), chain_hash(TestModule(1, 3, 3)))
+        self.assertNotEqual(chain_hash(TestModule(1, 2, 3)), chain_hash(TestModule(1, "2", 3)))
+        self.assertEqual(chain_hash(TestModule({1, 2, 3}, {"b": 1, "a": 2}, 3)),
+                         chain_hash(TestModule({3, 2, 1}, {"a": 2, "b": 1}, 3)))
+
+        # __flexp_hash__ replaces attributes of the module
+        self.assertEqual(chain_hash(CustomHash("v1", [1])), chain_hash(CustomHash("v1", [2])))
+        self.assertNotEqual(chain_hash(CustomHash("v1", [1])), chain_hash(CustomHash("v2", [1])))
+
+        # legacy fingerprint is kept for caches written by older versions
+        self.assertNotEqual(chain_hash(TestModule(1, 2, 3)), chain_hash(TestModule(1, 2, 3), fingerprint="dump"))
+        self.assertEqual(chain_hash(TestModule(1, 2, 3), fingerprint="dump"),
+                         chain_hash(TestModule(1, 2, 4), fingerprint="dump"))
+
+        # batching of nested chains does not change results
+        for fingerprint in cache.FINGERPRINTS:
+            self.assertEqual(chain_hash(Chain(TestModule(1, 2, 3)), fingerprint=fingerprint),
+                             chain_hash(Chain(TestModule(1, 2, 3), batch_size=10), fingerprint=fingerprint))
+
+        # options of storing the entries of a nested cache do not change results
+        options = dict(max_bytes=10 ** 6, max_entries=10, max_age=60., eviction="lfu", compression="gzip",
+                       compression_level=1, single_flight=True, lock_timeout=1., async_write=True, write_workers=2,
+                       max_pending_writes=8, save_keys=cache.SAVE_CHANGED, memory_max_bytes=10 ** 6,
+                       memory_copy_on_read=False, log_every=10, chunked=True, lazy=True)
+        for fingerprint in cache.FINGERPRINTS:
+            inner_dir = os.path.join(self.cache_dir, "inner")
+            plain = cache.PickleCache(inner_dir, "input", chain=[TestModule(1, 2, 3)], fingerprint=fingerprint)
+            tuned = cache.PickleCache(inner_dir, "input", chain=[TestModule(1, 2, 3)], fingerprint=fingerprint,
+                                      **options)
+            self.assertEqual(plain.chain_info['chain_hash'], tuned.chain_info['chain_hash'])
+            self.assertEqual(chain_hash(plain, fingerprint=fingerprint), chain_hash(tuned, fingerprint=fingerprint))
+            plain.close()
+            tuned.close()
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_fingerprint_arrays(self):
+        def chain_hash(array):
+            c = cache.PickleCache(self.cache_dir, "input", chain=[TestModule(array, 0, 0)])
+            c.close()
+            return c.chain_info['chain_hash']
+
+        array = np.arange(1000, dtype=np.float64)
+        self.assertEqual(chain_hash(array), chain_hash(array.copy()))
+        self.assertEqual(chain_hash(array[::2]), chain_hash(array[::2].copy()))
+        changed = array.copy()
+        changed[500] = -1
+        self.assertNotEqual(chain_hash(array), chain_hash(changed))
+        self.assertNotEqual(chain_hash(array), chain_hash(array.astype(np.float32)))
+        self.assertNotEqual(chain_hash(array), chain_hash(array.reshape(10, 100)))
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import time
+import unittest
+
+from click.testing import CliRunner
+
+from flexp.flow import cache
+from flexp.flow.cache_cli import main
+from flexp.flow.cache_index import CacheIndex, LFU
+from flexp.flow.serialization import read_metadata
+from .utils import Add, Mult
+
+
+class TestCacheIndex(unittest.TestCase):
+    """Test size-bounded cache and garbage collection."""
+
+    cache_dir = "tests/cached_pkls"
+
+    def setUp(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_lru(self):
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], max_entries=2)
+        c.process({"input": 1})
+        c.process({"input": 2})
+        c.process({"input": 1})  # hit makes input 2 least recently used
+        c.process({"input": 3})
+        self.assertTrue(c.check_cache_exists({"input": 1}))
+        self.assertFalse(c.check_cache_exists({"input": 2}))
+        self.assertTrue(c.check_cache_exists({"input": 3}))
+        c.close()
+
+    def test_lfu(self):
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], max_entries=2, eviction=LFU)
+        c.process({"input": 1})
+        c.process({"input": 1})
+        c.process({"input": 1})
+        c.process({"input": 2})
+        c.process({"input": 2})
+        c.process({"input": 3})  # input 2 is less frequently used than 1
+        self.assertFalse(c.check_cache_exists({"input": 2}))
+        c.process({"input": 4})  # the just written entry is never evicted
+        self.assertTrue(c.check_cache_exists({"input": 1}))
+        self.assertFalse(c.check_cache_exists({"input": 3}))
+        self.assertTrue(c.check_cache_exists({"input": 4}))
+        c.close()
+
+    def test_existing_entries(self):
+        """Entries written by an unbounded cache count towards the budget."""
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        for i in range(10):
+            c.process({"input": i})
+        c.close()
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], max_entries=2)
+        for i in range(10, 13):
+            c.process({"input": i})
+        self.assertEqual(len(c.storage.keys()), 2)
+        self.assertTrue(c.check_cache_exists({"input": 12}))
+        c.close()
+
+    def test_batched_accesses(self):
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)], max_entries=10)
+        c.process({"input": 1})
+        c.process({"input": 1})
+        c.process({"input": 1})
+        index = CacheIndex(c.storage.index_path())
+        # hits are buffered until the next batch is written
+        self.assertEqual(index.entries()[0][4], 0)
+        c.flush()
+        self.assertEqual(index.entries()[0][4], 2)
+        # totals maintained by triggers survive replaced rows
+        index.record_write(index.entries()[0][0], 5)
+        self.assertEqual(index.totals(), (1, 5))
+        index.close()
+        c.close()
+
+    def test_gc_command(self):
+        c = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        for i in range(5):
+            c.process({"input": i})
+        c.close()
+
+        stale = c.get_cache_file({"input": 0}) + ".tmp123abcdefgh"
+        with open(stale, "wb") as f:
+            f.write(b"x")
+        os.utime(stale, (time.time() - 7200, time.time() - 7200))
+        result = CliRunner().invoke(main, ["gc", self.cache_dir, "--max-entries", "3"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Removed 1 temporary files", result.output)
+        self.assertIn("Evicted 2 entries", result.output)
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(len(c.storage.keys()), 3)
+
+        index = CacheIndex(c.storage.index_path())
+        self.assertEqual(index.totals()[0], 3)
+        self.assertEqual(len(index.victims(max_age=0, now=time.time() + 1)), 3)
+        index.close()
+
+    def test_ls_command(self):
+        add = cache.PickleCache(self.cache_dir, "input", chain=[Add(13)])
+        mult = cache.PickleCache(self.cache_dir, "input", chain=[Mult(2)], max_entries=10)
+        # the bounded cache indexes entries existing before its first write
+        mult.process({"input": 1})
+        for i in range(3):
+            add.process({"input": i})
+        with open(add.get_cache_file({"input": 0}), "rb") as f:
+            self.assertEqual(read_metadata(f), {"chain_hash": add.chain_hash, "chain_repr": add.chain_info["chain_repr"],
+                                                "chain_mtime": add.chain_info["chain_mtime"]})
+        add.close()
+        mult.close()
+
+        result = CliRunner().invoke(main, ["ls", self.cache_dir, "--width", "0"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        lines = result.output.splitlines()
+        self.assertIn("3 entries added", lines[0])
+        self.assertTrue(lines[2].startswith(add.chain_hash[:16]))
+        self.assertIn(add.chain_info["chain_repr"], lines[2])
+        self.assertTrue(lines[3].startswith(mult.chain_hash[:16]))
+
+        result = CliRunner().invoke(main, ["ls", self.cache_dir, "--chain", mult.chain_hash[:8]])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.splitlines()[1].split()[0], mult.get_cache_key({"input": 1}))
+
+        result = CliRunner().invoke(main, ["stats", self.cache_dir])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Entries: 4", result.output)
+        self.assertIn("Chains: 2 (0 entries without metadata)", result.output)
@@ -89,4 +89,52 @@ class TestChain(unittest.TestCase):
             Result()], check=True).process(data)
         assert data["output"] == 30
 
+    def test_process_batch(self):
+        class BatchMult(Mult):
+            batches = []
+
+            def process_batch(self, data_list):
+                self.batches.append(len(data_list))
+                for data in data_list:
+                    data["output"] = data["input"] * self.val
+                return [data for data in data_list if data["output"] != 6]
+
+        def stop_odd(data):
+            if data["output"] % 2:
+                raise StopIteration()
+
+        c = Chain([Add(1), BatchMult(3), Chain([stop_odd, BatchMult(2)])],
+                  batch_size=2)
+        processed = c.process_batch({"input": i} for i in range(6))
+        self.assertEqual(processed, [{"input": i, "output": 2 * i}
+                                     for i in [0, 4]])
+        # the nested chain gets micro-batches and passes on data not stopped
+        self.assertEqual(BatchMult.batches, [2, 2, 2, 1, 1])
+        self.assertEqual(c.iterations, 2)
+        c.close()
 
+    def test_stream(self):
+        pulled = []
+
+        def documents():
+            for text in ["a b", "", "c d e"]:
+                pulled.append(text)
+                yield {"text": text}
+
+        def sentences(data):
+            for word in data["text"].split():
+                yield {"input": len(pulled), "word": word}
+
+        def stop_d(data):
+            if data["word"] == "d":
+                raise StopIteration()
+
+        c = Chain([sentences, Chain([stop_d, Add(10)])])
+        stream = c.stream(documents())
+        self.assertEqual(next(stream), {"input": 1, "word": "a", "output": 11})
+        # data are pulled from the source only when needed
+        self.assertEqual(pulled, ["a b"])
+        self.assertEqual([data["word"] for data in stream], ["b", "c", "e"])
+        self.assertEqual(c.iterations, 4)
+        self.assertRaises(TypeError, c.process, {"text": "a"})
+        c.close()
@@ -3,7 +3,8 @@ from __future__ import print_function
 import time
 import unittest
 
-from flexp.flow.parallel import parallelize
+from flexp.flow import parallel
+from flexp.flow.parallel import DagChain, parallelize
 
 
 def add_two(x):
@@ -16,9 +17,77 @@ class TestParallel(unittest.TestCase):
         count = 50
         data = range(0, count)
 
-        start = time.clock()
+        start = time.perf_counter()
         res = list(parallelize(add_two, data, 25))
-        end = time.clock()
+        end = time.perf_counter()
         print("Time to process {}".format(end - start))
         assert len(res) == count
         assert sum(res) == (2 + count + 1) * count / 2
+
+
+class Sleep:
+    """Sleep and store the input times the factor under the output key."""
+
+    def __init__(self, output, factor, seconds=0.3, requires=("input",)):
+        self.requires = list(requires)
+        self.provides = [output]
+        self.factor = factor
+        self.seconds = seconds
+        # start and end times of the calls
+        self.intervals = []
+
+    def process(self, data):
+        start = time.time()
+        time.sleep(self.seconds)
+        data[self.provides[0]] = sum(data[key] for key in self.requires) * self.factor
+        self.intervals.append((start, time.time()))
+
+
+def stop_negative(data):
+    if data["input"] < 0:
+        raise StopIteration()
+
+
+class TestDagChain(unittest.TestCase):
+
+    def make_modules(self):
+        return [Sleep("a", 2), Sleep("b", 3), Sleep("c", 1, requires=["a", "b"])]
+
+    def test_dependencies(self):
+        chain = DagChain([Sleep("a", 2), Sleep("b", 3, requires=["a"]), Sleep("a", 5), stop_negative,
+                          Sleep("d", 1)])
+        self.assertEqual(chain._dependencies, [set(), {0}, {0, 1}, {0, 1, 2}, {3}])
+        chain.close()
+
+    def test_threads(self):
+        modules = self.make_modules()
+        chain = DagChain(modules, max_workers=2)
+        data = {"input": 1}
+        chain.process(data)
+        (a_start, a_end), (b_start, b_end), (c_start, _) = [module.intervals[0] for module in modules]
+        # independent modules overlap, the dependent one starts after both
+        self.assertLess(max(a_start, b_start), min(a_end, b_end))
+        self.assertGreaterEqual(c_start, max(a_end, b_end))
+        self.assertEqual(data, {"input": 1, "a": 2, "b": 3, "c": 5})
+        chain.close()
+        self.assertEqual(chain.iterations, 1)
+
+    def test_processes(self):
+        with DagChain([stop_negative] + self.make_modules(), executor="process", max_workers=2) as chain:
+            data = {"input": 2}
+            chain.process(data)
+            self.assertEqual(data, {"input": 2, "a": 4, "b": 6, "c": 10})
+            self.assertRaises(StopIteration, chain.process, {"input": -1})
+            self.assertEqual(chain.iterations, 1)
+
+    def test_processes_without_initializer(self):
+        """Modules are sent with every call where ProcessPoolExecutor has no initializer."""
+        initializer = parallel._DAG_WORKER_INITIALIZER
+        parallel._DAG_WORKER_INITIALIZER = False
+        try:
+            with DagChain(self.make_modules(), executor="process", max_workers=2) as chain:
+                data = {"input": 2}
+                chain.process(data)
+                self.assertEqual(data, {"input": 2, "a": 4, "b": 6, "c": 10})
+        finally:
+            parallel._DAG_WORKER_INITIALIZER = initializer
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import time
+import unittest
+from multiprocessing import Event, Process
+
+from flexp.flow import cache
+from flexp.flow.storage import SIDECARS_SUFFIX, DirectoryStorage, SqliteStorage, TieredStorage, sidecar_directory
+from .utils import Add
+
+
+def hold_lock(storage, key, locked, release):
+    with storage.lock(key) as acquired:
+        assert acquired
+        locked.set()
+        release.wait(10)
+
+
+class TestStorage(unittest.TestCase):
+    """Test storage backends of PickleCache."""
+
+    cache_dir = "tests/cached_pkls"
+
+    def setUp(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _check_storage(self, storage):
+        with storage.open_write("a") as f:
+            f.write(b"first")
+        storage.put_many({"b": b"second", "c": b"third"})
+        self.assertTrue(storage.exists("a"))
+        self.assertFalse(storage.exists("d"))
+        self.assertEqual(storage.exists_many(["a", "c", "d"]), {"a", "c"})
+        self.assertEqual(storage.get_many(["a", "b", "d"]), {"a": b"first", "b": b"second"})
+        with storage.open_read("c") as f:
+            self.assertEqual(f.read(), b"third")
+        self.assertEqual(storage.size("b"), 6)
+        storage.remove("b")
+        self.assertEqual(sorted(storage.keys()), ["a", "c"])
+        self.assertRaises(KeyError, storage.open_read, "b")
+        storage.close()
+
+    def test_directory_storage(self):
+        self._check_storage(DirectoryStorage(self.cache_dir))
+
+    def test_directory_sidecars(self):
+        storage = DirectoryStorage(self.cache_dir)
+        with storage.open_write("a") as f:
+            f.write(b"first")
+        os.makedirs(sidecar_directory(storage.path("a")))
+        with open(os.path.join(sidecar_directory(storage.path("a")), "x.0.npy"), "wb") as f:
+            f.write(b"array")
+        self.assertEqual(storage.size("a"), 10)
+        storage.remove("a")
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        # temporary files of killed writers and sidecars of never stored entries are swept when old enough
+        for name in ["b", "b.tmp123abc", "c.tmp456def"]:
+            with open(storage.path(name), "wb") as f:
+                f.write(b"x")
+        os.makedirs(sidecar_directory(storage.path("d")))
+        old = time.time() - 7200
+        for name in ["b", "b.tmp123abc", "d" + SIDECARS_SUFFIX]:
+            os.utime(storage.path(name), (old, old))
+        self.assertEqual(storage.sweep_temporary(max_age=3600), (2, 1))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["b", "c.tmp456def"])
+
+    def test_locks(self):
+        """Entries are locked by other processes, lock files are not left behind."""
+        for storage in (DirectoryStorage(self.cache_dir), SqliteStorage(self.cache_dir + "/cache.sqlite")):
+            locked, release = Event(), Event()
+            holder = Process(target=hold_lock, args=(storage, "a", locked, release))
+            holder.start()
+            self.assertTrue(locked.wait(10))
+            with storage.lock("a", timeout=0.2) as acquired:
+                self.assertFalse(acquired)
+            with storage.lock("b", timeout=0.2) as acquired:
+                self.assertTrue(acquired)
+            release.set()
+            with storage.lock("a", timeout=10) as acquired:
+                self.assertTrue(acquired)
+            holder.join()
+            self.assertEqual(holder.exitcode, 0)
+            storage.close()
+        self.assertEqual(os.listdir(self.cache_dir), ["cache.sqlite.lock"])
+
+    def test_sqlite_storage(self):
+        self._check_storage(SqliteStorage(self.cache_dir + "/cache.sqlite"))
+
+    def test_pickle_cache_sqlite(self):
+        storage = SqliteStorage(self.cache_dir + "/cache.sqlite")
+        c = cache.PickleCache(None, "input", chain=[Add(13)], storage=storage)
+        c.process({"input": 10})
+        self.assertEqual(storage.keys(), [c.get_cache_key({"input": 10})])
+
+        data = {"input": 10}
+        c.process(data)
+        self.assertEqual(data, {"input": 10, "output": 23})
+        processed = list(c.process_many({"input": i} for i in range(8, 12)))
+        c.close()
+        self.assertEqual(processed, [{"input": i, "output": i + 13} for i in range(8, 12)])
+        self.assertEqual(os.listdir(self.cache_dir), ["cache.sqlite"])
+
+    def test_tiered_storage(self):
+        self._check_storage(TieredStorage(DirectoryStorage(self.cache_dir + "/local"),
+                                          DirectoryStorage(self.cache_dir + "/remote")))
+
+    def test_pickle_cache_tiered(self):
+        remote = DirectoryStorage(self.cache_dir + "/remote")
+        storage = TieredStorage(DirectoryStorage(self.cache_dir + "/local1"), remote)
+        c = cache.PickleCache(None, "input", chain=[Add(13)], storage=storage)
+        c.process({"input": 10})
+        c.close()
+        key = c.get_cache_key({"input": 10})
+        self.assertEqual(storage.uploads, 1)
+        self.assertEqual(remote.keys(), [key])
+
+        # another machine promotes the entry to its local storage on the first read
+        local = DirectoryStorage(self.cache_dir + "/local2")
+        storage = TieredStorage(local, remote)
+        c = cache.PickleCache(None, "input", chain=[Add(13)], storage=storage)
+        for _ in range(2):
+            data = {"input": 10}
+            c.process(data)
+            self.assertEqual(data, {"input": 10, "output": 23})
+        self.assertEqual(storage.promotions, 1)
+        self.assertEqual(local.keys(), [key])
+        c.close()
+        self.assertEqual(storage.uploads, 0)
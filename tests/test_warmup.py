@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import unittest
+
+from click.testing import CliRunner
+
+from flexp.flow import Chain, cache
+from flexp.flow import warmup
+from flexp.flow.cache_cli import main
+from flexp.flow.caching_chain import CachingChain
+from flexp.flow.warmup import find_missing, warm_cache
+from .utils import Add, Mult
+
+
+CACHE_DIR = "tests/cached_pkls"
+
+
+def make_cache():
+    return cache.PickleCache(CACHE_DIR, "input", chain=[Mult(2)])
+
+
+def make_chain():
+    return Chain([cache.PickleCache(CACHE_DIR + "/mult", "input", chain=[Mult(2)]),
+                  cache.PickleCache(CACHE_DIR + "/add", "input", chain=[Add(1)])])
+
+
+def stop_odd(data):
+    if data["input"] % 2:
+        raise StopIteration()
+
+
+def make_stopping_cache():
+    return cache.PickleCache(CACHE_DIR, "input", chain=[stop_odd, Mult(2)])
+
+
+def make_caching_chain():
+    return CachingChain([cache.PickleCache(CACHE_DIR + "/mult", "input", chain=[Mult(2)]),
+                         cache.PickleCache(CACHE_DIR + "/add", "input", chain=[Mult(3)])], update_data_id="input")
+
+
+def fail(data):
+    raise KeyboardInterrupt()
+
+
+def make_failing_cache():
+    return cache.PickleCache(CACHE_DIR, "input", chain=[fail])
+
+
+def load_data():
+    return [{"input": i} for i in range(6)]
+
+
+class TestWarmup(unittest.TestCase):
+    """Test precomputation of cache entries."""
+
+    cache_dir = CACHE_DIR
+
+    def setUp(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_find_missing(self):
+        chain = make_chain()
+        chain.modules[0].process({"input": 1})
+        chain.process({"input": 2})
+        missing = [(data["input"], is_missing)
+                   for data, is_missing in find_missing(chain, [{"input": i} for i in [0, 1, 2, 0]], batch_size=3)]
+        # input 1 misses the second cache, repeated input 0 is scheduled once
+        self.assertEqual(missing, [(0, True), (1, True), (2, False), (0, False)])
+        chain.close()
+
+    def test_warm_cache(self):
+        c = make_cache()
+        c.process({"input": 0})
+        reports = []
+        progress = warm_cache(make_cache, load_data(), processes=2, chunk_size=2, report=reports.append)
+        self.assertEqual((progress.total, progress.existing, progress.computed), (6, 1, 5))
+        self.assertEqual(progress.eta, 0)
+        self.assertEqual(len(reports), 2)
+        self.assertTrue(all(c.check_cache_exists({"input": i}) for i in range(6)))
+        c.close()
+
+    def test_warm_stopped(self):
+        progress = warm_cache(make_stopping_cache, load_data(), processes=0)
+        self.assertEqual((progress.computed, progress.failed), (6, 0))
+        # stopped items are cached as well and are not computed again
+        progress = warm_cache(make_stopping_cache, load_data(), processes=0)
+        self.assertEqual(progress.existing, 6)
+
+    def test_warm_caching_chain(self):
+        """Data read from JSON lines are dicts, CachingChain reads their ids as items."""
+        progress = warm_cache(make_caching_chain, [{"input": str(i)} for i in range(6)], processes=0)
+        self.assertEqual((progress.computed, progress.failed), (6, 0))
+        progress = warm_cache(make_caching_chain, [{"input": str(i)} for i in range(6)], processes=0)
+        self.assertEqual(progress.existing, 6)
+
+    def test_warm_interrupted(self):
+        with self.assertRaises(KeyboardInterrupt):
+            warm_cache(make_failing_cache, load_data(), processes=0)
+        self.assertIsNone(warmup._worker_chain)
+
+    def test_warm_command(self):
+        os.makedirs(self.cache_dir)
+        data_file = os.path.join(self.cache_dir, "data.jsonl")
+        with open(data_file, "w") as f:
+            for data in load_data():
+                f.write(json.dumps(data) + "\n")
+        result = CliRunner().invoke(main, ["warm", "tests.test_warmup:make_chain", data_file, "-p", "2"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("6/6 missing items processed (0 existing", result.output)
+        chain = make_chain()
+        self.assertTrue(all(chain.modules[1].check_cache_exists({"input": i}) for i in range(6)))
+        chain.close()
+
+        result = CliRunner().invoke(main, ["warm", "tests.test_warmup:make_chain", "tests.test_warmup:load_data"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("0/0 missing items processed (6 existing", result.output)